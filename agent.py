@@ -5,50 +5,72 @@
 # Fabian Lohmann, July 2025
 # FDLohmann@gmail.com
 
+import bisect
 import mesa
+from data import ARTI_MAGGIORI
 
-class household(mesa.Agent):
+# Wealth class thresholds on investments, based on the 1427 distribution
+# Poor: bottom 24.8%, Lower middle: 25.0%, Upper middle: 24.9%, Wealthy: 15.0%, Affluent: 9.1%, Elite: top 1.2%
+CLASS_THRESHOLDS = [29, 210, 893, 2634, 14299]
 
-    def __init__(self, model, investments, deductions, trade, bocche):
+# Returns the wealth class (0-5) for an amount of investments
+def wealth_class_of(investments, class_thresholds=CLASS_THRESHOLDS):
+    return bisect.bisect_right(class_thresholds, investments)
+
+# Guild code as a number, from the last two digits of the Catasto trade code
+def guild_of(trade):
+    return int(trade)
+
+ARTI_MAGGIORI_GUILDS = {guild_of(code) for code in ARTI_MAGGIORI}
+
+# Range of the number of trades per step (inclusive) for each trade strategy
+# Agents can trade 1 to 10 times, strategies 1-3 favor higher trade volumes
+# These are the defaults of the class_thresholds and trades_per_strategy model parameters
+TRADES_PER_STRATEGY = [(1, 3), (3, 7), (7, 10), (8, 10), (1, 10)]
+
+# Behaviour of a household agent, its state is kept by the subclasses: in slots (household) or in the model's
+# HouseholdArrays columns (engine.array_household). Values used within one phase are local variables.
+class household_agent(mesa.Agent):
+
+    # Attributes kept per agent by both subclasses, Mesa's model and pos included
+    __slots__ = ("model", "pos", "trade", "received_trades")
+
+    members = 1             # Households represented by this agent, grouped households have more
+
+    # trade_strategy is drawn here unless it is given, as for households that split off
+    def __init__(self, model, investments, deductions, trade, bocche, location=0, trade_strategy=None):
         super().__init__(model)
         self.investments = investments
         self.deductions = deductions
         self.wealth = investments - deductions
         self.trade = trade
-        if self.trade in [21, 22, 23, 24, 25, 26, 27]:          # Check if the agent is in the Arti Maggiori
-            self.artimag = True
-        else:
-            self.artimag = False
+        self.guild = guild_of(trade)
+        self.location = location    # Quarter (gonfalone) of the city
         self.bocche = bocche
         self.taxable = 0        # Initiate taxable variable
-        self.trades_n = 1       # Initialize number of trades per step variable
-        self.trade_size = 100
-        self.trade_strategy = self.random.randint(0, 4)     # Determines whether agents favors small or large amounts of trades
-        self.production = 0
-        self.remaining_production = 0
+        if trade_strategy is None:
+            trade_strategy = self.draws("strategy").randint(0, 4)       # Determines whether agents favors small or large amounts of trades
+        self.trade_strategy = trade_strategy
 
         # Determine wealth class of agent based on investments
-        if self.investments < 29:           # Bottom 24.8%
-            self.wealth_class = 0
-        elif self.investments < 210:        # 25.0%
-            self.wealth_class = 1
-        elif self.investments < 893:        # 24.9%
-            self.wealth_class = 2                        
-        elif self.investments < 2634:       # 15.0%
-            self.wealth_class = 3
-        elif self.investments < 14299:      # 9.1%
-            self.wealth_class = 4         
-        else:                               # Top 1.2%
-            self.wealth_class = 5
-
-        self.labor_productivity = 40        # florins per person per year
-        self.capital_return_rate = 0.06     # 5-8% was typical for pre-industrial economies
-        self.partner_class = 1              # Initialize this variable to choose trading partners
+        self.wealth_class = wealth_class_of(self.investments, self.model.class_thresholds)
+        self.model.classified_agents.add(self, self.wealth_class)
+
+    # Check if the agent is in the Arti Maggiori
+    @property
+    def artimag(self):
+        return self.guild in ARTI_MAGGIORI_GUILDS
 
     def say_hi(self):       # Test action
         # Prints agent's ID and wealth.
         print(f"I am agent {str(self.unique_id)}, I have {str(self.wealth)} Florins. I am in guild {str(self.trade)}")
 
+    # Random numbers for one phase, from the model's counter-based streams if it uses them
+    def draws(self, phase):
+        if self.model.streams is None:
+            return self.random
+        return self.model.streams.draws(self.model.year, phase, self.unique_id)
+
     # Calculates taxable income
     def calculate_taxable(self):
         self.taxable = self.wealth - self.bocche * 200    # 200 Florins tax deduction per family member   
@@ -57,133 +79,160 @@ class household(mesa.Agent):
 
     # Agent engages in economic value production and trading behavior
     def trading_phase(self):
+        if self.model.streams is not None:
+            return self.trading_phase_streams()
+
         # Every agent produces value based on their investments and household members      
-        self.production = round((self.bocche * self.labor_productivity + self.investments * self.capital_return_rate) * (1 - self.model.instability))
-        self.remaining_production = round(self.production)
+        model = self.model
+        production = round((self.bocche * model.labor_productivity + self.investments * model.capital_return_rate) * (1 - model.instability))
+        remaining_production = production
         
         # Every agent randomly trades their production in exchange for wealth
         # Based on trade strategy agents can trade 1 to 10 times, favoring higher trade volumes
-        if self.trade_strategy == 0:
-            self.trades_n = self.random.randint(1, 3)
-        elif self.trade_strategy == 1:
-            self.trades_n = self.random.randint(3, 7)
-        elif self.trade_strategy == 2:
-            self.trades_n = self.random.randint(7, 10)
-        elif self.trade_strategy == 3:
-            self.trades_n = self.random.randint(8, 10)
-        elif self.trade_strategy == 4:
-            self.trades_n = self.random.randint(1, 10)        
+        trades_n = self.random.randint(*model.trades_per_strategy[self.trade_strategy])
                 
-        self.trade_size = round(self.production / self.trades_n)
+        trade_size = round(production / trades_n)
+        lowest_class = wealth_class_of(trade_size, model.class_thresholds)        # Lowest wealth class that can afford the trade
+        flows = model.trade_flows
+        partners = []
         
         # Find trade partners and trade
-        for _ in range(self.trades_n):
+        for _ in range(trades_n):
             
             # Randomly choose the wealth class of the trading partner based on the size of the trade
-            if self.trade_size < 29:
-                self.partner_class = self.random.randint(0,6)
-                if self.partner_class > 5:  # Gives double chances of trading within the highest class that can afford it
-                    self.partner_class = 0
-            elif self.trade_size < 210:
-                self.partner_class = self.random.randint(1,6)
-                if self.partner_class > 5:  # Gives double chances of trading within the highest class that can afford it
-                    self.partner_class = 1
-            elif self.trade_size < 893:
-                self.partner_class = self.random.randint(2,6)
-                if self.partner_class > 5:
-                    self.partner_class = 2
-            elif self.trade_size < 2634:
-                self.partner_class = self.random.randint(3,6)
-                if self.partner_class > 5:
-                    self.partner_class = 3                
-            elif self.trade_size < 14299:
-                self.partner_class = self.random.randint(4,6)
-                if self.partner_class > 5:
-                    self.partner_class = 4                
-            else:
-                self.partner_class = self.random.randint(5,6)
-                if self.partner_class > 5:
-                    self.partner_class = 5                                  
+            partner_class = self.random.randint(lowest_class, 6)
+            if partner_class > 5:      # Gives double chances of trading within the lowest class that can afford it
+                partner_class = lowest_class
             
             # Choose a random trading partner in the picked class and trade!
-            if self.model.classified_agents[self.partner_class]:    # Check if there are agents in the class
-                trading_partner = self.random.choice(self.model.classified_agents[self.partner_class])
-                trading_partner.deductions += self.trade_size
-                self.investments += self.trade_size
-                self.remaining_production -= self.trade_size
+            trading_partner = model.trading_partner(partner_class, self)
+            if trading_partner is not None:                 # Check if there are agents in the class
+                trading_partner.deductions += trade_size
+                self.investments += trade_size
+                remaining_production -= trade_size
+                if flows is not None:
+                    partners.append(trading_partner)
+
+        if flows is not None:
+            flows.record(self, partners, trade_size)
 
         # Put remaining production into personal wealth
-        if self.remaining_production > 0:
-            self.investments += self.remaining_production
-            self.remaining_production = 0
+        if remaining_production > 0:
+            self.investments += remaining_production
+
+    # Trading with counter-based streams, mirrored by HouseholdArrays.trading_phase_streams
+    # Draws are keyed by household and trade, partners are picked from classes sorted by unique_id and trades
+    # are settled after all households traded, so the order of the households does not change the result.
+    def trading_phase_streams(self):
+        streams = self.model.streams
+        key = streams.key(self.model.year, "trading", self.unique_id)
+        partner_key = streams.key(self.model.year, "partners", self.unique_id) if self.model.preferences is not None else None
+        production = round((self.bocche * self.model.labor_productivity + self.investments * self.model.capital_return_rate) * (1 - self.model.instability))
+        trades_n = streams.integer(key, 0, *self.model.trades_per_strategy[self.trade_strategy])
+        trade_size = round(production / trades_n)
+        lowest_class = wealth_class_of(trade_size, self.model.class_thresholds)
+        flows = self.model.trade_flows
+        partners = []
+
+        gained = 0
+        for trade in range(trades_n):
+            partner_class = streams.integer(key, 2 * trade + 1, lowest_class, 6)
+            if partner_class > 5:
+                partner_class = lowest_class
+            pool = self.model.trading_pools[partner_class]
+            if pool:
+                partner = pool[int(streams.uniform(key, 2 * trade + 2) * len(pool))]
+                if partner_key is not None:
+                    local = self.model.local_partner(self, partner_class, streams.uniform(partner_key, 2 * trade), streams.uniform(partner_key, 2 * trade + 1), self.model.local_pools)
+                    partner = local if local is not None else partner
+                partner.received_trades += trade_size
+                gained += trade_size
+                if flows is not None:
+                    partners.append(partner)
+        self.investments += gained + max(production - gained, 0)    # Trades plus any remaining production
+        if flows is not None:
+            flows.record(self, partners, trade_size)
 
     
     # Agent is taxed and has an opportunity to pay off debt. There is also a chance that the household will split
     def recalculation_phase(self):  
+        random = self.draws("recalculation")
         
         # Chance to pay off a random debt percentage
         if self.investments > self.deductions:
             if self.wealth_class >= 4:        
                 if (0.7 * self.investments) < self.deductions:              # Wealthy aim to keep their debts at 70% of their investments
-                        self.deductions_percentage = self.random.random() * 0.3 + self.random.random() * 0.1    # 0.1 for random costs
+                        deductions_percentage = random.random() * 0.3 + random.random() * 0.1    # 0.1 for random costs
                 else:
-                    self.deductions_percentage = self.random.random() * 0.1 # Wealthy always have at least some costs
+                    deductions_percentage = random.random() * 0.1 # Wealthy always have at least some costs
             elif self.wealth_class == 3:
                 if (0.3 * self.investments) < self.deductions:              # Middle class aim to keep their debts at 30% of their investments
-                        self.deductions_percentage = self.random.random() * 0.3
+                        deductions_percentage = random.random() * 0.3
                 else:
-                    self.deductions_percentage = self.random.random() * 0.2 #                     
+                    deductions_percentage = random.random() * 0.2 #                     
             else:
-                self.deductions_percentage = self.random.random()           # The poor always try to escape their debts
-            self.deductions_amount = self.deductions * self.deductions_percentage
-            self.deductions -= self.deductions_amount
-            self.investments -= self.deductions_amount
+                deductions_percentage = random.random()           # The poor always try to escape their debts
+            deductions_amount = self.deductions * deductions_percentage
+            self.deductions -= deductions_amount
+            self.investments -= deductions_amount
             
         if self.taxable > 0:
             # Include forced loans
-            self.tax = self.taxable * self.model.tax_percentage
-            self.deductions += self.tax                         # Add tax to deductions
-            #self.model.city_government.revenue += self.tax     # Add tax to the government
-        else:
-            self.tax = 0
+            tax = self.taxable * self.model.tax_percentage
+            self.deductions += tax                         # Add tax to deductions
+            #self.model.city_government.revenue += tax     # Add tax to the government
         
         # There is a chance a household can split due to marriage or other circumstances
         # Likelihood calculation is loosely based on household numbers in the catasti
         if self.bocche >= 2:
-            split_probability = (self.bocche**2) * 0.00015      # Exponential likelihood increase with family size 
+            split_probability = (self.bocche**2) * self.model.split_coefficient   # Exponential likelihood increase with family size 
             # if self.wealth_class >= 4:                            # Optional code to let wealthy families create more branches
             #     split_probability *= 1.5        
-            if self.random.random() < split_probability:
-                new_bocche = self.random.randint(1, (self.bocche // 2))
+            if random.random() < split_probability:
+                new_bocche = random.randint(1, (self.bocche // 2))
                 new_investments = round((new_bocche / self.bocche) * self.investments)
                 new_deductions = round((new_bocche / self.bocche) * self.deductions)
                 self.bocche -= new_bocche            
                 self.investments -= new_investments
                 self.deductions -= new_deductions
-                household.create_agents(
-                    model=self.model, 
-                    n=1,
-                    investments = new_investments,
-                    deductions = new_deductions,
-                    trade = self.trade,
-                    bocche = new_bocche,
-                    )
+                # The new household is created by Florence.create_splits once all households recalculated,
+                # its trade strategy is drawn now. With streams it is drawn from its unique_id once it is created.
+                trade_strategy = self.random.randint(0, 4) if self.model.streams is None else None
+                self.model.splits[self] = (new_investments, new_deductions, new_bocche, trade_strategy)
             
-        self.wealth = self.investments - self.deductions        # Recalculate wealth
-
-        # Put agent in the appropriate wealth class
-        if self.investments < 29:        # Bottom 24.8% in original distribution
-            self.wealth_class = 0
-        elif self.investments < 210:     # 25.0%
-            self.wealth_class = 1
-        elif self.investments < 893:     # 24.9%
-            self.wealth_class = 2                        
-        elif self.investments < 2634:    # 15.0%
-            self.wealth_class = 3
-        elif self.investments < 14299:   # 9.1%
-            self.wealth_class = 4         
-        else:                            # Top 1.2%
-            self.wealth_class = 5
+        self.update_wealth()
+
+    # Recalculates wealth and the wealth class, the household moves in the class index in Florence.create_splits
+    def update_wealth(self):
+        self.wealth = self.investments - self.deductions
+        self.wealth_class = wealth_class_of(self.investments, self.model.class_thresholds)
+
+    # The household loses one member, returns its estate (investments, deductions, wealth) if it died out
+    def death(self):
+        self.bocche -= 1
+        if self.bocche <= 0:
+            return (self.investments, self.deductions, self.wealth)
+        return None
+
+    def birth(self):
+        self.bocche += 1
+
+    # Adds a share of a deceased household's estate
+    def inherit(self, investments, deductions):
+        self.investments += investments
+        self.deductions += deductions
+
+    # Removes the household from the model and from the wealth class index
+    def remove(self):
+        self.model.classified_agents.remove(self)
+        super().remove()
+
+
+# Household agent of the objects engine
+class household(household_agent):
+
+    # Household state is kept in slots instead of a per-household dict, so households only get a dict if something else is added to them
+    __slots__ = ("unique_id", "investments", "deductions", "wealth", "taxable", "guild", "location", "bocche", "trade_strategy", "wealth_class")
             
 
 ### Potential city government agent for future versions ###
@@ -0,0 +1,137 @@
+# Scaling benchmark for agent-based Renaissance Florence simulation.
+# Bootstraps synthetic populations of any size from the 1427 Catasto, scales the forced loans and the
+# population baseline to match, and times construction, every step phase and data collection.
+# Each case runs in a fresh process so its peak memory can be measured.
+# Results are written as JSON and compared against a stored baseline to catch regressions.
+#
+# Usage: python benchmark.py --sizes 10000 100000 1000000 --years 5 --out benchmark.json --baseline benchmark_baseline.json
+
+import argparse
+import json
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from data import load_inputs
+from model import Florence
+from profiling import bytes_per_household
+
+# Measurements compared against the baseline, lower is better for all of them
+METRICS = ["construction_seconds", "step_seconds", "collect_seconds", "peak_memory_mb"]
+
+# Synthetic Catasto of size households, rows of the 1427 Catasto drawn with replacement
+def synthetic_catasto(df_1427, size, seed=0):
+    rng = np.random.default_rng(seed)
+    return df_1427.iloc[rng.integers(0, len(df_1427), size)].reset_index(drop=True)
+
+# Model inputs for a synthetic population of size households
+# Forced loans grow with the population, so the tax rate stays the same, and so does the
+# instability they cause because the florins per unit of instability grow along with them.
+def scaled_inputs(size, seed=0):
+    df_1427, forced_loans_dict, mortality_dict = load_inputs()
+    df = synthetic_catasto(df_1427, size, seed)
+    population = int(df["bocche"].sum())
+    scale = population / df_1427["bocche"].sum()
+    forced_loans = {year: amount * scale for year, amount in forced_loans_dict.items()}
+    params = {"population_1427": population, "instability_tax_unit": 1000000 * scale}
+    return df, forced_loans, mortality_dict, params
+
+# Highest resident memory of this process in MB
+def peak_memory_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024     # Bytes on macOS, kilobytes on Linux
+
+# Runs one benchmark case, meant to be called in a fresh process
+def run_case(size, years=5, engine="objects", seed=1):
+    df, forced_loans, mortality, params = scaled_inputs(size, seed)
+    start = time.perf_counter()
+    model = Florence(1, df, forced_loans, mortality, seed=seed, engine=engine, agent_history=False, params=params, profile="summary", quiet=True)
+    construction = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(years):
+        model.step()
+    steps = time.perf_counter() - start
+    phases = model.profiler.to_dataframe()["Seconds"]
+    return {
+        "size": size,
+        "engine": engine,
+        "years": years,
+        "seed": seed,
+        "final_households": len(model.agents),
+        "construction_seconds": construction,
+        "step_seconds": steps,
+        "collect_seconds": phases.get("collect", 0.0),
+        "phase_seconds": {name: float(seconds) for name, seconds in phases.items() if name != "setup"},
+        "peak_memory_mb": peak_memory_mb(),
+        "bytes_per_household": bytes_per_household(model),
+    }
+
+# Runs every case in its own process, one at a time so the timings do not compete for cores
+def run_benchmark(sizes, years=5, engines=("objects",), seed=1):
+    results = []
+    for engine in engines:
+        for size in sizes:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                result = executor.submit(run_case, size, years, engine, seed).result()
+            print(f"{engine} {size} households: {result['construction_seconds']:.2f}s setup, {result['step_seconds']:.2f}s for {years} years, {result['peak_memory_mb']:.0f} MB, {result['bytes_per_household']:.0f} bytes per household")
+            results.append(result)
+    return {
+        "machine": {
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+        },
+        "results": results,
+    }
+
+# Compares results with a baseline, cases match on size, engine, years and seed
+# A metric regresses when it is more than tolerance (relative) above the baseline
+def compare(current, baseline, tolerance=0.25):
+    key = lambda r: (r["size"], r["engine"], r["years"], r["seed"])
+    previous = {key(r): r for r in baseline["results"]}
+    rows = []
+    for result in current["results"]:
+        if key(result) not in previous:
+            continue
+        for metric in METRICS:
+            old, new = previous[key(result)][metric], result[metric]
+            ratio = new / old if old > 0 else np.inf
+            rows.append({
+                "size": result["size"],
+                "engine": result["engine"],
+                "metric": metric,
+                "baseline": old,
+                "current": new,
+                "ratio": ratio,
+                "regression": ratio > 1 + tolerance,
+            })
+    return pd.DataFrame(rows, columns=["size", "engine", "metric", "baseline", "current", "ratio", "regression"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the Florence model on synthetic populations.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000], help="households per case")
+    parser.add_argument("--years", type=int, default=5, help="years to simulate per case")
+    parser.add_argument("--engines", nargs="+", default=["objects", "arrays"], choices=["objects", "arrays"])
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", default="benchmark.json", help="results file")
+    parser.add_argument("--baseline", default=None, help="results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative slowdown before a regression is reported")
+    args = parser.parse_args()
+
+    current = run_benchmark(args.sizes, args.years, args.engines, args.seed)
+    with open(args.out, "w") as f:
+        json.dump(current, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            comparison = compare(current, json.load(f), args.tolerance)
+        print(comparison.to_string(index=False))
+        if comparison["regression"].any():
+            print("Performance regressions found.")
+            sys.exit(1)
@@ -0,0 +1,81 @@
+# Breakdown statistics for agent-based Renaissance Florence simulation.
+# Wealth share, Gini coefficient, mean and median wealth, households, population and tax paid per guild,
+# per location and for the Arti Maggiori against all other households, every step.
+# Each breakdown is one pass over the households sorted by group and wealth, the sort of the wealths is shared.
+
+import numpy as np
+import pandas as pd
+from agent import ARTI_MAGGIORI_GUILDS
+
+# Household attributes the breakdowns need on top of the model's snapshot
+BREAKDOWN_COLUMNS = {
+    "guild": np.int64,
+    "location": np.int64,
+    "taxable": np.float64,
+}
+
+# Breakdowns and the name of their group column
+BY = {"guild": "Guild", "location": "Location", "arti_maggiori": "Arti_Maggiori"}
+
+METRICS = ["Households", "Population", "Total_Wealth", "Wealth_Share", "Avg_Wealth", "Median_Wealth", "Gini", "Tax_Paid"]
+
+# Group of every household in one breakdown, Arti Maggiori membership is 1 for members and 0 for all others
+def group_codes(snapshot, by):
+    if by == "arti_maggiori":
+        return np.isin(snapshot["guild"], list(ARTI_MAGGIORI_GUILDS)).astype(np.int64)
+    return snapshot[by]
+
+# Statistics of every group of one breakdown, order is the households sorted by wealth
+# The Gini coefficient and the median are computed as by gini_sorted and np.median within every group.
+def breakdown_of(snapshot, tax_percentage, by, order=None):
+    wealth = snapshot["wealth"]
+    if order is None:
+        order = np.argsort(wealth, kind="stable")
+    codes = group_codes(snapshot, by)
+    order = order[np.argsort(codes[order], kind="stable")]     # By group, and by wealth within every group
+    wealth = wealth[order]
+    groups, starts, counts = np.unique(codes[order], return_index=True, return_counts=True)
+    segment = np.repeat(np.arange(len(groups)), counts)
+    n = len(groups)
+
+    total = np.bincount(segment, weights=wealth, minlength=n)
+    clipped = np.maximum(wealth, 0)                             # Negative wealth counts as zero in the Gini coefficient
+    clipped_total = np.bincount(segment, weights=clipped, minlength=n)
+    rank = np.arange(len(order)) - starts[segment] + 1
+    weighted = np.bincount(segment, weights=rank * clipped, minlength=n)
+    has_wealth = clipped_total > 0
+    gini = np.zeros(n)
+    gini[has_wealth] = (2 * weighted[has_wealth]) / (counts[has_wealth] * clipped_total[has_wealth]) - (counts[has_wealth] + 1) / counts[has_wealth]
+    city_wealth = total.sum()
+
+    return {
+        "Group": groups,
+        "Households": counts,
+        "Population": np.bincount(segment, weights=snapshot["bocche"][order], minlength=n).astype(np.int64),
+        "Total_Wealth": total,
+        "Wealth_Share": total / city_wealth if city_wealth != 0 else np.zeros(n),
+        "Avg_Wealth": total / counts,
+        "Median_Wealth": (wealth[starts + (counts - 1) // 2] + wealth[starts + counts // 2]) / 2,
+        "Gini": gini,
+        "Tax_Paid": np.bincount(segment, weights=snapshot["taxable"][order] * tax_percentage, minlength=n),
+    }
+
+class Breakdown:
+
+    def __init__(self, by=tuple(BY)):
+        self.by = by
+        self.records = {name: [] for name in by}    # Breakdown -> [(step, year, statistics), ...]
+
+    # Adds the breakdowns of one step, tax paid is the taxable income of this year times the tax percentage
+    def record(self, step, year, snapshot, tax_percentage):
+        order = np.argsort(snapshot["wealth"], kind="stable")
+        for name in self.by:
+            self.records[name].append((step, year, breakdown_of(snapshot, tax_percentage, name, order)))
+
+    # One row per step and group, e.g. to_dataframe("arti_maggiori")
+    def to_dataframe(self, by="guild"):
+        frames = [pd.DataFrame({"Step": step, "Year": year, **statistics}) for step, year, statistics in self.records[by]]
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=["Step", "Year", "Group"] + METRICS)
+        if by == "arti_maggiori":
+            df["Group"] = df["Group"].astype(bool)
+        return df.rename(columns={"Group": BY[by]})
@@ -0,0 +1,147 @@
+# Calibration of agent-based Renaissance Florence simulation against the 1457 Catasto.
+# Scores runs on wealth class counts, the wealth distribution and the Gini coefficient,
+# searches the parameter space in parallel, caches finished evaluations on disk and
+# stops runs early once they are clearly worse than the best run so far.
+#
+# Usage: python calibrate.py --samples 64 --workers 8 --out calibration.csv
+
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from agent import CLASS_THRESHOLDS
+from data import load_inputs, load_catasto_1457
+from model import Florence, household_snapshot, gini_sorted
+
+# Search ranges of the calibrated parameters
+BOUNDS = {
+    "labor_productivity": (30, 50),
+    "capital_return_rate": (0.04, 0.08),
+    "instability_decay_rate": (0.3, 0.7),
+    "split_coefficient": (0.00005, 0.0003),
+}
+
+# Weights of the score components, a lower score is better
+WEIGHTS = {"class_error": 1.0, "wealth_distance": 1.0, "gini_error": 1.0}
+
+inputs = None       # Model inputs and 1457 targets, loaded once per worker process
+targets = None
+
+# Class counts, sorted wealths and Gini coefficient of the 1457 Catasto
+def load_targets():
+    df_1457 = load_catasto_1457(["total", "deductions"])
+    wealths = np.sort((df_1457["total"] - df_1457["deductions"].fillna(0)).to_numpy(dtype=float))
+    return {
+        "class_counts": np.bincount(np.searchsorted(CLASS_THRESHOLDS, df_1457["total"], side="right"), minlength=6),
+        "wealths": wealths,
+        "gini": gini_sorted(wealths),
+    }
+
+def init_worker():
+    global inputs, targets
+    inputs = load_inputs()
+    targets = load_targets()
+
+# Scores the current households of a model against the 1457 targets
+def score_model(model):
+    snapshot = household_snapshot(model)
+    wealths = np.sort(snapshot["wealth"])
+    class_counts = np.bincount(snapshot["wealth_class"], minlength=6)
+
+    # Absolute class count error, relative to the number of historical households
+    class_error = np.abs(class_counts - targets["class_counts"]).sum() / targets["class_counts"].sum()
+
+    # Kolmogorov-Smirnov distance between the simulated and historical wealth distributions
+    grid = np.concatenate((wealths, targets["wealths"]))
+    simulated_cdf = np.searchsorted(wealths, grid, side="right") / max(len(wealths), 1)
+    historical_cdf = np.searchsorted(targets["wealths"], grid, side="right") / len(targets["wealths"])
+    wealth_distance = np.abs(simulated_cdf - historical_cdf).max()
+
+    gini_error = abs(gini_sorted(wealths) - targets["gini"])
+    components = {"class_error": class_error, "wealth_distance": wealth_distance, "gini_error": gini_error}
+    return sum(WEIGHTS[name] * value for name, value in components.items()), components
+
+# Runs the model for one parameter set and seed, scoring it after every year
+# The run is stopped once its score is more than tolerance times the best run's score in the same year
+def evaluate(params, seed, years=30, best_trajectory=None, tolerance=1.5, min_years=10):
+    df_1427, forced_loans_dict, mortality_dict = inputs
+    trajectory = []
+    model = Florence(1, df_1427, forced_loans_dict, mortality_dict, seed=seed, agent_history=False, params=params, quiet=True)
+    for year in range(years):
+        model.step()
+        score, components = score_model(model)
+        trajectory.append(score)
+        if best_trajectory is not None and year + 1 >= min_years and score > best_trajectory[year] * tolerance:
+            return {"score": np.inf, "stopped_year": model.year, "trajectory": trajectory, **components}
+    return {"score": score, "stopped_year": None, "trajectory": trajectory, **components}
+
+# Cache key for one evaluation
+def evaluation_key(params, seed, years):
+    text = json.dumps({"params": params, "seed": seed, "years": years}, sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+# Latin hypercube sample of n parameter sets within the bounds
+def latin_hypercube(n, bounds=BOUNDS, seed=0):
+    rng = np.random.default_rng(seed)
+    samples = [{} for _ in range(n)]
+    for name, (low, high) in bounds.items():
+        strata = (rng.permutation(n) + rng.random(n)) / n
+        for sample, value in zip(samples, low + strata * (high - low)):
+            sample[name] = float(value)
+    return samples
+
+# Evaluates every parameter set for every seed and returns all evaluations sorted by score
+# Evaluations run in batches, the best trajectory so far is used to stop runs in the next batches early.
+# The batch size, not the number of workers, decides which runs can be stopped, so results do not depend on workers.
+def calibrate(samples, seeds=(1,), years=30, workers=None, cache_dir="calibration_cache", batch_size=8, tolerance=1.5, min_years=10):
+    os.makedirs(cache_dir, exist_ok=True)
+    tasks = [(params, seed) for params in samples for seed in seeds]
+    results = []
+    best = None
+
+    def use(params, seed, result):
+        nonlocal best
+        results.append({**params, "seed": seed, **{k: v for k, v in result.items() if k != "trajectory"}})
+        if np.isfinite(result["score"]) and (best is None or result["score"] < best["score"]):
+            best = result
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        for start in range(0, len(tasks), batch_size):
+            batch = tasks[start:start + batch_size]
+            pending = []
+            for params, seed in batch:
+                path = os.path.join(cache_dir, evaluation_key(params, seed, years) + ".json")
+                if os.path.exists(path):
+                    with open(path) as f:
+                        use(params, seed, json.load(f))
+                else:
+                    best_trajectory = best["trajectory"] if best is not None else None
+                    pending.append((params, seed, path, executor.submit(evaluate, params, seed, years, best_trajectory, tolerance, min_years)))
+            for params, seed, path, future in pending:
+                result = future.result()
+                with open(path, "w") as f:
+                    json.dump(result, f)
+                use(params, seed, result)
+
+    return pd.DataFrame(results).sort_values("score").reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate the Florence model against the 1457 Catasto.")
+    parser.add_argument("--samples", type=int, default=32, help="number of parameter sets")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[1], help="seeds per parameter set")
+    parser.add_argument("--years", type=int, default=30)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--sample-seed", type=int, default=0, help="seed of the parameter sample")
+    parser.add_argument("--cache", default="calibration_cache", help="directory with cached evaluations")
+    parser.add_argument("--out", default="calibration.csv")
+    args = parser.parse_args()
+
+    evaluations = calibrate(latin_hypercube(args.samples, seed=args.sample_seed), args.seeds, args.years, args.workers, args.cache)
+    evaluations.to_csv(args.out, index=False)
+    # Average over seeds for every parameter set, early stopped runs count as infinitely bad
+    summary = evaluations.groupby(list(BOUNDS))["score"].mean().sort_values()
+    print(summary.head(10))
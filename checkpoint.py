@@ -0,0 +1,159 @@
+# Checkpoints for agent-based Renaissance Florence simulation.
+# Saves a running Florence model after any step and restores it later, or forks many
+# independent continuations from one checkpoint without simulating the shared years again.
+# Checkpoints are compressed .npz files with the household columns and a JSON header.
+
+import itertools
+import json
+import os
+import mesa
+import numpy as np
+import pandas as pd
+from history import AgentHistory, COLUMNS as HISTORY_COLUMNS
+from model import Florence, compute_statistics
+from sampling import LocalClassIndex
+from sink import plain
+from streams import RandomStreams
+
+# Household attributes stored per household
+HOUSEHOLD_FIELDS = ["unique_id", "investments", "deductions", "wealth", "taxable", "bocche", "wealth_class", "trade_strategy", "trade", "location"]
+
+# Model attributes stored in the header
+MODEL_FIELDS = [
+    "steps", "num_agents", "year", "war", "Cosimo", "instability", "instability_input", "tax_total", "taxable_total",
+    "tax_eligible_households", "tax_percentage", "plague", "population", "population_new", "deaths", "births",
+]
+
+# Takes an in-memory checkpoint of a model: a dict of arrays plus a JSON serializable header
+def take_checkpoint(model):
+    if model.groups is not None:
+        raise ValueError("Models with grouped households cannot be checkpointed.")
+    households = list(model.agents)
+    arrays = {f"household/{name}": np.array([getattr(agent, name) for agent in households]) for name in HOUSEHOLD_FIELDS}
+    for wealth_class, members in enumerate(model.classified_agents.members):     # Order matters for partner picks
+        arrays[f"classes/{wealth_class}"] = np.array([agent.unique_id for agent in members], dtype=np.int64)
+    if isinstance(model.classified_agents, LocalClassIndex):                    # And so does the order of the local lists
+        for key in model.classified_agents.keys:
+            positions = model.classified_agents.local_position[key]
+            arrays[f"local/{key}"] = np.array([positions[agent] for agent in households], dtype=np.int64)
+    for name, values in model.datacollector.model_vars.items():
+        arrays[f"model_vars/{name}"] = np.array(values)
+
+    # Next unique_id Mesa will hand out, the counter is put back after reading it
+    next_id = next(mesa.Agent._ids[model])
+    mesa.Agent._ids[model] = itertools.count(next_id)
+
+    header = {
+        "engine": "arrays" if model.engine is not None else "objects",
+        "streams": None if model.streams is None else model.streams.seed,
+        "params": model.params,
+        "model": {name: plain(getattr(model, name, 0)) for name in MODEL_FIELDS},
+        "forced_loans": [[plain(k), plain(v)] for k, v in model.forced_loans_dict.items()],
+        "mortality": [[plain(k), plain(v)] for k, v in model.mortality_dict.items()],
+        "random": model.random.getstate(),
+        "rng": model.rng.bit_generator.state,
+        "next_id": next_id,
+        "history": None,
+    }
+    if model.agent_history:
+        history = model.agent_history
+        header["history"] = {
+            "every": history.every,
+            "panel": history.panel,
+            "classes": None if history.classes is None else history.classes.tolist(),
+            "rng": history.rng.bit_generator.state,
+        }
+        if history.panel_ids is not None:
+            arrays["history_panel"] = history.panel_ids
+        for name in HISTORY_COLUMNS:
+            arrays[f"history/{name}"] = np.asarray(history.column(name))
+    return {"header": header, "arrays": arrays}
+
+def save_checkpoint(model, path):
+    checkpoint = take_checkpoint(model)
+    np.savez_compressed(path, header=np.array(json.dumps(checkpoint["header"])), **checkpoint["arrays"])
+
+def load_checkpoint(path):
+    with np.load(path) as data:
+        header = json.loads(str(data["header"]))
+        arrays = {name: data[name] for name in data.files if name != "header"}
+    return {"header": header, "arrays": arrays}
+
+# Rebuilds a model from a checkpoint (or the path of a saved one)
+# forced_loans_dict, mortality_dict and params can be replaced for counterfactual continuations.
+# A seed reseeds the model's RNGs, otherwise the continuation is identical to the original run.
+def restore(checkpoint, forced_loans_dict=None, mortality_dict=None, params=None, seed=None, agent_history=None, quiet=False):
+    if isinstance(checkpoint, (str, os.PathLike)):
+        checkpoint = load_checkpoint(checkpoint)
+    header, arrays = checkpoint["header"], checkpoint["arrays"]
+    households = {name: arrays[f"household/{name}"] for name in HOUSEHOLD_FIELDS}
+
+    # Households are recreated from their investments, deductions, trade and bocche, like from the Catasto
+    df = pd.DataFrame({
+        "total": households["investments"],
+        "deductions": households["deductions"],
+        "trade_last2": households["trade"],
+        "bocche": households["bocche"],
+        "location": households["location"],
+    })
+    if forced_loans_dict is None:
+        forced_loans_dict = {k: v for k, v in header["forced_loans"]}
+    if mortality_dict is None:
+        mortality_dict = {k: v for k, v in header["mortality"]}
+    model = Florence(1, df, forced_loans_dict, mortality_dict, seed=0, engine=header["engine"],
+                     streams=header.get("streams") is not None, agent_history=False, params={**header["params"], **(params or {})}, quiet=True)
+    model.quiet = quiet                                 # Only the rebuilding itself is silent
+    if model.streams is not None:                       # The streams continue from the seed of the saved run
+        model.streams = RandomStreams(header["streams"])
+
+    # Household state that is not derived from the Catasto columns
+    for i, agent in enumerate(model.agents):
+        agent.unique_id = int(households["unique_id"][i])
+        agent.wealth = households["wealth"][i].item()
+        agent.taxable = households["taxable"][i].item()
+        agent.trade_strategy = int(households["trade_strategy"][i])
+    mesa.Agent._ids[model] = itertools.count(header["next_id"])
+
+    # Rebuild the wealth class index in the saved order
+    by_id = {agent.unique_id: agent for agent in model.agents}
+    model.classified_agents = model.class_index()
+    for wealth_class in range(len(model.classified_agents.members)):
+        for unique_id in arrays[f"classes/{wealth_class}"]:
+            model.classified_agents.add(by_id[int(unique_id)], wealth_class)
+    if isinstance(model.classified_agents, LocalClassIndex):
+        for key in model.classified_agents.keys:
+            saved = dict(zip(households["unique_id"].tolist(), arrays[f"local/{key}"].tolist()))
+            model.classified_agents.arrange(key, lambda agent: saved[agent.unique_id])
+
+    for name, value in header["model"].items():
+        setattr(model, name, value)
+    model.datacollector.model_vars = {name: arrays[f"model_vars/{name}"].tolist() for name in model.datacollector.model_vars}
+    model.statistics = compute_statistics(model)
+
+    if agent_history is not None:
+        model.agent_history = agent_history
+    elif header["history"] is not None:
+        settings = header["history"]
+        history = AgentHistory(every=settings["every"], panel=settings["panel"], classes=settings["classes"])
+        history.rng.bit_generator.state = settings["rng"]
+        history.panel_ids = arrays.get("history_panel")
+        for name in HISTORY_COLUMNS:
+            history.blocks[name] = [arrays[f"history/{name}"]]
+        model.agent_history = history
+
+    # RNG states are tuples in random.getstate(), JSON turned them into lists
+    version, internal, gauss = header["random"]
+    model.random.setstate((version, tuple(internal), gauss))
+    model.rng.bit_generator.state = header["rng"]
+    if seed is not None:
+        model.reset_randomizer(seed)
+        model.reset_rng(seed)
+    return model
+
+# Forks n independent continuations from one checkpoint, seeded with the given seeds
+# (by default the continuations get seeds 1 to n, so they differ from each other)
+def fork(checkpoint, n, seeds=None, **changes):
+    if isinstance(checkpoint, (str, os.PathLike)):
+        checkpoint = load_checkpoint(checkpoint)
+    seeds = list(seeds) if seeds is not None else list(range(1, n + 1))
+    return [restore(checkpoint, seed=seed, **changes) for seed in seeds[:n]]
@@ -0,0 +1,123 @@
+# Data loading for agent-based Renaissance Florence simulation.
+# Parses each Catasto CSV once into a typed binary cache (data/cache/*.npz) and loads that on later runs.
+# The cache is rebuilt when the source file changes (checked by size and modification time, then by hash).
+
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+import numpy as np
+import pandas as pd
+
+DATA_DIR = "data"
+CACHE_VERSION = 1                   # Increase when the preprocessing below changes, so old caches are rebuilt
+ARTI_MAGGIORI = {'21', '22', '23', '24', '25', '26', '27'}      # Arti Maggiori trade codes
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def cache_path(path):
+    return os.path.join(os.path.dirname(path), "cache", os.path.basename(path) + ".npz")
+
+# Stores a dataframe as typed columns, text columns keep a mask of their missing values
+# The cache is written to a temporary file and then moved into place, so readers never see a partial cache.
+# Without write access to the data directory no cache is kept.
+def write_cache(df, path, header):
+    arrays = {}
+    header = {**header, "columns": [], "dtypes": []}
+    for i, name in enumerate(df.columns):
+        column = df[name]
+        header["columns"].append(name)
+        header["dtypes"].append(str(column.dtype))
+        if column.dtype.kind in "biuf":
+            arrays[f"c{i}"] = column.to_numpy()
+        else:
+            missing = column.isna().to_numpy()
+            arrays[f"c{i}"] = np.array([("" if m else str(v)) for v, m in zip(column, missing)], dtype=str)
+            arrays[f"m{i}"] = missing
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        f = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix=os.path.basename(path) + ".", suffix=".tmp", delete=False)
+    except OSError:
+        return
+    try:
+        with f:
+            np.savez(f, header=np.array(json.dumps(header)), **arrays)
+        os.replace(f.name, path)
+    except OSError:
+        if os.path.exists(f.name):
+            os.remove(f.name)
+
+# Reads the cached columns back, optionally only some of them (columns are loaded lazily)
+def read_cache(data, header, columns=None):
+    frame = {}
+    for i, (name, dtype) in enumerate(zip(header["columns"], header["dtypes"])):
+        if columns is not None and name not in columns:
+            continue
+        values = data[f"c{i}"]
+        if f"m{i}" in data.files:
+            values = values.astype(object)
+            values[data[f"m{i}"]] = np.nan
+            if dtype != "object":
+                values = pd.array(values, dtype=dtype)
+        frame[name] = values
+    return pd.DataFrame(frame)
+
+# Reads a CSV through the binary cache, prepare is applied once before caching
+def load_csv(path, prepare=None, columns=None, **read_csv_args):
+    stat = os.stat(path)
+    cache = cache_path(path)
+    if os.path.exists(cache):
+        try:
+            with np.load(cache) as data:
+                header = json.loads(str(data["header"]))
+                if header["version"] == CACHE_VERSION and header["pandas"] == pd.__version__ and header["size"] == stat.st_size:
+                    if header["mtime_ns"] == stat.st_mtime_ns:
+                        return read_cache(data, header, columns)
+                    if header["sha1"] == file_hash(path):        # Touched but unchanged, remember the new time
+                        df = read_cache(data, header)
+                        write_cache(df, cache, {**header, "mtime_ns": stat.st_mtime_ns})
+                        return df if columns is None else df[columns]
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):     # Unreadable or partial cache, rebuild it
+            pass
+
+    df = pd.read_csv(path, **read_csv_args)
+    if prepare is not None:
+        df = prepare(df)
+    write_cache(df, cache, {"version": CACHE_VERSION, "pandas": pd.__version__, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": file_hash(path)})
+    return df if columns is None else df[columns]
+
+# Trades data preprocessing, only the last two digits of the trade code are relevant
+def prepare_1427(df):
+    df['trade'] = df['trade'].astype(str)
+    df['trade_last2'] = df['trade'].str[-2:]
+    return df
+
+# columns selects a subset of the columns, the others are then not read from the cache
+def load_catasto_1427(columns=None):
+    return load_csv(os.path.join(DATA_DIR, "Catasto_1427.csv"), prepare_1427, columns)
+
+def load_catasto_1457(columns=None):
+    return load_csv(os.path.join(DATA_DIR, "Catasto_1457.csv"), columns=columns)
+
+# Forced loans in each year, {year: amount}
+def load_forced_loans():
+    forced_loans = pd.read_csv(os.path.join(DATA_DIR, "forcedloans.txt"), sep='\t')
+    return dict(zip(forced_loans['Year'], forced_loans['Amount']))
+
+# Mortality per 1000 people in epidemic years, {year: mortality}
+def load_mortality():
+    mortality = pd.read_csv(os.path.join(DATA_DIR, "mortality.txt"), sep='\t')
+    return dict(zip(mortality['Year'], mortality['Mortality']))
+
+# Catasto columns used by the model
+MODEL_COLUMNS = ["location", "trade", "trade_last2", "total", "deductions", "bocche"]
+
+# The 1427 Catasto, forced loans and mortality, as passed to Florence
+def load_inputs():
+    return load_catasto_1427(MODEL_COLUMNS), load_forced_loans(), load_mortality()
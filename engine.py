@@ -0,0 +1,425 @@
+# Array-backed household state for agent-based Renaissance Florence simulation.
+# Stores the whole population in contiguous NumPy columns, household agents are thin views on one row.
+# Taxable income, wealth and wealth classes are then computed for all households in one vectorized pass.
+# Utilizes Mesa 3.2.0.
+
+import math
+import mesa
+import numpy as np
+from agent import household_agent, guild_of, CLASS_THRESHOLDS, TRADES_PER_STRATEGY
+
+# Household state columns and their types, small integer types where the values are small
+COLUMNS = {
+    "unique_id": np.int64,
+    "investments": np.float64,
+    "deductions": np.float64,
+    "wealth": np.float64,
+    "taxable": np.float64,
+    "bocche": np.int32,
+    "wealth_class": np.int8,
+    "trade_strategy": np.int8,
+    "guild": np.int64,
+    "location": np.int64,
+}
+
+# Households grouped by wealth class and the values of one more column, e.g. location
+# Returns the order of the households, the number of values and the start and size of every (class, value) pool
+def local_pools(wealth_class, values, unique_id=None):
+    n_values = int(values.max()) + 1 if len(values) else 1
+    index = wealth_class.astype(np.int64) * n_values + values
+    order = np.lexsort((index,)) if unique_id is None else np.lexsort((unique_id, index))
+    sizes = np.bincount(index, minlength=6 * n_values)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    return order, n_values, starts, sizes
+
+
+# Draws of the array kernels below from a NumPy generator, in the order the kernels take them
+class GeneratorDraws:
+
+    def __init__(self, rng):
+        self.rng = rng
+
+    # Trades of every household, low and high inclusive
+    def trades(self, low, high):
+        return self.rng.integers(low, high + 1)
+
+    # Partner class of every trade, from the lowest class that can afford it up to 6, which stands for that class again
+    def partner_classes(self, trader, trade, lowest):
+        return self.rng.integers(lowest, 7)
+
+    # Position of the partner of every trade in its pool
+    def picks(self, trader, trade, sizes):
+        return self.rng.integers(0, sizes)
+
+    # Two draws per household for its debt payment
+    def payments(self, n):
+        return self.rng.random(n), self.rng.random(n)
+
+    # One draw per household for the chance to split, used gives the draws taken by the debt payment
+    def splits(self, used):
+        return self.rng.random(len(used))
+
+    # Members that leave every splitting household, from 1 to half
+    def split_sizes(self, parents, used, half):
+        return self.rng.integers(1, half + 1)
+
+# The same draws from the counter-based streams of one phase, keys has the stream of every household
+# Trade j of a household uses counters 2j+1 for the partner class and 2j+2 for the partner. The debt payment
+# uses counters 1 and 2 and the split the counters after the ones the payment took, like household.draws.
+class StreamDraws:
+
+    def __init__(self, streams, keys):
+        self.streams = streams
+        self.keys = keys
+
+    def trades(self, low, high):
+        return self.streams.integers(self.keys, 0, low, high)
+
+    def partner_classes(self, trader, trade, lowest):
+        return self.streams.integers(self.keys[trader], 2 * trade + 1, lowest, 6)
+
+    def picks(self, trader, trade, sizes):
+        return (self.streams.uniforms(self.keys[trader], 2 * trade + 2) * sizes).astype(np.int64)
+
+    def payments(self, n):
+        return self.streams.uniforms(self.keys, 1), self.streams.uniforms(self.keys, 2)
+
+    def splits(self, used):
+        return self.streams.uniforms(self.keys, used + 1)
+
+    def split_sizes(self, parents, used, half):
+        return 1 + (self.streams.uniforms(self.keys[parents], used + 2) * half).astype(np.int64)
+
+# Vectorized household.trading_phase up to the choice of partners, for households given as columns
+# Returns the production and trade size of every household, and for every trade the trader (position in the
+# columns), the number of the trade within the trader's trades and the partner class, with double chances
+# of trading within the lowest class that can afford the trade
+def plan_trades(bocche, investments, strategy, instability, labor_productivity, capital_return_rate, trades_low, trades_high, class_thresholds, draws):
+    production = np.round((bocche * labor_productivity + investments * capital_return_rate) * (1 - instability))
+    trades_n = draws.trades(trades_low[strategy], trades_high[strategy])
+    trade_size = np.round(production / trades_n)
+    lowest_class = np.searchsorted(class_thresholds, trade_size, side="right")
+
+    trader = np.repeat(np.arange(len(production)), trades_n)
+    trade = np.arange(len(trader)) - np.repeat(np.cumsum(trades_n) - trades_n, trades_n)
+    partner_class = draws.partner_classes(trader, trade, lowest_class[trader])
+    partner_class = np.where(partner_class > 5, lowest_class[trader], partner_class)
+    return production, trade_size, trader, trade, partner_class
+
+# Picks a random partner for every trade in its pool, pools has the households of every pool one after another
+# and pool_sizes the number in each. Trades into an empty pool do not happen.
+# Returns which trades happened and the partners of those trades.
+def pick_partners(pools, pool_sizes, pool, trader, trade, draws):
+    pool_starts = np.concatenate(([0], np.cumsum(pool_sizes)[:-1]))
+    traded = pool_sizes[pool] > 0
+    pool = pool[traded]
+    partner = pools[pool_starts[pool] + draws.picks(trader[traded], trade[traded], pool_sizes[pool])]
+    return traded, partner
+
+# What every household gains from trading: the trades it made plus any remaining production
+# Sums of whole florins are exact, so they do not depend on the order of the trades
+def trading_gains(production, trade_size, trader):
+    gained = np.bincount(trader, weights=trade_size[trader], minlength=len(production))
+    return gained + np.maximum(production - gained, 0)
+
+# Vectorized household.recalculation_phase for households given as columns: the chance to pay off a random debt
+# percentage with the same targets per class, the forced loans and the chance to split.
+# Returns the new investments, deductions and bocche, and the households that split off as
+# (parents, bocche, investments, deductions), parents being positions in the columns.
+def recalculate(investments, deductions, wealth_class, bocche, taxable, tax_percentage, split_coefficient, draws):
+    first, second = draws.payments(len(investments))
+    paying = investments > deductions
+    wealthy = wealth_class >= 4
+    middle = wealth_class == 3
+    indebted = wealthy & (0.7 * investments < deductions)         # The wealthy above their debt target use two draws
+    percentage = np.select(
+        [indebted, wealthy, middle & (0.3 * investments < deductions), middle],
+        [first * 0.3 + second * 0.1, first * 0.1, first * 0.3, first * 0.2],
+        first,
+    )
+    amount = deductions * percentage
+    deductions = np.where(paying, deductions - amount, deductions)
+    investments = np.where(paying, investments - amount, investments)
+    deductions = np.where(taxable > 0, deductions + taxable * tax_percentage, deductions)
+
+    used = np.where(paying, np.where(indebted, 2, 1), 0)
+    split = (bocche >= 2) & (draws.splits(used) < (bocche ** 2) * split_coefficient)
+    parents = np.flatnonzero(split)
+    new_bocche = draws.split_sizes(parents, used[parents], bocche[parents] // 2)
+    new_investments = np.round((new_bocche / bocche[parents]) * investments[parents])
+    new_deductions = np.round((new_bocche / bocche[parents]) * deductions[parents])
+    bocche = bocche.copy()
+    bocche[parents] -= new_bocche.astype(bocche.dtype)
+    investments[parents] -= new_investments
+    deductions[parents] -= new_deductions
+    return investments, deductions, bocche, (parents, new_bocche, new_investments, new_deductions)
+
+# Households per block, blocks number the households by unique_id: block b holds unique_ids b * BLOCK + 1 to (b + 1) * BLOCK.
+# With counter-based streams the population draws and the exactly rounded sums are taken per block, so the
+# results do not depend on the engine or on how the blocks are divided over workers.
+BLOCK = 4096
+
+# The blocks of households given in order of unique_id, as (block, slice of the households in it)
+def block_slices(unique_id):
+    block = (np.asarray(unique_id) - 1) // BLOCK
+    bounds = np.concatenate(([0], np.flatnonzero(np.diff(block)) + 1, [len(block)]))
+    return [(int(block[start]), slice(start, stop)) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+# Exactly rounded sum of the exactly rounded sums of every block, e.g. the taxable total
+def block_fsum(unique_id, values):
+    return math.fsum(math.fsum(values[part]) for _, part in block_slices(unique_id))
+
+# Deaths of the year per block, drawn from the city's deaths stream without replacement from the members of the
+# blocks (multivariate hypergeometric), as if the deaths were drawn one after another over the whole city
+def split_deaths(random, block_bocche, deaths):
+    counts = np.zeros(len(block_bocche), dtype=np.int64)
+    positive = block_bocche > 0
+    if positive.any():
+        counts[positive] = random.multivariate_hypergeometric(block_bocche[positive], deaths)
+    return counts
+
+# Deceased members of the households of one block in order of unique_id, drawn from the block's deaths stream
+def block_deaths(random, bocche, count):
+    if count <= 0:
+        return np.zeros(len(bocche), dtype=np.int64)
+    return random.multivariate_hypergeometric(bocche, count)
+
+# Heirs of the households that died out, 1 to 5 per estate among the n_living households alive after the deaths,
+# drawn from the city's deaths stream after split_deaths. Returns the position of every heir among the living and its
+# shares of the estate's investments and debts, in order of the estates. Heirs of an estate in debt are its creditors.
+def draw_heirs(random, investments, deductions, wealth, n_living):
+    heirs_n = random.integers(1, 6, len(investments))
+    if n_living == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)
+    estate = np.repeat(np.arange(len(investments)), heirs_n)
+    heirs = random.integers(0, n_living, len(estate))
+    shares = investments[estate] / heirs_n[estate]
+    debts = np.where(wealth[estate] >= 0, deductions[estate] / heirs_n[estate], 0)
+    return heirs, shares, debts
+
+# Births of the year per block, by a Polya urn over the members left in every block (Dirichlet-multinomial)
+# drawn from the city's births stream, as if the births were drawn one after another weighted by household size
+def split_births(random, block_bocche, births):
+    counts = np.zeros(len(block_bocche), dtype=np.int64)
+    positive = block_bocche > 0
+    if births > 0 and positive.any():
+        counts[positive] = random.multinomial(births, random.dirichlet(block_bocche[positive]))
+    return counts
+
+# Births in the households of one block with members, in order of unique_id, drawn from the block's births stream
+def block_births(random, bocche, count):
+    if count <= 0:
+        return np.zeros(len(bocche), dtype=np.int64)
+    return random.multinomial(count, random.dirichlet(bocche))
+
+
+# Contiguous column storage for all households of a model
+class HouseholdArrays:
+
+    def __init__(self, capacity=1024, class_thresholds=CLASS_THRESHOLDS, trades_per_strategy=TRADES_PER_STRATEGY):
+        self.size = 0                                   # Number of rows in use, including dead households
+        self.capacity = capacity
+        self.class_thresholds = np.array(class_thresholds)
+        self.trades_low, self.trades_high = np.array(trades_per_strategy).T      # Trade ranges per strategy
+        for name, dtype in COLUMNS.items():
+            setattr(self, name, np.zeros(capacity, dtype=dtype))
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.agents = []                                # Household view for every row, None once it has died
+
+    # Claims a row for a new household, growing the columns if they are full
+    def add(self, agent):
+        row = self.add_rows(1).start
+        self.agents[row] = agent
+        return row
+
+    # Claims n rows for new households at once, their agents are set by the caller
+    def add_rows(self, n):
+        if self.size + n > self.capacity:
+            self.capacity = max(2 * self.capacity, self.size + n)
+            for name in list(COLUMNS) + ["alive"]:
+                column = getattr(self, name)
+                grown = np.zeros(self.capacity, dtype=column.dtype)
+                grown[:self.size] = column[:self.size]
+                setattr(self, name, grown)
+        rows = slice(self.size, self.size + n)
+        self.size += n
+        self.alive[rows] = True
+        self.agents.extend([None] * n)
+        return rows
+
+    # Marks the household in this row as dead, the row is never reused
+    def remove(self, row):
+        self.alive[row] = False
+        self.agents[row] = None
+
+    # Indices of all living households, in order of creation
+    def rows(self):
+        return np.flatnonzero(self.alive[:self.size])
+
+    # Vectorized household.calculate_taxable
+    def calculate_taxable(self):
+        n = self.size
+        self.taxable[:n] = np.maximum(self.wealth[:n] - self.bocche[:n] * 200, 0)     # 200 Florins tax deduction per family member
+
+    # Vectorized household.update_wealth, households that changed class are moved in the class index
+    def update_wealth(self, index):
+        n = self.size
+        previous = self.wealth_class[:n].copy()
+        self.wealth[:n] = self.investments[:n] - self.deductions[:n]
+        self.wealth_class[:n] = np.searchsorted(self.class_thresholds, self.investments[:n], side="right")
+        for row in np.flatnonzero((self.wealth_class[:n] != previous) & self.alive[:n]):
+            index.move(self.agents[row], int(self.wealth_class[row]))
+
+    # Vectorized household.recalculation_phase for all living households, draws is a GeneratorDraws or the
+    # StreamDraws of the households' recalculation streams. Returns the households that split off as
+    # (parent rows, bocche, investments, deductions), to be created with array_household.create_households.
+    def recalculation_phase(self, draws, tax_percentage, split_coefficient, rows=None):
+        rows = self.rows() if rows is None else rows
+        self.investments[rows], self.deductions[rows], self.bocche[rows], (parents, bocche, investments, deductions) = recalculate(
+            self.investments[rows], self.deductions[rows], self.wealth_class[rows], self.bocche[rows], self.taxable[rows], tax_percentage, split_coefficient, draws)
+        return rows[parents], bocche, investments, deductions
+
+    # Vectorized household.trading_phase for all living households in one pass
+    def trading_phase(self, rng, instability, labor_productivity, capital_return_rate, flows=None, preferences=None):
+        rows = self.rows()
+        wealth_class = self.wealth_class[rows]
+        draws = GeneratorDraws(rng)
+        production, trade_size, trader, trade, partner_class = plan_trades(
+            self.bocche[rows], self.investments[rows], self.trade_strategy[rows], instability, labor_productivity, capital_return_rate,
+            self.trades_low, self.trades_high, self.class_thresholds, draws)
+
+        # Pick a random partner in the chosen class, among the living households grouped by wealth class
+        pools = rows[np.argsort(wealth_class, kind="stable")]
+        traded, partner = pick_partners(pools, np.bincount(wealth_class, minlength=6), partner_class, trader, trade, draws)
+        trader = trader[traded]
+        if preferences is not None:
+            local = self.local_partners(rows, trader, partner_class[traded], rng.random(len(trader)), rng.random(len(trader)), preferences)
+            partner = np.where(local >= 0, rows[local], partner)
+        size = trade_size[trader]
+
+        # Partners take on the trade as deductions, traders gain it and keep any remaining production
+        self.deductions[:self.size] += np.bincount(partner, weights=size, minlength=self.size)
+        self.investments[rows] += trading_gains(production, trade_size, trader)
+        if flows is not None:
+            flows.record_rows(self, rows[trader], partner, size)
+
+    # Vectorized household.trading_phase_streams, with the same draws and exact integer sums of the trades
+    def trading_phase_streams(self, streams, year, instability, labor_productivity, capital_return_rate, flows=None, preferences=None):
+        rows = self.rows()
+        unique_id = self.unique_id[rows]
+        wealth_class = self.wealth_class[rows]
+        draws = StreamDraws(streams, streams.keys(year, "trading", unique_id))
+        production, trade_size, trader, trade, partner_class = plan_trades(
+            self.bocche[rows], self.investments[rows], self.trade_strategy[rows], instability, labor_productivity, capital_return_rate,
+            self.trades_low, self.trades_high, self.class_thresholds, draws)
+
+        # Pools per class sorted by unique_id
+        pools = np.lexsort((unique_id, wealth_class))
+        traded, partner = pick_partners(pools, np.bincount(wealth_class, minlength=6), partner_class, trader, trade, draws)
+        trader = trader[traded]
+        if preferences is not None:                     # Trade j draws 2j and 2j+1 of the partners stream
+            trade = trade[traded]
+            partner_keys = streams.keys(year, "partners", unique_id)[trader]
+            mode = streams.uniforms(partner_keys, 2 * trade)
+            local = self.local_partners(rows, trader, partner_class[traded], mode, streams.uniforms(partner_keys, 2 * trade + 1), preferences, by_unique_id=True)
+            partner = np.where(local >= 0, local, partner)
+        size = trade_size[trader]
+
+        self.deductions[rows] += np.bincount(partner, weights=size, minlength=len(rows))
+        self.investments[rows] += trading_gains(production, trade_size, trader)
+        if flows is not None:
+            flows.record_rows(self, rows[trader], rows[partner], size)
+
+    # Vectorized Florence.local_partner: a trade goes to a household of the trader's location (or guild) when its mode
+    # draw falls in the band of that preference and the class has such households there, picked with the pick draw.
+    # Returns the partner as a position in rows for these trades and -1 for all others.
+    def local_partners(self, rows, trader, partner_class, mode, pick, preferences, by_unique_id=False):
+        partner = np.full(len(trader), -1)
+        wealth_class = self.wealth_class[rows]
+        low = 0
+        for key, weight in preferences.items():
+            values = getattr(self, key)[rows]
+            order, n_values, starts, sizes = local_pools(wealth_class, values, self.unique_id[rows] if by_unique_id else None)
+            chosen = np.flatnonzero((mode >= low) & (mode < low + weight))
+            index = partner_class[chosen] * n_values + values[trader[chosen]]
+            found = sizes[index] > 0
+            chosen = chosen[found]
+            index = index[found]
+            partner[chosen] = order[starts[index] + (pick[chosen] * sizes[index]).astype(np.int64)]
+            low += weight
+        return partner
+
+
+# Property that reads and writes one household's value in a column
+def column_property(name, cast):
+    def get(self):
+        return cast(getattr(self._arrays, name)[self._row])
+    def set(self, value):
+        getattr(self._arrays, name)[self._row] = value
+    return property(get, set)
+
+
+# Household agent whose state lives in the model's HouseholdArrays
+# Behaves like a regular household, so all agent methods work unchanged
+class array_household(household_agent):
+
+    __slots__ = ("_arrays", "_row")
+
+    unique_id = column_property("unique_id", int)
+    investments = column_property("investments", float)
+    deductions = column_property("deductions", float)
+    wealth = column_property("wealth", float)
+    taxable = column_property("taxable", float)
+    bocche = column_property("bocche", int)
+    wealth_class = column_property("wealth_class", int)
+    trade_strategy = column_property("trade_strategy", int)
+    guild = column_property("guild", int)
+    location = column_property("location", int)
+
+    def __init__(self, model, investments, deductions, trade, bocche, location=0):
+        self._arrays = model.engine
+        self._row = model.engine.add(self)
+        super().__init__(model, investments, deductions, trade, bocche, location)
+
+    # Creates a household for every value of the columns, like one household after another: the columns are
+    # written in one pass, then every household registers with the model and joins the wealth class index.
+    # Trade strategies take the same draws as household_agent.__init__. Returns the new households.
+    @classmethod
+    def create_households(cls, model, investments, deductions, trade, bocche, location):
+        arrays = model.engine
+        investments = np.asarray(investments, dtype=float)
+        rows = arrays.add_rows(len(investments))
+        arrays.investments[rows] = investments
+        arrays.deductions[rows] = deductions
+        arrays.wealth[rows] = investments - arrays.deductions[rows]
+        arrays.taxable[rows] = 0
+        arrays.bocche[rows] = bocche
+        arrays.guild[rows] = [guild_of(code) for code in trade]
+        arrays.location[rows] = location
+        arrays.wealth_class[rows] = np.searchsorted(arrays.class_thresholds, investments, side="right")
+
+        agents = []
+        for row, code in zip(range(rows.start, rows.stop), trade):
+            agent = cls.__new__(cls)
+            agent._arrays = arrays
+            agent._row = row
+            agent.trade = code
+            mesa.Agent.__init__(agent, model)           # Sets the unique_id and registers the household
+            agents.append(agent)
+        arrays.agents[rows] = agents
+        if model.streams is None:
+            arrays.trade_strategy[rows] = [model.random.randint(0, 4) for _ in agents]
+        else:                                           # The first draw of every household's strategy stream
+            arrays.trade_strategy[rows] = model.streams.integers(model.streams.keys(model.year, "strategy", arrays.unique_id[rows]), 1, 0, 4)
+        for agent, wealth_class in zip(agents, arrays.wealth_class[rows].tolist()):
+            model.classified_agents.add(agent, wealth_class)
+        return agents
+
+    # Wealth and wealth classes are updated for all households at once by HouseholdArrays.update_wealth
+    def update_wealth(self):
+        pass
+
+    # Dead households keep their row, but it is marked as no longer alive
+    def remove(self):
+        self._arrays.remove(self._row)
+        super().remove()
@@ -0,0 +1,91 @@
+# Ensemble runner for agent-based Renaissance Florence simulation.
+# Runs the model for many seeds across a process pool and summarizes the model level series
+# with mean and quantile bands. Results do not depend on the number of workers.
+#
+# Usage: python ensemble.py --runs 100 --workers 8 --out ensemble.csv
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from data import load_inputs
+from model import Florence
+
+# Model level series kept from every run
+SERIES = [
+    "Gini",
+    "Avg_Wealth",
+    "Poor_Households",
+    "Lower_Mid_Households",
+    "Upper_Mid_Households",
+    "Wealthy_Households",
+    "Affluent_Households",
+    "Elite_Households",
+]
+
+QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+inputs = None       # Catasto and exogenous data, loaded once per worker process
+
+def init_worker():
+    global inputs
+    inputs = load_inputs()
+
+# Runs one simulation and returns its model level series as an array of shape (years + 1, len(series))
+def run_one(seed, years=30, engine="objects", series=SERIES):
+    df_1427, forced_loans_dict, mortality_dict = inputs
+    model = Florence(1, df_1427, forced_loans_dict, mortality_dict, seed=seed, engine=engine, agent_history=False, quiet=True)
+    for _ in range(years):
+        model.step()
+    return model.datacollector.get_model_vars_dataframe()[series].to_numpy(dtype=float)
+
+# Runs the model once for every seed, n_runs seeds starting at base_seed unless seeds are given
+# Returns a summary with the mean and quantiles of every series per year, and all runs in long format
+def run_ensemble(n_runs=10, years=30, workers=None, base_seed=1, seeds=None, engine="objects", series=SERIES, quantiles=QUANTILES):
+    seeds = list(seeds) if seeds is not None else list(range(base_seed, base_seed + n_runs))
+    runs = np.empty((len(seeds), years + 1, len(series)))       # Only the model level series are kept, so memory stays small
+
+    if workers == 1:                                            # Run in this process, e.g. for debugging
+        init_worker()
+        results = (run_one(seed, years, engine, series) for seed in seeds)
+        for i, result in enumerate(results):
+            runs[i] = result
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+            # Results stream back in seed order, whatever worker finished first
+            results = executor.map(run_one, seeds, [years] * len(seeds), [engine] * len(seeds), [series] * len(seeds))
+            for i, result in enumerate(results):
+                runs[i] = result
+
+    years_index = pd.Index(np.arange(years + 1) + 1427, name="Year")
+    summary = {}
+    for j, name in enumerate(series):
+        summary[(name, "mean")] = runs[:, :, j].mean(axis=0)
+        for q, values in zip(quantiles, np.quantile(runs[:, :, j], quantiles, axis=0)):
+            summary[(name, f"q{round(q * 100):02d}")] = values
+    summary = pd.DataFrame(summary, index=years_index)
+
+    runs = pd.DataFrame(
+        runs.reshape(-1, len(series)),
+        index=pd.MultiIndex.from_product([seeds, years_index], names=["Seed", "Year"]),
+        columns=series,
+    )
+    return summary, runs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the Florence model for many seeds.")
+    parser.add_argument("--runs", type=int, default=10, help="number of seeds")
+    parser.add_argument("--years", type=int, default=30, help="years to simulate")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--seed", type=int, default=1, help="first seed")
+    parser.add_argument("--engine", default="objects", choices=["objects", "arrays"])
+    parser.add_argument("--out", default="ensemble.csv", help="summary output file")
+    parser.add_argument("--runs-out", default=None, help="optional output file with every run")
+    args = parser.parse_args()
+
+    summary, runs = run_ensemble(args.runs, args.years, args.workers, args.seed, engine=args.engine)
+    summary.to_csv(args.out)
+    if args.runs_out:
+        runs.to_csv(args.runs_out)
+    print(summary.xs("mean", axis=1, level=1).tail(1).T)
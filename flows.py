@@ -0,0 +1,122 @@
+# Trade flow accounting for agent-based Renaissance Florence simulation.
+# Sums the florins and number of trades between sellers and buyers per year, by wealth class, guild
+# (last two digits of the Catasto trade code) and location. Trades are added to small dense matrices
+# with one bincount per year, so recording a trade costs no more than appending the partner to a list.
+# The seller is the trading household, which gains the trade as investments, the buyer is the partner,
+# which takes it on as deductions.
+
+from itertools import chain
+from operator import attrgetter
+import numpy as np
+import pandas as pd
+from agent import ARTI_MAGGIORI_GUILDS
+
+CLASS_NAMES = ["Poor", "Lower_Mid", "Upper_Mid", "Wealthy", "Affluent", "Elite"]
+GUILDS = 100                                        # Guild codes 0-99
+
+# Household attribute (and HouseholdArrays column) each kind of flow is grouped by
+KINDS = {"class": "wealth_class", "guild": "guild", "location": "location"}
+
+class TradeFlows:
+
+    # locations: number of location codes, the highest code plus one
+    def __init__(self, locations):
+        self.sizes = {"class": len(CLASS_NAMES), "guild": GUILDS, "location": locations}
+        self.sellers = []                           # Trades of the objects engine, added up by settle
+        self.buyers = []                            # List of partners per seller
+        self.trade_florins = []                     # Trade size per seller
+        self.florins = {}                           # Year -> {kind: seller x buyer matrix}
+        self.counts = {}
+        self.reset()
+
+    def reset(self):
+        self.year_florins = {kind: np.zeros((n, n)) for kind, n in self.sizes.items()}
+        self.year_counts = {kind: np.zeros((n, n), dtype=np.int64) for kind, n in self.sizes.items()}
+
+    # The trades of one household, which all have the same size
+    def record(self, seller, buyers, florins):
+        self.sellers.append(seller)
+        self.buyers.append(buyers)
+        self.trade_florins.append(florins)
+
+    # Class, guild and location codes of households
+    def codes(self, households):
+        return {kind: np.fromiter(map(attrgetter(column), households), np.int64, len(households)) for kind, column in KINDS.items()}
+
+    # Trades between rows of a HouseholdArrays
+    def record_rows(self, arrays, sellers, buyers, florins):
+        codes = {kind: getattr(arrays, column).astype(np.int64, copy=False) for kind, column in KINDS.items()}
+        self.add({kind: code[sellers] for kind, code in codes.items()}, {kind: code[buyers] for kind, code in codes.items()}, florins)
+
+    def add(self, sellers, buyers, florins):
+        for kind, n in self.sizes.items():
+            index = sellers[kind] * n + buyers[kind]
+            self.year_florins[kind] += np.bincount(index, weights=florins, minlength=n * n).reshape(n, n)
+            self.year_counts[kind] += np.bincount(index, minlength=n * n).reshape(n, n)
+
+    # Adds up the recorded trades and stores the matrices of the year
+    def settle(self, year):
+        if self.sellers:
+            trades = np.fromiter(map(len, self.buyers), np.int64, len(self.buyers))
+            buyers = list(chain.from_iterable(self.buyers))
+            # Codes are read once per buyer, not once per trade
+            _, first, buyer = np.unique(np.fromiter(map(id, buyers), np.int64, len(buyers)), return_index=True, return_inverse=True)
+            self.add(
+                {kind: np.repeat(code, trades) for kind, code in self.codes(self.sellers).items()},
+                {kind: code[buyer] for kind, code in self.codes([buyers[i] for i in first]).items()},
+                np.repeat(np.array(self.trade_florins, dtype=float), trades),
+            )
+            self.sellers, self.buyers, self.trade_florins = [], [], []
+        self.florins[year] = self.year_florins
+        self.counts[year] = self.year_counts
+        self.reset()
+
+    # Seller x buyer matrix of one year, in florins or number of trades
+    def matrix(self, year, kind="class", counts=False):
+        values = (self.counts if counts else self.florins)[year][kind]
+        labels = CLASS_NAMES if kind == "class" else range(self.sizes[kind])
+        return pd.DataFrame(values, index=pd.Index(labels, name="Seller"), columns=pd.Index(labels, name="Buyer"))
+
+    # All matrices of one year, guilds and locations without trades are left out
+    def report(self, year):
+        report = {}
+        for kind in KINDS:
+            df = self.matrix(year, kind)
+            if kind != "class":
+                active = (df.sum(axis=1) > 0) | (df.sum(axis=0) > 0)
+                df = df.loc[active, active]
+            report[kind] = df
+        return report
+
+    # Flows of every year in long format, one row per seller and buyer that traded
+    def to_dataframe(self, kind="class"):
+        labels = np.array(CLASS_NAMES if kind == "class" else range(self.sizes[kind]), dtype=object)
+        frames = []
+        for year, matrices in self.florins.items():
+            sellers, buyers = np.nonzero(self.counts[year][kind])
+            frames.append(pd.DataFrame({
+                "Year": year,
+                "Seller": labels[sellers],
+                "Buyer": labels[buyers],
+                "Florins": matrices[kind][sellers, buyers],
+                "Trades": self.counts[year][kind][sellers, buyers],
+            }))
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=["Year", "Seller", "Buyer", "Florins", "Trades"])
+
+    # Florins traded between the Arti Maggiori and all other households per year
+    def arti_maggiori(self):
+        member = np.isin(np.arange(GUILDS), list(ARTI_MAGGIORI_GUILDS))
+        rows = []
+        for year, matrices in self.florins.items():
+            guild = matrices["guild"]
+            total = guild.sum()
+            rows.append({
+                "Year": year,
+                "Arti_To_Arti": guild[np.ix_(member, member)].sum(),
+                "Arti_To_Other": guild[np.ix_(member, ~member)].sum(),
+                "Other_To_Arti": guild[np.ix_(~member, member)].sum(),
+                "Other_To_Other": guild[np.ix_(~member, ~member)].sum(),
+                "Arti_Sales_Share": guild[member].sum() / total if total > 0 else 0,
+                "Arti_Purchases_Share": guild[:, member].sum() / total if total > 0 else 0,
+            })
+        return pd.DataFrame(rows)
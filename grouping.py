@@ -0,0 +1,357 @@
+# Grouped households for agent-based Renaissance Florence simulation.
+# Mixed resolution mode, Florence(..., group_size=100): Arti Maggiori and Elite households stay individual
+# agents, the other households are bundled into aggregate agents of group_size members, sorted by wealth.
+# An aggregate agent keeps every member's investments, deductions and bocche in small NumPy columns and
+# runs trading, taxes, debt payments, deaths, births and splits for all its members in vectorized passes.
+# Utilizes Mesa 3.2.0.
+#
+# Usage: python grouping.py --group-size 100 --years 30 --seeds 1 2 3
+
+import argparse
+import itertools
+import time
+import mesa
+import numpy as np
+import pandas as pd
+from agent import CLASS_THRESHOLDS, guild_of, wealth_class_of
+from data import ARTI_MAGGIORI, load_inputs
+from engine import GeneratorDraws, plan_trades, recalculate, trading_gains
+
+# Wealth classes (on 1427 investments) whose non Arti Maggiori households are grouped, Elite households stay individual
+GROUPED_CLASSES = (0, 1, 2, 3, 4)
+
+# Member columns of a grouped household and their types
+MEMBER_COLUMNS = {
+    "unique_id": np.int64,
+    "investments": np.float64,
+    "deductions": np.float64,
+    "wealth": np.float64,
+    "taxable": np.float64,
+    "bocche": np.int64,
+    "wealth_class": np.int64,
+    "trade_strategy": np.int64,
+    "trade": object,
+    "guild": np.int64,
+    "location": np.int64,
+}
+
+# Statistics compared between grouped and full resolution runs
+HEADLINE = [
+    "Gini",
+    "Total_Households",
+    "Total_Population",
+    "Avg_Wealth",
+    "Median_Wealth",
+    "Top_10_Percent_Wealth_Share",
+    "Poor_Households",
+    "Lower_Mid_Households",
+    "Upper_Mid_Households",
+    "Wealthy_Households",
+    "Affluent_Households",
+    "Elite_Households",
+]
+
+# Rows of the Catasto that are grouped: not in the Arti Maggiori and in one of the grouped classes
+def grouped_rows(df_1427, grouped_classes=GROUPED_CLASSES, class_thresholds=CLASS_THRESHOLDS):
+    classes = np.searchsorted(class_thresholds, df_1427["total"], side="right")
+    return (~df_1427["trade_last2"].isin(ARTI_MAGGIORI) & np.isin(classes, grouped_classes)).to_numpy()
+
+# Bundles households into groups of group_size, households of similar wealth end up in the same group
+def create_groups(model, investments, deductions, trade, bocche, location, group_size):
+    order = np.argsort(-(investments - deductions), kind="stable")
+    for start in range(0, len(order), group_size):
+        members = order[start:start + group_size]
+        household_group(model, investments[members], deductions[members], trade[members], bocche[members], location[members])
+
+
+# Member of a grouped household picked as a trading partner, trades add to the member's deductions
+class group_member:
+
+    def __init__(self, group, row):
+        self.group = group
+        self.row = row
+
+    @property
+    def deductions(self):
+        return self.group.columns["deductions"][self.row]
+
+    @deductions.setter
+    def deductions(self, value):
+        self.group.columns["deductions"][self.row] = value
+
+
+# All grouped households of a model and which members are in every wealth class
+# Trading partners are drawn uniformly over individual households and group members of a class.
+# Members are numbered across all groups, trades to members are collected and settled after trading.
+class GroupIndex:
+
+    def __init__(self, n_classes=6):
+        self.n_classes = n_classes
+        self.groups = []
+        self.member_ids = itertools.count(1)
+        self.received = np.zeros(0)             # Trades to every member since the last settle
+        self.dirty = True                       # Members or their classes changed since the pools were built
+
+    # Group members get negative ids, so they never clash with Mesa's agent ids
+    def next_member_id(self):
+        return -next(self.member_ids)
+
+    def add(self, group):
+        self.groups.append(group)
+        self.dirty = True
+
+    def remove(self, group):
+        self.groups.remove(group)
+        self.dirty = True
+
+    # Numbers the members of all groups and pools them by wealth class
+    def refresh(self):
+        if self.dirty:
+            self.settle()
+            sizes = [group.members for group in self.groups]
+            self.starts = np.concatenate(([0], np.cumsum(sizes))).astype(np.int64)
+            classes = np.concatenate([group.column("wealth_class") for group in self.groups] + [np.empty(0, dtype=np.int64)])
+            self.pools = [np.flatnonzero(classes == wealth_class) for wealth_class in range(self.n_classes)]
+            # Group and row of every pooled member as plain lists, for fast single picks by individual households
+            group_of = np.repeat(np.arange(len(sizes)), sizes)
+            self.pool_groups = [group_of[pool].tolist() for pool in self.pools]
+            self.pool_rows = [(pool - self.starts[group_of[pool]]).tolist() for pool in self.pools]
+            self.received = np.zeros(len(classes))
+            self.dirty = False
+
+    # Number of group members in a wealth class
+    def members_in(self, wealth_class):
+        self.refresh()
+        return len(self.pools[wealth_class])
+
+    # Number of households in all groups
+    def members_total(self):
+        return sum(group.members for group in self.groups)
+
+    # The offset-th group member in a wealth class
+    def member(self, wealth_class, offset):
+        self.refresh()
+        return group_member(self.groups[self.pool_groups[wealth_class][offset]], self.pool_rows[wealth_class][offset])
+
+    # Collects trades to the offset-th group members in a wealth class
+    def receive(self, wealth_class, offsets, amounts):
+        self.refresh()
+        self.received += np.bincount(self.pools[wealth_class][offsets], weights=amounts, minlength=len(self.received))
+
+    # Adds the collected trades to the members' deductions
+    def settle(self):
+        if self.received.any():
+            for group, start in zip(self.groups, self.starts):
+                group.column("deductions")[:] += self.received[start:start + group.members]
+            self.received[:] = 0
+
+    # Member level columns of all groups, as in household_snapshot
+    def snapshot(self, names):
+        return {name: np.concatenate([group.column(name) for group in self.groups] + [np.empty(0, dtype=MEMBER_COLUMNS[name])]) for name in names}
+
+
+# Aggregate agent for a group of households, every member is simulated like an individual household
+class household_group(mesa.Agent):
+
+    def __init__(self, model, investments, deductions, trade, bocche, location):
+        super().__init__(model)
+        self.members = len(investments)                 # Number of households in the group
+        capacity = max(self.members, 1) * 2             # Room for households that split off
+        self.columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in MEMBER_COLUMNS.items()}
+        self.columns["unique_id"][:self.members] = [model.groups.next_member_id() for _ in range(self.members)]
+        self.columns["investments"][:self.members] = investments
+        self.columns["deductions"][:self.members] = deductions
+        self.columns["trade"][:self.members] = trade
+        self.columns["guild"][:self.members] = [guild_of(t) for t in trade]
+        self.columns["location"][:self.members] = location
+        self.columns["bocche"][:self.members] = bocche
+        self.columns["trade_strategy"][:self.members] = model.rng.integers(0, 5, self.members)
+        self.taxable = 0                                # Total taxable income of the members
+        self.taxable_members = 0                        # Members with taxable income
+        model.groups.add(self)
+        self.update_wealth()
+
+    # Values of all members in one column
+    def column(self, name):
+        return self.columns[name][:self.members]
+
+    @property
+    def investments(self):
+        return float(self.column("investments").sum())
+
+    @property
+    def deductions(self):
+        return float(self.column("deductions").sum())
+
+    @property
+    def wealth(self):
+        return float(self.column("wealth").sum())
+
+    @property
+    def bocche(self):
+        return int(self.column("bocche").sum())
+
+    # Adds a household to the group, growing the columns if they are full
+    def add_member(self, investments, deductions, trade, bocche, location):
+        if self.members == len(self.columns["investments"]):
+            for name, column in self.columns.items():
+                grown = np.zeros(len(column) * 2, dtype=column.dtype)
+                grown[:self.members] = column[:self.members]
+                self.columns[name] = grown
+        row = self.members
+        self.members += 1
+        values = {
+            "unique_id": self.model.groups.next_member_id(),
+            "investments": investments,
+            "deductions": deductions,
+            "wealth": investments - deductions,
+            "taxable": 0,
+            "bocche": bocche,
+            "wealth_class": wealth_class_of(investments, self.model.class_thresholds),
+            "trade_strategy": self.model.rng.integers(0, 5),
+            "trade": trade,
+            "guild": guild_of(trade),
+            "location": location,
+        }
+        for name, value in values.items():
+            self.columns[name][row] = value
+        self.model.groups.dirty = True
+
+    # Removes a household by swapping the last member into its row
+    def remove_member(self, row):
+        last = self.members - 1
+        for column in self.columns.values():
+            column[row] = column[last]
+        self.members -= 1
+        self.model.groups.dirty = True
+
+    # Member picked proportional to bocche, as the model picks households
+    def random_member(self):
+        cumulative = self.column("bocche").cumsum()
+        return min(int(cumulative.searchsorted(self.random.random() * cumulative[-1], side="right")), self.members - 1)
+
+    # Vectorized household.calculate_taxable for all members
+    def calculate_taxable(self):
+        taxable = self.column("taxable")
+        taxable[:] = np.maximum(self.column("wealth") - self.column("bocche") * 200, 0)    # 200 Florins tax deduction per family member
+        self.taxable = float(taxable.sum())
+        self.taxable_members = int(np.count_nonzero(taxable))
+
+    # Vectorized household.trading_phase for all members
+    # Partners are drawn uniformly from the individual households and group members of the picked class.
+    def trading_phase(self):
+        model = self.model
+        rng = model.rng
+        investments = self.column("investments")
+        low, high = np.array(model.trades_per_strategy).T
+        production, trade_size, trader, _, partner_class = plan_trades(
+            self.column("bocche"), investments, self.column("trade_strategy"), model.instability, model.labor_productivity, model.capital_return_rate,
+            low, high, model.class_thresholds, GeneratorDraws(rng))
+        size = trade_size[trader]
+
+        traded = np.zeros(len(trader), dtype=bool)
+        for wealth_class in np.unique(partner_class):
+            trades = partner_class == wealth_class
+            individuals = model.classified_agents[wealth_class]
+            pool = len(individuals) + model.groups.members_in(wealth_class)
+            if pool == 0:                                   # Trades into an empty class do not happen
+                continue
+            picks = rng.integers(0, pool, np.count_nonzero(trades))
+            amounts = size[trades]
+            individual = picks < len(individuals)
+            for pick, amount in zip(picks[individual], amounts[individual]):
+                individuals[pick].deductions += amount
+            model.groups.receive(wealth_class, picks[~individual] - len(individuals), amounts[~individual])
+            traded |= trades
+
+        # Members gain their trades and keep any remaining production
+        investments += trading_gains(production, trade_size, trader[traded])
+
+    # Vectorized household.recalculation_phase for all members, the new households join the group
+    def recalculation_phase(self):
+        model = self.model
+        new_columns = recalculate(
+            self.column("investments"), self.column("deductions"), self.column("wealth_class"), self.column("bocche"), self.column("taxable"),
+            model.tax_percentage, model.split_coefficient, GeneratorDraws(model.rng))
+        for name, values in zip(("investments", "deductions", "bocche"), new_columns):
+            self.column(name)[:] = values
+        for row, b, i, d in zip(*new_columns[3]):
+            self.add_member(i, d, self.columns["trade"][row], b, self.columns["location"][row])
+
+        self.update_wealth()
+
+    # Recalculates wealth and wealth classes of all members
+    def update_wealth(self):
+        investments = self.column("investments")
+        self.column("wealth")[:] = investments - self.column("deductions")
+        self.column("wealth_class")[:] = np.searchsorted(self.model.class_thresholds, investments, side="right")
+        self.model.groups.dirty = True
+
+    # A member loses one person, returns the estate (investments, deductions, wealth) if the member died out
+    def death(self):
+        row = self.random_member()
+        bocche = self.column("bocche")
+        bocche[row] -= 1
+        if bocche[row] > 0:
+            return None
+        estate = (float(self.columns["investments"][row]), float(self.columns["deductions"][row]), float(self.columns["wealth"][row]))
+        self.remove_member(row)
+        return estate
+
+    def birth(self):
+        self.column("bocche")[self.random_member()] += 1
+
+    # A random member is the heir, nothing is inherited once all members died
+    def inherit(self, investments, deductions):
+        if self.members > 0:
+            row = self.random.randrange(self.members)
+            self.columns["investments"][row] += investments
+            self.columns["deductions"][row] += deductions
+
+    def remove(self):
+        self.model.groups.remove(self)
+        super().remove()
+
+
+# Relative drift of the headline statistics of a grouped run from a full resolution run, per year
+def resolution_drift(full, grouped, columns=HEADLINE):
+    full = full[columns].astype(float)
+    grouped = grouped[columns].astype(float)
+    drift = (grouped - full) / full.abs().where(full != 0)
+    drift.index = pd.Index(full.index + 1427, name="Year")
+    return drift
+
+# Runs the full and the grouped model for the same seeds and reports the drift of their mean statistics
+def compare_resolution(df_1427, forced_loans_dict, mortality_dict, seeds=(1,), years=30, group_size=100, grouped_classes=GROUPED_CLASSES):
+    from model import Florence          # The model imports this module
+    runs = {}
+    report = {}
+    for resolution, size in (("full", None), ("grouped", group_size)):
+        start = time.perf_counter()
+        series = []
+        for seed in seeds:
+            model = Florence(1, df_1427, forced_loans_dict, mortality_dict, seed=seed, agent_history=False,
+                             group_size=size, grouped_classes=grouped_classes, quiet=True)
+            agents = len(model.agents)
+            for _ in range(years):
+                model.step()
+            series.append(model.datacollector.get_model_vars_dataframe()[HEADLINE].astype(float))
+        runs[resolution] = sum(series) / len(series)
+        report[resolution] = {"agents": agents, "seconds": time.perf_counter() - start}
+    return resolution_drift(runs["full"], runs["grouped"]), report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the grouped and full resolution Florence models.")
+    parser.add_argument("--group-size", type=int, default=100, help="households per group")
+    parser.add_argument("--years", type=int, default=30)
+    parser.add_argument("--seeds", type=int, nargs="+", default=[1])
+    parser.add_argument("--out", default=None, help="optional output file with the drift per year")
+    args = parser.parse_args()
+
+    drift, report = compare_resolution(*load_inputs(), seeds=args.seeds, years=args.years, group_size=args.group_size)
+    for resolution, values in report.items():
+        print(f"{resolution}: {values['agents']} agents, {values['seconds']:.1f}s")
+    print(drift.tail(1).T.rename(columns=lambda year: f"Drift {year}"))
+    if args.out:
+        drift.to_csv(args.out)
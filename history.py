@@ -0,0 +1,106 @@
+# Columnar storage of household level history for agent-based Renaissance Florence simulation.
+# Appends one typed NumPy block per recorded step instead of a Python dict per household,
+# and can spill the columns to memory-mapped files on disk for long or large runs.
+
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# Stored columns, their types and the snapshot field they are taken from
+COLUMNS = {
+    "Step": (np.int32, None),
+    "AgentID": (np.int64, "unique_id"),
+    "Wealth": (np.float64, "wealth"),
+    "Investments": (np.float64, "investments"),
+    "Deductions": (np.float64, "deductions"),
+    "Bocche": (np.int32, "bocche"),
+    "Wealth_Class": (np.int8, "wealth_class"),
+}
+
+class AgentHistory:
+
+    # every:        only record every k-th step (the initial state is always recorded)
+    # panel:        only record a random panel of this many households, drawn from the initial population
+    # classes:      only record households in these wealth classes, e.g. (0, 5) for the bottom and top classes
+    # path:         directory to spill the columns to, they are then read back as memory-mapped arrays
+    # buffer_rows:  number of rows kept in memory before they are written to disk
+    def __init__(self, every=1, panel=None, classes=None, path=None, buffer_rows=1000000, seed=0):
+        self.every = every
+        self.panel = panel
+        self.panel_ids = None
+        self.classes = None if classes is None else np.asarray(classes)
+        self.path = path
+        self.buffer_rows = buffer_rows
+        self.rng = np.random.default_rng(seed)     # Separate from the model RNG, so sampling does not change the simulation
+        self.blocks = {name: [] for name in COLUMNS}
+        self.buffered = 0
+
+        if self.path is not None:                   # Start with empty column files
+            os.makedirs(self.path, exist_ok=True)
+            for name in COLUMNS:
+                open(self.column_file(name), "wb").close()
+            with open(os.path.join(self.path, "columns.json"), "w") as f:
+                json.dump({name: np.dtype(dtype).str for name, (dtype, _) in COLUMNS.items()}, f)
+
+    def column_file(self, name):
+        return os.path.join(self.path, f"{name}.bin")
+
+    # Appends the households of a snapshot (see model.household_snapshot) for this step
+    def record(self, step, snapshot):
+        if step % self.every != 0:
+            return
+        ids = snapshot["unique_id"]
+        if self.panel is not None and self.panel_ids is None:
+            self.panel_ids = np.sort(self.rng.choice(ids, size=min(self.panel, len(ids)), replace=False))
+        keep = np.ones(len(ids), dtype=bool)
+        if self.panel_ids is not None:
+            keep &= np.isin(ids, self.panel_ids)
+        if self.classes is not None:
+            keep &= np.isin(snapshot["wealth_class"], self.classes)
+
+        n = np.count_nonzero(keep)
+        for name, (dtype, field) in COLUMNS.items():
+            values = np.full(n, step) if field is None else snapshot[field][keep]
+            self.blocks[name].append(values.astype(dtype))
+        self.buffered += n
+        if self.path is not None and self.buffered >= self.buffer_rows:
+            self.flush()
+
+    # Writes the buffered blocks to the column files
+    def flush(self):
+        if self.path is None:
+            return
+        for name, blocks in self.blocks.items():
+            if blocks:
+                with open(self.column_file(name), "ab") as f:
+                    for block in blocks:
+                        f.write(block.tobytes())
+            self.blocks[name] = []
+        self.buffered = 0
+
+    # One column for all recorded steps, memory-mapped when spilled to disk
+    def column(self, name):
+        dtype = COLUMNS[name][0]
+        if self.path is None:
+            return np.concatenate(self.blocks[name]) if self.blocks[name] else np.empty(0, dtype=dtype)
+        self.flush()
+        if os.path.getsize(self.column_file(name)) == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(self.column_file(name), dtype=dtype, mode="r")
+
+    # Same layout as mesa.DataCollector.get_agent_vars_dataframe()
+    def to_dataframe(self):
+        return pd.DataFrame({name: self.column(name) for name in COLUMNS}).set_index(["Step", "AgentID"])
+
+
+# Reads a history that was spilled to disk, e.g. by a run that has already finished
+def read_agent_history(path):
+    with open(os.path.join(path, "columns.json")) as f:
+        dtypes = json.load(f)
+    columns = {}
+    for name, dtype in dtypes.items():
+        file = os.path.join(path, f"{name}.bin")
+        columns[name] = np.memmap(file, dtype=dtype, mode="r") if os.path.getsize(file) else np.empty(0, dtype=dtype)
+    n = min(len(column) for column in columns.values())    # A killed run may have written some columns further than others
+    return pd.DataFrame({name: column[:n] for name, column in columns.items()}).set_index(["Step", "AgentID"])
@@ -5,46 +5,211 @@
 # Fabian Lohmann, July 2025
 # FDLohmann@gmail.com
 
-import pandas as pd
+import math
+from operator import attrgetter
 import mesa
 import numpy as np
-from agent import household
+from agent import household, CLASS_THRESHOLDS, TRADES_PER_STRATEGY
+from sampling import FenwickTree, ClassIndex, LocalClassIndex
+from engine import GeneratorDraws, HouseholdArrays, StreamDraws, array_household, block_births, block_deaths, block_fsum, block_slices, draw_heirs, split_births, split_deaths
+from history import AgentHistory
+from profiling import PhaseProfiler
+from streams import RandomStreams
+from flows import TradeFlows
+from breakdown import Breakdown, BREAKDOWN_COLUMNS
+from grouping import GroupIndex, GROUPED_CLASSES, create_groups, grouped_rows
 
-# Load the dataframe
-df_1427 = pd.read_csv("data/Catasto_1427.csv")
+# Default values of the model parameters, override them per run with Florence(..., params={...})
+DEFAULT_PARAMS = {
+    "labor_productivity": 40,           # florins per person per year
+    "capital_return_rate": 0.06,        # 5-8% was typical for pre-industrial economies
+    "instability_decay_rate": 0.5,      # 50% instability decay per year
+    "split_coefficient": 0.00015,       # Household split probability is bocche^2 times this
+    "population_1427": 38269,           # Population at the start, the sum of all bocche in the 1427 Catasto
+    "instability_tax_unit": 1000000,    # Forced loans in florins that add instability_weight instability, scale with the population
+    "location_preference": 0.0,         # Share of trades that go to a partner in the trader's location, if the class has one there
+    "guild_preference": 0.0,            # Share of trades that go to a partner in the trader's guild
+    "tax_cap": 0.9,                     # Hard limit on the tax percentage
+    "plague_threshold": 20,             # Mortality per 1000 above which a year counts as an epidemic
+    "plague_multiplier": 1.5,           # Epidemics multiply the instability caused by forced loans
+    "instability_weight": 0.65,         # Instability per instability_tax_unit of forced loans
+    "birthrate": 0.05,                  # Average birthrate in Italy in the 15th century
+    "class_thresholds": CLASS_THRESHOLDS,           # Investments at which wealth classes 1-5 start
+    "trades_per_strategy": TRADES_PER_STRATEGY,     # Range of the number of trades per step for strategies 0-4
+}
 
-# Gini coefficient function
-def compute_gini(model):
-    wealths = [agent.wealth for agent in model.agents]
-    
-    if not wealths or len(wealths) == 0:
+# Default parameters with the given ones, raises ValueError for unknown or malformed parameters
+def model_params(params=None):
+    unknown = set(params or {}) - set(DEFAULT_PARAMS)
+    if unknown:
+        raise ValueError(f"Unknown model parameters: {', '.join(sorted(unknown))}.")
+    params = {**DEFAULT_PARAMS, **(params or {})}
+    params["class_thresholds"] = list(params["class_thresholds"])
+    params["trades_per_strategy"] = [(int(low), int(high)) for low, high in params["trades_per_strategy"]]
+    thresholds = params["class_thresholds"]
+    if len(thresholds) != 5 or any(a > b for a, b in zip(thresholds, thresholds[1:])):
+        raise ValueError("class_thresholds must be 5 increasing investment amounts.")
+    if len(params["trades_per_strategy"]) != 5 or any(not 1 <= low <= high for low, high in params["trades_per_strategy"]):
+        raise ValueError("trades_per_strategy must be 5 ranges (low, high) with 1 <= low <= high.")
+    return params
+
+# Parameter with the weight of each partner preference, by the household attribute it matches on
+PREFERENCES = {"location": "location_preference", "guild": "guild_preference"}
+
+# Household attributes in the snapshot and their types, the breakdown columns are added when the model keeps a breakdown
+SNAPSHOT_COLUMNS = {
+    "unique_id": np.int64,
+    "wealth": np.float64,
+    "investments": np.float64,
+    "deductions": np.float64,
+    "bocche": np.int64,
+    "wealth_class": np.int64,
+}
+
+# Household state pulled into arrays once per step, shared by all model reporters
+def household_snapshot(model):
+    columns = SNAPSHOT_COLUMNS if model.breakdown is None else {**SNAPSHOT_COLUMNS, **BREAKDOWN_COLUMNS}
+    names = tuple(columns)
+    if model.engine is not None:
+        rows = model.engine.rows()
+        return {name: getattr(model.engine, name)[rows] for name in names}
+    agents = model.agents if model.groups is None else model.agents_by_type.get(household, [])     # Group members are added below
+    values = np.array(list(map(attrgetter(*names), agents)), dtype=float).reshape(-1, len(names))
+    snapshot = {name: values[:, i] if dtype == np.float64 else values[:, i].astype(dtype) for i, (name, dtype) in enumerate(columns.items())}
+    if model.groups is not None:
+        members = model.groups.snapshot(names)
+        snapshot = {name: np.concatenate((snapshot[name], members[name].astype(snapshot[name].dtype))) for name in names}
+    return snapshot
+
+# Gini coefficient of wealths sorted in ascending order
+def gini_sorted(sorted_wealths):
+    n = len(sorted_wealths)
+    if n == 0:
         return 0
     
     # Handle negative wealth
-    wealths = [max(0, w) for w in wealths]
-    total_wealth = sum(wealths)
+    wealths = np.maximum(sorted_wealths, 0)         # Sorting order is unchanged by this
+    total_wealth = wealths.sum()
     
     if total_wealth == 0:
         return 0
     
-    # Sort wealths
-    sorted_wealths = sorted(wealths)
-    n = len(wealths)
-    
     # Gini formula
-    cumsum = 0
-    for i, wealth in enumerate(sorted_wealths):
-        cumsum += (i + 1) * wealth
+    cumsum = np.dot(np.arange(1, n + 1), wealths)
     
-    gini = (2 * cumsum) / (n * total_wealth) - (n + 1) / n
-    
-    return gini
+    return (2 * cumsum) / (n * total_wealth) - (n + 1) / n
+
+# Gini coefficient function
+def compute_gini(model):
+    return gini_sorted(np.sort(household_snapshot(model)["wealth"]))
+
+# Computes all model level statistics from one snapshot, with a single sort of the wealths
+def compute_statistics(model, snapshot=None):
+    if snapshot is None:
+        snapshot = household_snapshot(model)
+    if model.streams is not None:           # Summed per block like a sharded run, so the statistics do not depend on the engine
+        parts = [statistics_parts({name: values[part] for name, values in snapshot.items()}) for _, part in block_slices(snapshot["unique_id"])]
+        return combine_statistics(parts, model.instability)
+    return statistics_of(snapshot, model.instability)
+
+# Model level statistics of a snapshot of households
+def statistics_of(snapshot, instability):
+    return combine_statistics([statistics_parts(snapshot)], instability)
+
+# Sorted wealths and sums of a snapshot, the parts of several snapshots add up to the statistics of all of them
+def statistics_parts(snapshot):
+    wealths = np.sort(snapshot["wealth"])
+    investments = snapshot["investments"]
+    debt_ratios = np.divide(snapshot["deductions"], investments, out=np.zeros(len(wealths)), where=investments > 0)
+    return {
+        "wealths": wealths,
+        "population": snapshot["bocche"].sum(),
+        "total_wealth": wealths.sum(),
+        "positive_wealth": np.maximum(wealths, 0).sum(),      # Share of the positive wealth, as in the Gini, so the top 10% share stays within [0, 1]
+        "class_counts": np.bincount(snapshot["wealth_class"], minlength=6),
+        "debt_ratios": debt_ratios.sum(),
+    }
+
+# Model level statistics from the parts of the population, e.g. the blocks of a sharded run
+# Sums over the parts are exactly rounded, so they only depend on how the population is divided into parts.
+def combine_statistics(parts, instability):
+    if len(parts) == 1:
+        wealths = parts[0]["wealths"]
+    else:
+        wealths = np.sort(np.concatenate([part["wealths"] for part in parts]), kind="stable")     # Merges the sorted runs
+    n = len(wealths)
+    population = sum(part["population"] for part in parts)
+    total_wealth = math.fsum(part["total_wealth"] for part in parts)
+    positive_wealth = math.fsum(part["positive_wealth"] for part in parts)
+    class_counts = sum(part["class_counts"] for part in parts)
+    top_n = -(-n // 10)                             # Top 10% of households, rounded up
+    return {
+        "Gini": gini_sorted(wealths),
+        "Total_Households": n,
+        "Total_Population": population,
+        "Avg_Household_Size": population / n,
+        "Total_Wealth": total_wealth,
+        "Avg_Wealth": total_wealth / n,
+        "Median_Wealth": np.median(wealths),
+        "Poor_Households": class_counts[0],
+        "Lower_Mid_Households": class_counts[1],
+        "Upper_Mid_Households": class_counts[2],
+        "Wealthy_Households": class_counts[3],
+        "Affluent_Households": class_counts[4],
+        "Elite_Households": class_counts[5],
+        "Top_10_Percent_Wealth_Share": np.maximum(wealths[n - top_n:], 0).sum() / positive_wealth if positive_wealth > 0 else 0,
+        "Instability": instability,
+        "Avg_Debt_Ratio": math.fsum(part["debt_ratios"] for part in parts) / n,
+    }
+
+# Historical events at the start of a year, {year: [(message, model attribute, new value), ...]}
+# At the start of the simulation Florence is at war with Milan and Cosimo de' Medici has not yet come to power.
+HISTORICAL_EVENTS = {
+    1429: [("War with Milan ends.", "war", False)],
+    1430: [("War with Lucca begins.", "war", True)],
+    1434: [("War with Lucca ends.", "war", False), ("Cosimo de' Medici comes to power.", "Cosimo", True)],
+    1451: [("War with Venice and Aragon begins.", "war", True)],
+    1454: [("War with Venice and Aragon ends.", "war", False)],
+}
 
 # Create the Renaissance Florence model
 class Florence(mesa.Model):
 
-    def __init__(self, n, df_1427, forced_loans_dict, mortality_dict, seed):      # Seed makes the model reproducible by controlling RNG's
+    def __init__(self, n, df_1427, forced_loans_dict, mortality_dict, seed, engine="objects", agent_history=None, params=None, profile="off", group_size=None, grouped_classes=GROUPED_CLASSES, sink=None, quiet=False, streams=False, trade_flows=False, breakdown=False):      # Seed makes the model reproducible by controlling RNG's
         super().__init__(seed=seed)
+        self.params = model_params(params)
+        self.labor_productivity = self.params["labor_productivity"]
+        self.capital_return_rate = self.params["capital_return_rate"]
+        self.split_coefficient = self.params["split_coefficient"]
+        self.class_thresholds = self.params["class_thresholds"]
+        self.trades_per_strategy = self.params["trades_per_strategy"]
+        if engine not in ("objects", "arrays"):
+            raise ValueError(f"Unknown engine {engine!r}, use 'objects' or 'arrays'.")
+        # With the arrays engine all household state is kept in NumPy columns and updated in vectorized passes
+        self.engine = HouseholdArrays(max(len(df_1427) * n, 1), self.class_thresholds, self.trades_per_strategy) if engine == "arrays" else None
+        self.household_type = array_household if engine == "arrays" else household
+        # Mixed resolution: households of the grouped classes outside the Arti Maggiori are bundled into groups of group_size
+        if group_size is not None and engine == "arrays":
+            raise ValueError("Grouped households are only supported by the objects engine.")
+        self.groups = GroupIndex(6) if group_size is not None else None
+        # Counter-based random streams per year, phase and household, the results then do not depend on the engine
+        if streams and group_size is not None:
+            raise ValueError("Counter-based streams are not supported with grouped households.")
+        self.streams = RandomStreams(seed) if streams else None
+        # Florins traded between classes, guilds and locations per year, see model.trade_flows.report(year)
+        if trade_flows and group_size is not None:
+            raise ValueError("Trade flows are not recorded for grouped households.")
+        self.trade_flows = TradeFlows(int(df_1427["location"].max()) + 1) if trade_flows else None
+        # Statistics per guild, location and Arti Maggiori membership every step, see model.breakdown.to_dataframe("guild")
+        self.breakdown = Breakdown() if breakdown else None
+        # Partner preferences for the trader's own location and guild, None when all partners are picked citywide
+        weights = {key: self.params[name] for key, name in PREFERENCES.items()}
+        if min(weights.values()) < 0 or sum(weights.values()) > 1:
+            raise ValueError("Partner preferences must be at least 0 and add up to at most 1.")
+        self.preferences = weights if sum(weights.values()) > 0 else None
+        self.preference_total = sum(weights.values())
+        if self.preferences is not None and group_size is not None:
+            raise ValueError("Partner preferences are not supported with grouped households.")
         self.num_agents = len(df_1427)
         self.year = 1427                            # Starting year
         #self.year_abstract = 1427.0                # Starting year alternate representation by adding .25 to every season
@@ -55,54 +220,77 @@ class Florence(mesa.Model):
         self.mortality_dict = mortality_dict        # Dictionary with mortality rates in plague years
         self.instability = 0                        # Baseline instability is zero
         self.instability_input = 0
-        self.instability_decay_rate = 0.5           # 50% instability decay per year
+        self.instability_decay_rate = self.params["instability_decay_rate"]
         self.tax_total = 0                          # Initiate total tax variable
         self.taxable_total = 0
         self.tax_eligible_households = 0
         self.tax_percentage = 0.1525                # Literature value between 1428-1433
         self.plague = False
-        self.population = 38269                     # The sum of all bocche for all households
+        self.population_1427 = self.params["population_1427"]
+        self.instability_tax_unit = self.params["instability_tax_unit"]
+        self.tax_cap = self.params["tax_cap"]
+        self.plague_threshold = self.params["plague_threshold"]
+        self.plague_multiplier = self.params["plague_multiplier"]
+        self.instability_weight = self.params["instability_weight"]
+        self.birthrate = self.params["birthrate"]
+        self.population = self.population_1427      # The sum of all bocche for all households
         self.population_new = 0
         self.deaths = 0
+        self.births = 0
+        # Wall time per phase of the step, "summary" or "detailed" (adds memory per year), see model.profiler.to_dataframe()
+        self.profiler = PhaseProfiler(profile)
+        # Statistics and events are streamed to the sink (e.g. MetricsSink("run.jsonl")) after every step, quiet turns off printing
+        self.sink = sink
+        self.quiet = quiet
         
         self.datacollector = mesa.DataCollector(
-            model_reporters={
-                "Gini": compute_gini,
-                "Total_Households": lambda m: len(m.agents),
-                "Total_Population": lambda m: sum(a.bocche for a in m.agents),
-                "Avg_Household_Size": lambda m: np.mean([a.bocche for a in m.agents]),
-                "Total_Wealth": lambda m: sum(a.wealth for a in m.agents),
-                "Avg_Wealth": lambda m: np.mean([a.wealth for a in m.agents]),
-                "Median_Wealth": lambda m: np.median([a.wealth for a in m.agents]),
-                "Poor_Households": lambda m: len([a for a in m.agents if a.wealth_class == 0]),
-                "Lower_Mid_Households": lambda m: len([a for a in m.agents if a.wealth_class == 1]),
-                "Upper_Mid_Households": lambda m: len([a for a in m.agents if a.wealth_class == 2]),
-                "Wealthy_Households": lambda m: len([a for a in m.agents if a.wealth_class == 3]),
-                "Affluent_Households": lambda m: len([a for a in m.agents if a.wealth_class == 4]),
-                "Elite_Households": lambda m: len([a for a in m.agents if a.wealth_class == 5]),
-                "Top_10_Percent_Wealth_Share": lambda m: sum(sorted([a.wealth for a in m.agents])[-len(m.agents)//10:]) / sum(a.wealth for a in m.agents) if sum(a.wealth for a in m.agents) > 0 else 0,
-                "Instability": lambda m: m.instability,
-                "Avg_Debt_Ratio": lambda m: np.mean([a.deductions/a.investments if a.investments > 0 else 0 for a in m.agents])
-            },
-            agent_reporters={
-                "Wealth": "wealth",
-                "Investments": "investments",
-                "Deductions": "deductions",
-                "Bocche": "bocche",
-                "Wealth_Class": "wealth_class"
-            }
+            # Every reporter reads from the statistics computed once per step by collect_data
+            model_reporters={name: (lambda m, name=name: m.statistics[name]) for name in (
+                "Gini",
+                "Total_Households",
+                "Total_Population",
+                "Avg_Household_Size",
+                "Total_Wealth",
+                "Avg_Wealth",
+                "Median_Wealth",
+                "Poor_Households",
+                "Lower_Mid_Households",
+                "Upper_Mid_Households",
+                "Wealthy_Households",
+                "Affluent_Households",
+                "Elite_Households",
+                "Top_10_Percent_Wealth_Share",
+                "Instability",
+                "Avg_Debt_Ratio",
+            )},
         )
+        # Household level history (Wealth, Investments, Deductions, Bocche, Wealth_Class) is kept in columns.
+        # Pass e.g. AgentHistory(every=5, panel=500, path="history") to sample it or spill it to disk, or False to skip it.
+        self.agent_history = agent_history if agent_history is not None else AgentHistory()
         
-        # Create agents
-        for i, row in df_1427.iterrows():        # Arti Maggiori agents
-            household.create_agents(
-                model=self, 
-                n=n,
-                investments = row["total"],
-                deductions = row["deductions"],
-                trade = row["trade_last2"],
-                bocche = row["bocche"],
-                )
+        self.classified_agents = self.class_index()   # Households per wealth class, kept up to date by the households
+        self.splits = {}                              # Parent -> household that split off it this year, created by create_splits
+        
+        # Create agents, n households for every row of the Catasto
+        with self.profiler.phase("setup", self.year):
+            individuals = df_1427
+            if group_size is not None:
+                grouped = grouped_rows(df_1427, grouped_classes, self.class_thresholds)
+                individuals = df_1427[~grouped]
+                create_groups(self, *(np.repeat(df_1427[name].to_numpy()[grouped], n) for name in ("total", "deductions", "trade_last2", "bocche", "location")), group_size)
+            if self.engine is not None:             # All columns are written at once, see array_household.create_households
+                array_household.create_households(self, *(np.repeat(individuals[name].to_numpy(), n) for name in ("total", "deductions", "trade_last2", "bocche", "location")))
+            else:
+                for investments, deductions, trade, bocche, location in zip(individuals["total"], individuals["deductions"], individuals["trade_last2"], individuals["bocche"], individuals["location"]):
+                    for _ in range(n):
+                        self.household_type(
+                            self,
+                            investments = investments,
+                            deductions = deductions,
+                            trade = trade,
+                            bocche = bocche,
+                            location = int(location),
+                            )
 
         ### Potential city government agent ###            
         # city_government.create_agents(
@@ -111,19 +299,19 @@ class Florence(mesa.Model):
         #     treasury = -682000,             # The amount of money the city starts with
         # )
 
-        self.classified_agents = {i: [] for i in range(6)}      # This will create a list for each wealth class
-
-        print(f"Simulation started.")
-        print(f"There are {str(self.num_agents)} households.")
+        if not self.quiet:
+            print(f"Simulation started.")
+            print(f"There are {str(self.num_agents)} households.")
         
-        self.datacollector.collect(self)    # Collect data initial circumstances
+        self.collect_data()                 # Collect data initial circumstances
 
     def step(self):         # Advance the model by one step
         
         # Advance the calendar
         self.year += 1
-        print(f"\nYear {str(self.year)}.")
-        print(f"Population: {str(self.population)}.")        
+        if not self.quiet:
+            print(f"\nYear {str(self.year)}.")
+            print(f"Population: {str(self.population)}.")        
 
         ### Alternative for using quarters as timestep: ###
         # self.quarter += 1       
@@ -134,94 +322,294 @@ class Florence(mesa.Model):
         # print(f"Year {str(self.year)}, quarter {str(self.quarter)}.")
 
         # Historical events
-        if self.year == 1429:
-            print("War with Milan ends.")
-            self.war = False
-        if self.year == 1430:
-            print("War with Lucca begins.")
-            self.war = True
-        if self.year == 1434:
-            print("War with Lucca ends.")
-            self.war = False
-            print("Cosimo de' Medici comes to power.")
-            self.Cosimo = True
-        if self.year == 1451:
-            print("War with Venice and Aragon begins.")  
-            self.war = True
-        if self.year == 1454:
-            print("War with Venice and Aragon ends.")
-            self.war = False
+        for message, attribute, value in HISTORICAL_EVENTS.get(self.year, ()):
+            self.log(message)
+            setattr(self, attribute, value)
 
         # Calculate tax percentage by dividing the required tax amount by taxable amount 
-        self.tax_total = self.forced_loans_dict[self.year]   # Total forced loans that year, includes taxes
-        self.agents.do("calculate_taxable")
-        self.taxable_total = sum(agent.taxable for agent in self.agents)
-        self.tax_eligible_households = sum(1 for agent in self.agents if agent.taxable > 0)
-        self.tax_percentage = self.tax_total / self.taxable_total
-        if self.tax_percentage > 0.9:                   # Hard limit of 90%
-            self.tax_percentage = 0.9
+        with self.profiler.phase("tax", self.year):
+            self.tax_total = self.forced_loans_dict[self.year]   # Total forced loans that year, includes taxes
+            if self.engine is not None:
+                self.engine.calculate_taxable()
+                rows = self.engine.rows()
+                taxable = self.engine.taxable[rows]
+                self.taxable_total = block_fsum(self.engine.unique_id[rows], taxable) if self.streams is not None else taxable.sum()
+                self.tax_eligible_households = np.count_nonzero(taxable > 0)
+            else:
+                self.agents.do("calculate_taxable")
+                if self.streams is not None:            # Exactly rounded per block, so the total does not depend on the order or the engine
+                    self.taxable_total = block_fsum(np.array([agent.unique_id for agent in self.agents]), np.array([agent.taxable for agent in self.agents]))
+                else:
+                    self.taxable_total = sum(agent.taxable for agent in self.agents)
+                self.tax_eligible_households = sum(1 for agent in self.agents if agent.taxable > 0)
+                if self.groups is not None:             # Every member of a group with taxable income counts
+                    self.tax_eligible_households += sum(group.taxable_members - (group.taxable > 0) for group in self.groups.groups)
+            self.tax_percentage = self.tax_total / self.taxable_total
+            if self.tax_percentage > self.tax_cap:          # Hard limit, 90% by default
+                self.tax_percentage = self.tax_cap
 
         # Calculate the instability as a function of total taxes and whether there is a plague
-        if self.year in self.mortality_dict and self.mortality_dict[self.year] > 20:
-                self.plague = True
-                print("An epidemic has struck the city.")
-                self.instability_input = (self.tax_total / 1000000 * 1.5) * 0.65
-        else:
-            self.plague = False
-            self.instability_input = (self.tax_total / 1000000) * 0.65
-        self.instability = (self.instability * self.instability_decay_rate) + self.instability_input
-        if self.instability > 1:
-            self.instability = 1
+        with self.profiler.phase("instability", self.year):
+            if self.year in self.mortality_dict and self.mortality_dict[self.year] > self.plague_threshold:
+                    self.plague = True
+                    self.log("An epidemic has struck the city.")
+                    self.instability_input = (self.tax_total / self.instability_tax_unit * self.plague_multiplier) * self.instability_weight
+            else:
+                self.plague = False
+                self.instability_input = (self.tax_total / self.instability_tax_unit) * self.instability_weight
+            self.instability = (self.instability * self.instability_decay_rate) + self.instability_input
+            if self.instability > 1:
+                self.instability = 1
 
         # Deaths are modeled with a simple decay function based on the known populations in 1427 and 1458.
-        self.population_new = 38269 * np.exp(-0.0058084 * (self.year - 1427))
-        self.births = round(self.population*.05)    # Average birthrate in Italy in the 15th century.
+        self.population_new = self.population_1427 * np.exp(-0.0058084 * (self.year - 1427))
+        self.births = round(self.population*self.birthrate)    # Average birthrate in Italy in the 15th century by default.
         self.deaths = round(self.population + self.births - self.population_new)
         self.population = round(self.population_new)
         
         # Distribute deaths randomly
-        for _ in range(self.deaths):
-            #household = self.random.choice(list(self.agents))
-            household = self.random.choices(
-                self.agents, 
-                weights=[agent.bocche for agent in self.agents]
-            )[0]
-            household.bocche -= 1
-            if household.bocche <= 0:                           # Household dies if members reach 0
-                heirs_n = self.random.randint(1, 5)             # Between 1 and 5 random heirs
-                heirs = []
-                for _ in range(heirs_n):
-                    heirs.append(self.random.choice(self.agents))
-                if household.wealth >= 0:                       # Distribute remaining wealth randomly
-                    for heir in heirs:
-                        heir.investments += household.investments / heirs_n
-                        heir.deductions += household.deductions / heirs_n
-                else:                                           # Heir is a creditor in this case
-                    for heir in heirs:                    
-                        heir.investments += household.investments / heirs_n  
-                self.agents.remove(household)
+        # Households are drawn proportional to their bocche from a Fenwick tree that is updated in place.
+        # This gives the same draws as random.choices over the full weight list, without rebuilding it every death.
+        # With counter-based streams and in the arrays engine the deaths and births are drawn per block of households, see deaths_in_blocks.
+        with self.profiler.phase("deaths", self.year):
+            if self.streams is not None or self.engine is not None:
+                survivors = self.deaths_in_blocks()
+            else:
+                households = list(self.agents)
+                bocche_tree = FenwickTree([agent.bocche for agent in households])
+                alive_tree = FenwickTree([agent.members for agent in households])     # Counts the living households, used to pick heirs
+                died_out = []
+                for _ in range(self.deaths):
+                    i = bocche_tree.sample(self.random)
+                    household = households[i]
+                    estate = household.death()                          # A grouped household loses a person of one of its members
+                    bocche_tree.add(i, -1)
+                    if estate is not None:                              # Household dies if members reach 0
+                        investments, deductions, wealth = estate
+                        heirs_n = self.random.randint(1, 5)             # Between 1 and 5 random heirs
+                        heirs = []
+                        for _ in range(heirs_n):                        # Same draw as self.random.choice(self.agents)
+                            heirs.append(households[alive_tree.find(self.random.randrange(alive_tree.total))])
+                        if wealth >= 0:                                 # Distribute remaining wealth randomly
+                            for heir in heirs:
+                                heir.inherit(investments / heirs_n, deductions / heirs_n)
+                        else:                                           # Heir is a creditor in this case
+                            for heir in heirs:
+                                heir.inherit(investments / heirs_n, 0)
+                        if household.bocche <= 0:                       # A group is removed once all its members died
+                            died_out.append(household)
+                        alive_tree.add(i, -1)
+                # Households that died out are removed once all deaths are drawn, the trees already give them no deaths,
+                # births or inheritance. Inheritance is not deferred: a heir who dies later in the year passes it on.
+                self.remove_households(died_out)
 
         # Distribute births randomly
-        for _ in range(self.births):
-            #household = self.random.choice(list(self.agents))
-            household = self.random.choices(
-                self.agents, 
-                weights=[agent.bocche for agent in self.agents]
-            )[0]            
-            household.bocche += 1        
-
-        # Fill the wealth class sorted list
-        for agent in self.agents:
-            self.classified_agents[agent.wealth_class].append(agent) 
+        with self.profiler.phase("births", self.year):
+            if self.streams is not None or self.engine is not None:
+                self.births_in_blocks(*survivors)
+            else:
+                for _ in range(self.births):
+                    i = bocche_tree.sample(self.random)
+                    households[i].birth()
+                    bocche_tree.add(i, 1)
 
         # Agent actions
         #print("Households are producing goods, trading, paying taxes...")
-        self.agents.shuffle_do("trading_phase")         # Every agent produces value and randomly trades with other agents
-        self.agents.do("recalculation_phase")           # Every agent manages their wealth and is taxed
+        with self.profiler.phase("trading", self.year):
+            if self.streams is not None:
+                self.trade_with_streams()
+            elif self.engine is not None:               # All households produce and trade in one vectorized pass
+                self.engine.trading_phase(self.rng, self.instability, self.labor_productivity, self.capital_return_rate, self.trade_flows, self.preferences)
+            else:
+                self.agents.shuffle_do("trading_phase") # Every agent produces value and randomly trades with other agents
+                if self.groups is not None:
+                    self.groups.settle()                # Trades to group members are added to their deductions
+            if self.trade_flows is not None:
+                self.trade_flows.settle(self.year)
+        with self.profiler.phase("recalculation", self.year):
+            if self.engine is not None:                 # All households pay debts and taxes and split in one vectorized pass
+                self.recalculate_arrays()
+            else:
+                self.agents.do("recalculation_phase")   # Every agent manages their wealth and is taxed
+                self.create_splits()                    # Households that split off join once all households recalculated
+        if self.engine is not None:
+            with self.profiler.phase("class_index", self.year):
+                self.engine.update_wealth(self.classified_agents)   # Wealth and wealth classes of all households in one pass
         #self.agents.do("population_changes")            # Households die and split
         
         self.num_agents = len(self.agents)
-        print(f"This year {str(self.deaths)} people have died. There are now {str(self.num_agents)} households.")
+        if self.groups is not None:                     # Count the households in groups, not the groups
+            self.num_agents += self.groups.members_total() - len(self.groups.groups)
+        self.log(f"This year {str(self.deaths)} people have died. There are now {str(self.num_agents)} households.")
         
         # Collect data
-        self.datacollector.collect(self)       
+        self.collect_data()
+
+    # Random numbers for the population draws: the streams of the whole city (block None) or of one block,
+    # the model's generator when the arrays engine draws without streams
+    def population_random(self, phase, block=None):
+        if self.streams is None:
+            return self.rng
+        return self.streams.generator(self.year, phase, 0 if block is None else block + 1)
+
+    # Blocks of the living households for the population draws, all households are one block without streams
+    def population_blocks(self, unique_id):
+        if self.streams is None:
+            return [(0, slice(0, len(unique_id)))]
+        return block_slices(unique_id)
+
+    # Deaths and inheritance drawn per block of households, like ShardedFlorence.population_phase: the year's deaths
+    # are split over the blocks, then the deceased of every block are drawn. Heirs are picked among the households
+    # alive after the deaths. Used with streams and by the arrays engine.
+    # Returns the survivors in order of unique_id (households, or rows of the arrays engine) with their unique_ids and bocche.
+    def deaths_in_blocks(self):
+        households, unique_id, bocche = self.households_by_id()
+        blocks = self.population_blocks(unique_id)
+        random = self.population_random("deaths")
+        counts = split_deaths(random, np.array([bocche[part].sum() for _, part in blocks], dtype=np.int64), self.deaths)
+        died = np.zeros(len(bocche), dtype=np.int64)
+        for (block, part), count in zip(blocks, counts):
+            died[part] = block_deaths(self.population_random("deaths", block), bocche[part], count)
+        bocche -= died
+        died_out = (died > 0) & (bocche <= 0)
+
+        if self.engine is not None:
+            engine = self.engine
+            engine.bocche[households] = bocche
+            estates = households[died_out]
+            investments, deductions, wealth = engine.investments[estates], engine.deductions[estates], engine.wealth[estates]
+            self.remove_households([engine.agents[row] for row in estates.tolist()])
+            survivors = households[~died_out]
+            heirs, shares, debts = draw_heirs(random, investments, deductions, wealth, len(survivors))
+            np.add.at(engine.investments, survivors[heirs], shares)
+            np.add.at(engine.deductions, survivors[heirs], debts)
+        else:
+            for agent, members in zip(households, bocche.tolist()):
+                agent.bocche = members
+            estates = [households[i] for i in np.flatnonzero(died_out)]
+            investments, deductions, wealth = (np.array([getattr(agent, name) for agent in estates], dtype=float) for name in ("investments", "deductions", "wealth"))
+            self.remove_households(estates)
+            survivors = [agent for agent, dead in zip(households, died_out.tolist()) if not dead]
+            heirs, shares, debts = draw_heirs(random, investments, deductions, wealth, len(survivors))
+            for heir, share, debt in zip(heirs.tolist(), shares.tolist(), debts.tolist()):    # In order of the estates, like np.add.at
+                survivors[heir].inherit(share, debt)
+        return survivors, unique_id[~died_out], bocche[~died_out]
+
+    # Births drawn per block of households: split over the blocks, then drawn among the households of every block
+    def births_in_blocks(self, households, unique_id, bocche):
+        blocks = self.population_blocks(unique_id)
+        counts = split_births(self.population_random("births"), np.array([bocche[part].sum() for _, part in blocks], dtype=np.int64), self.births)
+        for (block, part), count in zip(blocks, counts):
+            parents = np.flatnonzero(bocche[part] > 0) + part.start
+            born = block_births(self.population_random("births", block), bocche[parents], count)
+            if self.engine is not None:
+                self.engine.bocche[households[parents]] += born.astype(self.engine.bocche.dtype)
+            else:
+                for i, n in zip(parents.tolist(), born.tolist()):
+                    if n:
+                        households[i].bocche += n
+
+    # Creates the households that split off this year and updates the class index. In the order the households
+    # recalculated, the household that split off a parent is created and joins its class, then the parent moves to
+    # its new class: the index then holds the households in the same order as when they split off during the phase.
+    def create_splits(self):
+        splits, index = self.splits, self.classified_agents
+        for agent in list(self.agents_by_type.get(self.household_type, ())):    # Groups are not in the class index
+            split = splits.get(agent)
+            if split is not None:
+                investments, deductions, bocche, trade_strategy = split
+                self.household_type(self, investments, deductions, agent.trade, bocche, agent.location, trade_strategy)
+            index.move(agent, agent.wealth_class)
+        self.splits = {}
+
+    # Removes households that died out from the model and the class index. Mesa deregisters agents one by one.
+    def remove_households(self, households):
+        for household in households:
+            household.remove()
+
+    # Living households in order of unique_id with their unique_ids and bocche as columns, rows for the arrays engine
+    def households_by_id(self):
+        if self.engine is not None:
+            rows = self.engine.rows()                   # Rows are in order of creation, so of unique_id
+            return rows, self.engine.unique_id[rows], self.engine.bocche[rows].astype(np.int64)
+        households = sorted(self.agents, key=lambda agent: agent.unique_id)
+        return households, np.array([agent.unique_id for agent in households], dtype=np.int64), np.array([agent.bocche for agent in households], dtype=np.int64)
+
+    # Debts, taxes and splits of the arrays engine in one vectorized pass, with the households' recalculation streams
+    # or the model's generator. The households that split off are created in the order of their parents.
+    def recalculate_arrays(self):
+        engine = self.engine
+        rows = engine.rows()
+        draws = GeneratorDraws(self.rng) if self.streams is None else StreamDraws(self.streams, self.streams.keys(self.year, "recalculation", engine.unique_id[rows]))
+        parents, bocche, investments, deductions = engine.recalculation_phase(draws, self.tax_percentage, self.split_coefficient, rows)
+        array_household.create_households(self, investments, deductions, [engine.agents[row].trade for row in parents.tolist()], bocche, engine.location[parents])
+
+    # Trading with counter-based streams, the households settle the trades they received once all have traded
+    def trade_with_streams(self):
+        if self.engine is not None:
+            self.engine.trading_phase_streams(self.streams, self.year, self.instability, self.labor_productivity, self.capital_return_rate, self.trade_flows, self.preferences)
+            return
+        by_id = lambda agent: agent.unique_id
+        self.trading_pools = [sorted(members, key=by_id) for members in self.classified_agents.members]
+        if self.preferences is not None:
+            self.local_pools = {key: {pool: sorted(members, key=by_id) for pool, members in local.items()} for key, local in self.classified_agents.local.items()}
+        for agent in self.agents:
+            agent.received_trades = 0
+        self.agents.do("trading_phase")
+        for agent in self.agents:
+            agent.deductions += agent.received_trades
+
+    # Prints a yearly event and passes it to the sink
+    def log(self, message):
+        if self.sink is not None:
+            self.sink.event(self.year, message)
+        if not self.quiet:
+            print(message)
+
+    # Index of the households per wealth class, also per location and guild when partners are picked locally
+    # The arrays engine picks local partners from its columns and only needs the class index.
+    def class_index(self):
+        if self.preferences is not None and self.engine is None:
+            return LocalClassIndex(6, tuple(self.preferences))
+        return ClassIndex(6)
+
+    # Partner in the trader's location or guild when the mode draw falls in the band of that preference,
+    # pools are {key: {(class, value): households}}. None if the trade goes to a partner anywhere in the city.
+    def local_partner(self, household, wealth_class, mode, pick, pools):
+        low = 0
+        for key, weight in self.preferences.items():
+            if low <= mode < low + weight:
+                members = pools[key].get((wealth_class, getattr(household, key)))
+                return members[int(pick * len(members))] if members else None
+            low += weight
+        return None
+
+    # Random trading partner in a wealth class, each member of a grouped household counts as a household
+    def trading_partner(self, wealth_class, household=None):
+        if self.preferences is not None:
+            mode = self.random.random()
+            if mode < self.preference_total:            # The pick is only drawn for trades that may stay local
+                partner = self.local_partner(household, wealth_class, mode, self.random.random(), self.classified_agents.local)
+                if partner is not None:
+                    return partner
+        members = self.classified_agents[wealth_class]
+        if self.groups is None:
+            return self.random.choice(members) if members else None
+        pool = len(members) + self.groups.members_in(wealth_class)
+        if pool == 0:
+            return None
+        pick = self.random.randrange(pool)
+        return members[pick] if pick < len(members) else self.groups.member(wealth_class, pick - len(members))
+
+    # Computes this step's statistics in one pass over the households and hands them to the data collector
+    def collect_data(self):
+        with self.profiler.phase("collect", self.year):
+            snapshot = household_snapshot(self)
+            self.statistics = compute_statistics(self, snapshot)
+            self.datacollector.collect(self)
+            if self.agent_history:
+                self.agent_history.record(self.steps, snapshot)
+            if self.breakdown is not None:
+                self.breakdown.record(self.steps, self.year, snapshot, self.tax_percentage)
+            if self.sink is not None:
+                self.sink.metrics(self.steps, self.year, {**self.statistics, "Deaths": self.deaths, "Births": self.births, "Tax_Percentage": self.tax_percentage})       
@@ -0,0 +1,117 @@
+# Phase profiler for agent-based Renaissance Florence simulation.
+# Records the wall time and number of calls of every phase of Florence.step, and in detailed mode
+# also the memory allocated per phase and year (with tracemalloc, which slows the run down).
+
+import contextlib
+import gc
+import itertools
+import sys
+import time
+import tracemalloc
+import pandas as pd
+
+MODES = ("off", "summary", "detailed")
+
+class PhaseProfiler:
+
+    # off:      no measurements, phases cost one no-op context manager
+    # summary:  wall time and calls per phase, summed over the run
+    # detailed: wall time, calls, allocated and peak memory per phase and year
+    def __init__(self, mode="off"):
+        if mode not in MODES:
+            raise ValueError(f"Unknown profiling mode {mode!r}, use one of {', '.join(MODES)}.")
+        self.mode = mode
+        self.totals = {}            # Phase -> [seconds, calls]
+        self.records = []           # One row per phase and year in detailed mode
+        self.off = contextlib.nullcontext()
+        self.started_tracing = False   # Only stop tracemalloc in close() if this profiler started it
+        if mode == "detailed" and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+
+    # Stops memory tracing when profiling ends, tracing started by someone else keeps running
+    def close(self):
+        if self.started_tracing:
+            self.started_tracing = False
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    # Context manager that measures one phase, e.g. with profiler.phase("trading", model.year):
+    def phase(self, name, year):
+        if self.mode == "off":
+            return self.off
+        return self.measure(name, year)
+
+    @contextlib.contextmanager
+    def measure(self, name, year):
+        if self.mode == "detailed":
+            tracemalloc.reset_peak()
+            memory_start = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            total = self.totals.setdefault(name, [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+            if self.mode == "detailed":
+                memory, peak = tracemalloc.get_traced_memory()
+                self.records.append({
+                    "Year": year,
+                    "Phase": name,
+                    "Seconds": seconds,
+                    "Calls": 1,
+                    "Allocated_Bytes": memory - memory_start,
+                    "Peak_Bytes": peak - memory_start,
+                })
+
+    # Per phase totals in summary mode, per phase and year in detailed mode
+    def to_dataframe(self):
+        if self.mode == "detailed":
+            return pd.DataFrame(self.records, columns=["Year", "Phase", "Seconds", "Calls", "Allocated_Bytes", "Peak_Bytes"])
+        summary = pd.DataFrame(
+            [(name, seconds, calls) for name, (seconds, calls) in self.totals.items()],
+            columns=["Phase", "Seconds", "Calls"],
+        ).set_index("Phase")
+        summary["Seconds_Per_Call"] = summary["Seconds"] / summary["Calls"]
+        summary["Share"] = summary["Seconds"] / summary["Seconds"].sum()
+        return summary
+
+# Bytes of a value that belongs to one household alone, small ints are shared by all of Python
+def owned_bytes(value):
+    if isinstance(value, float) or (isinstance(value, int) and not -5 <= value <= 256):
+        return sys.getsizeof(value)
+    return 0
+
+# Memory per household: the agent object, its attribute dict, slots and the numbers it owns, plus its share
+# of the household columns with the arrays engine. Averaged over the first sample households.
+# The values are read with gc.get_referents, which does not create the attribute dict of agents that have none.
+# Mesa's own bookkeeping per agent (the model's agent sets) is not included.
+def bytes_per_household(model, sample=1000):
+    agents = list(itertools.islice(model.agents, sample))
+    total = 0
+    for agent in agents:
+        total += sys.getsizeof(agent)
+        values = []
+        for value in gc.get_referents(agent):
+            if isinstance(value, dict):                 # An attribute dict that exists already
+                total += sys.getsizeof(value)
+                values.extend(value.values())
+            elif value is not type(agent):
+                values.append(value)
+        total += sum(owned_bytes(value) for value in values)
+    per_agent = total / max(len(agents), 1)
+    engine = getattr(model, "engine", None)
+    if engine is not None:
+        per_agent += sum(column.nbytes for column in vars(engine).values() if hasattr(column, "nbytes")) / max(len(model.agents), 1)
+    return per_agent
@@ -0,0 +1,202 @@
+# Report generation for agent-based Renaissance Florence simulation.
+# Renders the Gini, average wealth and 1427/1457 wealth class figures from saved model level results,
+# without re-running the model: a results CSV of one run (run.py), a metrics file (sink.py), an ensemble
+# summary with quantile bands or a file with every run of an ensemble (ensemble.py), one report per seed.
+# Figures render in parallel with the Agg backend, so no display is needed, and a figure is only rendered
+# again when the data it is drawn from has changed.
+#
+# Usage: python report.py results.csv ensemble.csv --out reports --workers 8
+
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+matplotlib.use("Agg")           # Render to files only, before pyplot is imported
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from sink import read_metrics
+
+CLASS_SERIES = [
+    "Poor_Households",
+    "Lower_Mid_Households",
+    "Upper_Mid_Households",
+    "Wealthy_Households",
+    "Affluent_Households",
+    "Elite_Households",
+]
+
+WEALTH_CLASSES = ['Poor\n(0–29)', 'Lower Middle\n(29–210)', 'Upper Middle\n(210–893)',
+                  'Wealthy\n(893–2,634)', 'Affluent\n(2,634–14,299)', 'Elite\n(14,299+)']
+
+# Wars (shaded regions) and epidemics (dashed lines) marked in the average wealth figure
+WAR_PERIODS = [(1424, 1428), (1429, 1433), (1451, 1454)]
+EPIDEMIC_YEARS = [1430, 1434, 1437, 1438, 1449, 1450, 1457]
+
+# Figure files and the series each one is drawn from
+FIGURES = {
+    "Gini.png": ["Gini"],
+    "avg_wealth.png": ["Avg_Wealth"],
+    "bars.png": CLASS_SERIES,
+}
+
+MANIFEST = "report.json"        # Hash of the data of every rendered figure
+
+# Model level results in a file, as {name: DataFrame indexed by Year}
+# Ensemble summaries have (series, statistic) columns, e.g. ("Gini", "mean") and ("Gini", "q05").
+def read_results(path):
+    name = os.path.splitext(os.path.basename(path))[0]
+    if path.endswith(".jsonl"):
+        return {name: read_metrics(path, extra=True).set_index("Year")}
+    with open(path) as f:
+        header = [f.readline(), f.readline()]
+    if ",mean" in header[1]:
+        return {name: pd.read_csv(path, header=[0, 1], index_col=0)}
+    df = pd.read_csv(path)
+    if "Seed" in df.columns:
+        return {f"{name}_seed{seed}": runs.drop(columns="Seed").set_index("Year") for seed, runs in df.groupby("Seed")}
+    return {name: df.set_index("Year")}
+
+# Mean of a series and its 5-95% band, the band is None for single runs
+def series_of(data, name):
+    if isinstance(data.columns, pd.MultiIndex):
+        band = (data[(name, "q05")], data[(name, "q95")]) if (name, "q05") in data.columns else None
+        return data[(name, "mean")], band
+    return data[name], None
+
+# Hash of the data one figure is drawn from
+def figure_key(figure, data, historical_counts):
+    columns = [column for column in data.columns if (column[0] if isinstance(column, tuple) else column) in FIGURES[figure]]
+    digest = hashlib.sha1(figure.encode())
+    digest.update(pd.util.hash_pandas_object(data[columns]).to_numpy().tobytes())
+    if figure == "bars.png":
+        digest.update(np.asarray(historical_counts, dtype=np.int64).tobytes())
+    return digest.hexdigest()
+
+def plot_gini(data, path, historical_counts=None):
+    gini, band = series_of(data, "Gini")
+    plt.figure(figsize=(8, 3.8))
+    plt.plot(data.index, gini, color='#1f77b4', marker='o')
+    if band is not None:
+        plt.fill_between(data.index, *band, color='#1f77b4', alpha=0.2, linewidth=0)
+    plt.xlabel('Year')
+    plt.ylabel('Gini Coefficient')
+    plt.grid(True)
+    plt.tight_layout()
+    plt.savefig(path, dpi=300)
+    plt.close()
+
+def plot_avg_wealth(data, path, historical_counts=None):
+    avg_wealth, band = series_of(data, "Avg_Wealth")
+    plt.figure(figsize=(8, 3.8))
+    plt.plot(data.index, avg_wealth, marker='o', color='#1f77b4', label='Average wealth')
+    if band is not None:
+        plt.fill_between(data.index, *band, color='#1f77b4', alpha=0.2, linewidth=0, label='5-95% of runs')
+
+    for start, end in WAR_PERIODS:
+        plt.axvspan(start, end, color='gray', alpha=0.2, label='War' if start == WAR_PERIODS[0][0] else None)
+    for year in EPIDEMIC_YEARS:
+        plt.axvline(year, color='#1f77b4', linestyle='--', alpha=0.6, label='Epidemic' if year == EPIDEMIC_YEARS[0] else None)
+
+    plt.xlabel('Year')
+    plt.ylabel('Average household wealth (Florins)')
+    plt.grid(True)
+    plt.legend(loc='lower left', frameon=True, facecolor='white', framealpha=0.9, fancybox=True)
+    plt.tight_layout()
+    plt.savefig(path, dpi=300)
+    plt.close()
+
+# Households per wealth class in the first year, the 1457 Catasto and the last year
+def plot_bars(data, path, historical_counts):
+    counts = [series_of(data, name)[0] for name in CLASS_SERIES]
+    initial_counts = [series.iloc[0] for series in counts]
+    final_counts = [series.iloc[-1] for series in counts]
+
+    x = np.arange(len(WEALTH_CLASSES))
+    width = 0.2
+    fig, ax = plt.subplots(figsize=(8, 3))
+    bars1 = ax.bar(x - 1.5*width, initial_counts, width, label=str(data.index[0]), color='#1f77b4', alpha=0.8)
+    bars2 = ax.bar(x - 0.5*width, historical_counts, width, label='1457 Historical', color="#165581", alpha=0.8)
+    bars3 = ax.bar(x + 0.5*width, final_counts, width, label=f'{data.index[-1]} Simulated', color="#0f3957", alpha=0.8)
+
+    ax.set_xlabel('Wealth Class (Florins)', fontsize=12)
+    ax.set_ylabel('Number of Households', fontsize=12)
+    ax.set_xticks(x)
+    ax.set_xticklabels(WEALTH_CLASSES, fontsize=10)
+    ax.legend(fontsize=8)
+
+    # Add value labels
+    for bars in [bars1, bars2, bars3]:
+        for bar in bars:
+            height = bar.get_height()
+            ax.text(bar.get_x() + bar.get_width()/2., height + 50, f'{int(height):,}', ha='center', va='bottom', fontsize=6)
+
+    max_height = max(max(initial_counts), max(historical_counts), max(final_counts))
+    ax.set_ylim(top=max_height * 1.1)
+    ax.set_yticks(np.arange(0, max_height * 1, 1000))
+    plt.tight_layout()
+    plt.savefig(path, dpi=300)
+    plt.close(fig)
+
+PLOTS = {"Gini.png": plot_gini, "avg_wealth.png": plot_avg_wealth, "bars.png": plot_bars}
+
+def render(figure, data, path, historical_counts):
+    PLOTS[figure](data, path, historical_counts)
+    return path
+
+# Renders the figures of every result in the files, a single result goes into out_dir, several into out_dir/<name>
+# Figures whose data has the same hash as in the manifest of their directory are skipped unless force is set.
+# historical_counts: households per wealth class in the 1457 Catasto, loaded from data/ if not given
+def generate_reports(paths, out_dir=".", workers=None, force=False, historical_counts=None):
+    if historical_counts is None:
+        from calibrate import load_targets
+        historical_counts = load_targets()["class_counts"].tolist()
+    results = {}
+    for path in paths:
+        results.update(read_results(path))
+
+    tasks = []
+    manifests = {}
+    for name, data in results.items():
+        directory = out_dir if len(results) == 1 else os.path.join(out_dir, name)
+        os.makedirs(directory, exist_ok=True)
+        manifest_path = os.path.join(directory, MANIFEST)
+        if directory not in manifests:
+            manifests[directory] = {}
+            if os.path.exists(manifest_path):
+                with open(manifest_path) as f:
+                    manifests[directory] = json.load(f)
+        for figure in FIGURES:
+            path = os.path.join(directory, figure)
+            key = figure_key(figure, data, historical_counts)
+            if not force and os.path.exists(path) and manifests[directory].get(figure) == key:
+                continue
+            tasks.append((directory, figure, key, (figure, data, path, historical_counts)))
+
+    if workers == 1 or len(tasks) <= 1:       # Render in this process
+        rendered = [render(*arguments) for *_, arguments in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            rendered = list(executor.map(render, *zip(*(arguments for *_, arguments in tasks))))
+
+    # Hashes are stored once the figures exist, so an interrupted run renders the missing ones again
+    for directory, figure, key, _ in tasks:
+        manifests[directory][figure] = key
+    for directory, manifest in manifests.items():
+        with open(os.path.join(directory, MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+    return rendered
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render figures from saved Florence model results.")
+    parser.add_argument("results", nargs="+", help="results CSV (run.py), metrics JSON lines (sink.py) or ensemble CSV files")
+    parser.add_argument("--out", default="reports", help="output directory")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--force", action="store_true", help="render all figures, also unchanged ones")
+    args = parser.parse_args()
+
+    rendered = generate_reports(args.results, args.out, args.workers, args.force)
+    print(f"{len(rendered)} figures rendered.")
@@ -0,0 +1,119 @@
+# Sampling structures for agent-based Renaissance Florence simulation.
+# Lets the model draw households proportional to their weight (e.g. bocche) without rebuilding weight lists.
+
+# Fenwick (binary indexed) tree over integer weights
+# Supports weight updates and weighted draws in O(log n) instead of O(n) per event
+class FenwickTree:
+
+    def __init__(self, weights):
+        self.n = len(weights)
+        self.tree = [0] + [int(w) for w in weights]
+        self.total = sum(self.tree)
+        for i in range(1, self.n + 1):              # Build the tree in O(n)
+            j = i + (i & -i)
+            if j <= self.n:
+                self.tree[j] += self.tree[i]
+        self.top = 1 << (self.n.bit_length() - 1) if self.n else 0     # Highest power of two <= n
+
+    # Changes the weight at (0-based) index i by delta
+    def add(self, i, delta):
+        self.total += delta
+        i += 1
+        while i <= self.n:
+            self.tree[i] += delta
+            i += i & -i
+
+    # Returns the first index whose cumulative weight exceeds x
+    # Equivalent to bisect_right on the cumulative weight list, as used by random.choices
+    def find(self, x):
+        pos = 0
+        acc = 0                                     # Cumulative weight is kept exact, x is never modified
+        step = self.top
+        while step:
+            nxt = pos + step
+            if nxt <= self.n and acc + self.tree[nxt] <= x:
+                pos = nxt
+                acc += self.tree[nxt]
+            step >>= 1
+        return min(pos, self.n - 1)                 # random.choices also caps the index at n - 1
+
+    # Draws an index with probability proportional to its weight
+    # Consumes the RNG exactly like random.choices(population, weights)[0]
+    def sample(self, random):
+        return self.find(random.random() * self.total)
+
+
+# Index of the households in every wealth class
+# Supports adding, removing and moving households and uniform random picks in O(1)
+class ClassIndex:
+
+    def __init__(self, n_classes=6):
+        self.members = [[] for _ in range(n_classes)]     # Households per class, in no particular order
+        self.position = {}                                  # Household -> (class, position in its list)
+
+    # The list of households in a class, e.g. for self.random.choice(index[wealth_class])
+    def __getitem__(self, wealth_class):
+        return self.members[wealth_class]
+
+    def __len__(self):
+        return len(self.position)
+
+    def add(self, agent, wealth_class):
+        members = self.members[wealth_class]
+        self.position[agent] = (wealth_class, len(members))
+        members.append(agent)
+
+    # Swaps the last household of the class into the removed slot
+    def remove(self, agent):
+        wealth_class, i = self.position.pop(agent)
+        members = self.members[wealth_class]
+        last = members.pop()
+        if last is not agent:
+            members[i] = last
+            self.position[last] = (wealth_class, i)
+
+    def move(self, agent, wealth_class):
+        if self.position[agent][0] != wealth_class:
+            self.remove(agent)
+            self.add(agent, wealth_class)
+
+
+# Wealth class index that also keeps the households of every class per location and per guild
+# Supports picks among the households of one class in the same location (or guild) in O(1)
+class LocalClassIndex(ClassIndex):
+
+    def __init__(self, n_classes=6, keys=("location", "guild")):
+        super().__init__(n_classes)
+        self.keys = keys
+        self.local = {key: {} for key in keys}              # Key -> {(class, value): households}
+        self.local_position = {key: {} for key in keys}     # Key -> {household: position in its list}
+
+    # The households of a class with this value of the key, e.g. local_members("location", 3, agent.location)
+    def local_members(self, key, wealth_class, value):
+        return self.local[key].get((wealth_class, value), ())
+
+    def add(self, agent, wealth_class):
+        super().add(agent, wealth_class)
+        for key in self.keys:
+            members = self.local[key].setdefault((wealth_class, getattr(agent, key)), [])
+            self.local_position[key][agent] = len(members)
+            members.append(agent)
+
+    def remove(self, agent):
+        wealth_class = self.position[agent][0]
+        super().remove(agent)
+        for key in self.keys:
+            positions = self.local_position[key]
+            i = positions.pop(agent)
+            members = self.local[key][(wealth_class, getattr(agent, key))]
+            last = members.pop()
+            if last is not agent:
+                members[i] = last
+                positions[last] = i
+
+    # Puts the households of every local list in order of rank(household), e.g. their saved positions
+    def arrange(self, key, rank):
+        for members in self.local[key].values():
+            members.sort(key=rank)
+            for i, agent in enumerate(members):
+                self.local_position[key][agent] = i
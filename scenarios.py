@@ -0,0 +1,248 @@
+# Scenario batches for agent-based Renaissance Florence simulation.
+# Runs S counterfactual scenarios (forced loans, mortality, war years, instability and tax constants)
+# together from one 1427 population. Household state has a leading scenario axis, shape (S, households),
+# and every year all scenarios advance in the same vectorized passes. Results are reported per scenario.
+#
+# Deaths draw persons without replacement in proportion to bocche (multivariate hypergeometric) and births
+# follow the Polya urn of the single model (Dirichlet-multinomial), so both match Florence in distribution.
+# Heirs are drawn from the households alive at the start of the year.
+
+import numpy as np
+import pandas as pd
+from engine import GeneratorDraws, pick_partners, plan_trades, recalculate, trading_gains
+from model import DEFAULT_PARAMS, HISTORICAL_EVENTS, PREFERENCES, model_params, statistics_of
+
+# Model parameters a scenario can change, the parameters are vectors over the scenarios of a batch
+# Partners are always picked citywide in a batch, so the partner preferences are left out, and all
+# scenarios share the class thresholds and trade ranges, which are not single numbers: they are
+# arguments of the batch, e.g. ScenarioBatch(df_1427, scenarios, class_thresholds=[...])
+BATCH_PARAMS = ("class_thresholds", "trades_per_strategy")
+SCENARIO_PARAMS = {name: value for name, value in DEFAULT_PARAMS.items() if name not in PREFERENCES.values() and name not in BATCH_PARAMS}
+
+# Household state columns and their types
+COLUMNS = {
+    "investments": np.float64,
+    "deductions": np.float64,
+    "wealth": np.float64,
+    "taxable": np.float64,
+    "bocche": np.int64,
+    "wealth_class": np.int64,
+    "trade_strategy": np.int64,
+    "alive": bool,
+}
+
+# Years at war under the historical events of Florence.step, Florence is at war at the start
+def historical_war_years(first=1427, last=1500):
+    war = True
+    years = set()
+    for year in range(first, last + 1):
+        for _, attribute, value in HISTORICAL_EVENTS.get(year, ()):
+            if attribute == "war":
+                war = value
+        if war:
+            years.add(year)
+    return years
+
+# One scenario, e.g. scenario("half loans", {y: a / 2 for y, a in forced_loans_dict.items()}, mortality_dict)
+def scenario(name, forced_loans_dict, mortality_dict, war_years=None, **params):
+    shared = set(params) & set(BATCH_PARAMS)
+    if shared:
+        raise ValueError(f"{', '.join(sorted(shared))} are shared by all scenarios, pass them to ScenarioBatch or run_scenarios.")
+    unknown = set(params) - set(SCENARIO_PARAMS)
+    if unknown:
+        raise ValueError(f"Unknown scenario parameters: {', '.join(sorted(unknown))}.")
+    return {
+        "name": name,
+        "forced_loans": forced_loans_dict,
+        "mortality": mortality_dict,
+        "war_years": historical_war_years() if war_years is None else set(war_years),
+        "params": {**SCENARIO_PARAMS, **params},
+    }
+
+class ScenarioBatch:
+
+    def __init__(self, df_1427, scenarios, seed=0, class_thresholds=None, trades_per_strategy=None):
+        self.scenarios = scenarios
+        self.names = [s["name"] for s in scenarios]
+        self.rng = np.random.default_rng(seed)
+        n_scenarios = len(scenarios)
+        n = len(df_1427)
+
+        # Parameters as vectors over the scenarios
+        self.params = {name: np.array([s["params"][name] for s in scenarios], dtype=float) for name in SCENARIO_PARAMS}
+
+        # Parameters shared by all scenarios, checked like the parameters of the single model
+        shared = {"class_thresholds": class_thresholds, "trades_per_strategy": trades_per_strategy}
+        shared = model_params({name: value for name, value in shared.items() if value is not None})
+        self.class_thresholds = np.array(shared["class_thresholds"], dtype=float)
+        self.trades_per_strategy = np.array(shared["trades_per_strategy"])
+
+        # Every scenario starts from the same households, trade strategies included
+        self.size = np.full(n_scenarios, n)                 # Rows in use per scenario, including dead households
+        self.capacity = max(2 * n, 1)
+        for name, dtype in COLUMNS.items():
+            setattr(self, name, np.zeros((n_scenarios, self.capacity), dtype=dtype))
+        self.investments[:, :n] = df_1427["total"].to_numpy(dtype=float)
+        self.deductions[:, :n] = df_1427["deductions"].to_numpy(dtype=float)
+        self.bocche[:, :n] = df_1427["bocche"].to_numpy()
+        self.trade_strategy[:, :n] = self.rng.integers(0, 5, n)
+        self.alive[:, :n] = True
+        self.update_wealth()
+
+        self.year = 1427
+        self.steps = 0
+        self.instability = np.zeros(n_scenarios)
+        self.tax_percentage = np.full(n_scenarios, 0.1525)      # Literature value between 1428-1433
+        self.plague = np.zeros(n_scenarios, dtype=bool)
+        self.population = self.params["population_1427"].round()
+        self.deaths = np.zeros(n_scenarios, dtype=np.int64)
+        self.births = np.zeros(n_scenarios, dtype=np.int64)
+        self.records = []
+        self.collect()
+
+    # Grows the household columns of all scenarios
+    def grow(self, capacity):
+        for name in COLUMNS:
+            column = getattr(self, name)
+            grown = np.zeros((column.shape[0], capacity), dtype=column.dtype)
+            grown[:, :self.capacity] = column
+            setattr(self, name, grown)
+        self.capacity = capacity
+
+    def update_wealth(self):
+        self.wealth[:] = self.investments - self.deductions
+        self.wealth_class[:] = np.searchsorted(self.class_thresholds, self.investments, side="right")
+
+    def step(self):
+        self.year += 1
+        self.steps += 1
+        params = self.params
+        alive = self.alive
+
+        # Taxes per scenario, capped
+        tax_total = np.array([s["forced_loans"][self.year] for s in self.scenarios], dtype=float)
+        self.taxable[:] = np.where(alive, np.maximum(self.wealth - self.bocche * 200, 0), 0)    # 200 Florins tax deduction per family member
+        self.tax_percentage = np.minimum(tax_total / self.taxable.sum(axis=1), params["tax_cap"])
+
+        # Instability from forced loans, raised in epidemic years
+        mortality = np.array([s["mortality"].get(self.year, 0) for s in self.scenarios], dtype=float)
+        self.plague = mortality > params["plague_threshold"]
+        instability_input = tax_total / params["instability_tax_unit"] * np.where(self.plague, params["plague_multiplier"], 1) * params["instability_weight"]
+        self.instability = np.minimum(self.instability * params["instability_decay_rate"] + instability_input, 1)
+
+        # Population follows the decay between the known populations of 1427 and 1458
+        population_new = params["population_1427"] * np.exp(-0.0058084 * (self.year - 1427))
+        self.births = np.round(self.population * params["birthrate"]).astype(np.int64)
+        self.deaths = np.round(self.population + self.births - population_new).astype(np.int64)
+        self.population = np.round(population_new)
+        self.distribute_deaths()
+        self.distribute_births()
+
+        self.trading_phase()
+        self.recalculation_phase()
+        self.collect()
+
+    # Persons die without replacement in proportion to bocche, households without members die
+    # and leave their estate to 1 to 5 heirs among the households alive at the start of the year
+    def distribute_deaths(self):
+        for s in range(len(self.scenarios)):
+            rows = np.flatnonzero(self.alive[s])
+            bocche = self.bocche[s, rows]
+            deaths = self.rng.multivariate_hypergeometric(bocche, min(max(self.deaths[s], 0), bocche.sum()))
+            self.bocche[s, rows] -= deaths
+            dead = rows[(deaths > 0) & (self.bocche[s, rows] <= 0)]        # Households without bocche are never drawn, so they never die
+            if len(dead) == 0:
+                continue
+            heirs_n = self.rng.integers(1, 6, len(dead))
+            heirs = rows[self.rng.integers(0, len(rows), heirs_n.sum())]
+            estate = np.repeat(dead, heirs_n)
+            share = np.repeat(heirs_n, heirs_n)
+            creditor = self.wealth[s, estate] < 0                    # Heirs of households in debt only inherit the investments
+            np.add.at(self.investments[s], heirs, self.investments[s, estate] / share)
+            np.add.at(self.deductions[s], heirs, np.where(creditor, 0, self.deductions[s, estate] / share))
+            self.alive[s, dead] = False
+
+    # Every birth picks a household in proportion to its bocche, which then grow: a Polya urn, so the
+    # births per household are Dirichlet-multinomial
+    def distribute_births(self):
+        shares = self.rng.gamma(np.where(self.alive, self.bocche, 0))
+        shares /= shares.sum(axis=1, keepdims=True)
+        self.bocche += self.rng.multinomial(self.births, shares)
+
+    # Vectorized household.trading_phase for all households of all scenarios
+    def trading_phase(self):
+        scenario, rows = np.nonzero(self.alive)
+        flat = scenario * self.capacity + rows
+        wealth_class = self.wealth_class.ravel()[flat]
+        investments = self.investments.ravel()[flat]
+        draws = GeneratorDraws(self.rng)
+        low, high = self.trades_per_strategy.T
+        production, trade_size, trader, trade, partner_class = plan_trades(
+            self.bocche.ravel()[flat], investments, self.trade_strategy.ravel()[flat], self.instability[scenario],
+            self.params["labor_productivity"][scenario], self.params["capital_return_rate"][scenario], low, high, self.class_thresholds, draws)
+
+        # Partners are picked within the trader's scenario and the chosen class
+        pool_key = scenario * 6 + wealth_class
+        pools = flat[np.argsort(pool_key, kind="stable")]
+        pool_sizes = np.bincount(pool_key, minlength=len(self.scenarios) * 6)
+        traded, partner = pick_partners(pools, pool_sizes, scenario[trader] * 6 + partner_class, trader, trade, draws)
+        trader = trader[traded]
+
+        deductions = self.deductions.ravel()
+        deductions += np.bincount(partner, weights=trade_size[trader], minlength=deductions.size)
+        self.investments.ravel()[flat] = investments + trading_gains(production, trade_size, trader)
+
+    # Vectorized household.recalculation_phase for all households of all scenarios
+    # Rows of dead households have no bocche and no taxable income, so they never split or pay taxes
+    def recalculation_phase(self):
+        tax_percentage = np.repeat(self.tax_percentage, self.capacity)
+        split_coefficient = np.repeat(self.params["split_coefficient"], self.capacity)
+        investments, deductions, bocche, (parents, new_bocche, new_investments, new_deductions) = recalculate(
+            self.investments.ravel(), self.deductions.ravel(), self.wealth_class.ravel(), self.bocche.ravel(), self.taxable.ravel(),
+            tax_percentage, split_coefficient, GeneratorDraws(self.rng))
+        self.investments.ravel()[:] = investments
+        self.deductions.ravel()[:] = deductions
+        self.bocche.ravel()[:] = bocche
+
+        # The households that split off get rows at the end of their scenario
+        if len(parents):
+            scenario = parents // self.capacity
+            counts = np.bincount(scenario, minlength=len(self.scenarios))
+            if (self.size + counts).max() > self.capacity:
+                self.grow(2 * int((self.size + counts).max()))
+            rank = np.arange(len(scenario)) - np.concatenate(([0], np.cumsum(counts)[:-1]))[scenario]
+            new_rows = self.size[scenario] + rank
+            self.investments[scenario, new_rows] = new_investments
+            self.deductions[scenario, new_rows] = new_deductions
+            self.bocche[scenario, new_rows] = new_bocche
+            self.trade_strategy[scenario, new_rows] = self.rng.integers(0, 5, len(scenario))
+            self.alive[scenario, new_rows] = True
+            self.size += counts
+
+        self.update_wealth()
+
+    # Model level statistics of every scenario for this year
+    def collect(self):
+        for s, name in enumerate(self.names):
+            rows = np.flatnonzero(self.alive[s])
+            snapshot = {column: getattr(self, column)[s, rows] for column in ("wealth", "investments", "deductions", "bocche", "wealth_class")}
+            self.records.append({
+                "Scenario": name,
+                "Year": self.year,
+                **statistics_of(snapshot, self.instability[s]),
+                "Tax_Percentage": self.tax_percentage[s],
+                "Plague": bool(self.plague[s]),
+                "War": self.year in self.scenarios[s]["war_years"],
+                "Deaths": self.deaths[s],
+                "Births": self.births[s],
+            })
+
+    def results(self):
+        return pd.DataFrame(self.records).set_index(["Scenario", "Year"]).sort_index(level=0, sort_remaining=False)
+
+# Runs all scenarios together for a number of years, results have one row per scenario and year
+def run_scenarios(df_1427, scenarios, years=30, seed=0, class_thresholds=None, trades_per_strategy=None):
+    batch = ScenarioBatch(df_1427, scenarios, seed, class_thresholds, trades_per_strategy)
+    for _ in range(years):
+        batch.step()
+    return batch.results()
@@ -0,0 +1,166 @@
+# Global sensitivity analysis of agent-based Renaissance Florence simulation.
+# Sobol first-order and total indices (Saltelli design) or Morris elementary effects of the model constants
+# on the Gini coefficient, average wealth and class counts in the final year. Evaluations are averaged over
+# replicate seeds, run in parallel and cached on disk, so an interrupted study resumes where it stopped.
+#
+# Usage: python sensitivity.py --method sobol --samples 64 --seeds 1 2 --workers 8 --out sensitivity.csv
+
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from agent import CLASS_THRESHOLDS, TRADES_PER_STRATEGY
+from calibrate import evaluation_key
+from data import load_inputs
+from model import Florence
+
+# Ranges of the factors, class_threshold_scale and trade_volume_scale scale all class thresholds and trade ranges
+FACTORS = {
+    "tax_cap": (0.7, 1.0),
+    "plague_multiplier": (1.0, 2.0),
+    "instability_weight": (0.4, 0.9),
+    "birthrate": (0.03, 0.07),
+    "class_threshold_scale": (0.8, 1.25),
+    "trade_volume_scale": (0.5, 1.5),
+}
+
+OUTPUTS = [
+    "Gini",
+    "Avg_Wealth",
+    "Poor_Households",
+    "Lower_Mid_Households",
+    "Upper_Mid_Households",
+    "Wealthy_Households",
+    "Affluent_Households",
+    "Elite_Households",
+]
+
+inputs = None       # Model inputs, loaded once per worker process
+
+def init_worker():
+    global inputs
+    inputs = load_inputs()
+
+# Model parameters for one point of the unit cube, with a value in [0, 1] for every factor
+def factor_params(point):
+    values = {name: low + x * (high - low) for (name, (low, high)), x in zip(FACTORS.items(), point)}
+    params = {name: float(value) for name, value in values.items() if not name.endswith("_scale")}
+    params["class_thresholds"] = [round(t * values["class_threshold_scale"]) for t in CLASS_THRESHOLDS]
+    params["trades_per_strategy"] = [[max(1, round(low * values["trade_volume_scale"])), max(1, round(high * values["trade_volume_scale"]))] for low, high in TRADES_PER_STRATEGY]
+    return params
+
+# Runs the model for one parameter set and seed, returns the outputs in the final year
+def evaluate(params, seed, years=30):
+    df_1427, forced_loans_dict, mortality_dict = inputs
+    model = Florence(1, df_1427, forced_loans_dict, mortality_dict, seed=seed, engine="arrays", agent_history=False, params=params, quiet=True)
+    for _ in range(years):
+        model.step()
+    return {name: float(model.statistics[name]) for name in OUTPUTS}
+
+# Outputs for every point of a design, averaged over the seeds
+# Every finished evaluation is written to the cache at once, cached evaluations are not run again.
+def run_design(points, seeds=(1,), years=30, workers=None, cache_dir="sensitivity_cache"):
+    os.makedirs(cache_dir, exist_ok=True)
+    results = {}
+    pending = []
+    for i, point in enumerate(points):
+        params = factor_params(point)
+        for seed in seeds:
+            path = os.path.join(cache_dir, evaluation_key(params, seed, years) + ".json")
+            if os.path.exists(path):
+                with open(path) as f:
+                    results[i, seed] = json.load(f)
+            else:
+                pending.append((i, seed, params, path))
+
+    if pending:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+            futures = {executor.submit(evaluate, params, seed, years): (i, seed, path) for i, seed, params, path in pending}
+            for future in as_completed(futures):
+                i, seed, path = futures[future]
+                results[i, seed] = future.result()
+                with open(path, "w") as f:
+                    json.dump(results[i, seed], f)
+
+    return np.array([[np.mean([results[i, seed][name] for seed in seeds]) for name in OUTPUTS] for i in range(len(points))])
+
+# Saltelli design: matrices A and B of n points each, then A with column i taken from B for every factor
+# Both matrices are Latin hypercube samples of the unit cube
+def saltelli_design(n, seed=0):
+    rng = np.random.default_rng(seed)
+    k = len(FACTORS)
+    a, b = ((rng.permuted(np.tile(np.arange(n), (k, 1)), axis=1).T + rng.random((n, k))) / n for _ in range(2))
+    ab = np.repeat(a[None], k, axis=0)
+    ab[np.arange(k), :, np.arange(k)] = b.T
+    return np.concatenate((a, b, ab.reshape(k * n, k)))
+
+# First-order (Saltelli 2010) and total (Jansen) indices from the outputs of a Saltelli design
+def sobol_indices(y, n):
+    k = len(FACTORS)
+    y_a, y_b, y_ab = y[:n], y[n:2 * n], y[2 * n:].reshape(k, n, -1)
+    variance = np.concatenate((y_a, y_b)).var(axis=0)
+    variance[variance == 0] = np.nan                # Outputs that never change have no indices
+    first = (y_b * (y_ab - y_a)).mean(axis=1) / variance
+    total = ((y_a - y_ab) ** 2).mean(axis=1) / 2 / variance
+    return pd.DataFrame([
+        {"Output": name, "Factor": factor, "S1": first[i, j], "ST": total[i, j]}
+        for j, name in enumerate(OUTPUTS) for i, factor in enumerate(FACTORS)
+    ])
+
+# Morris design: r trajectories of k + 1 points on a grid of levels, every step moves one factor up by delta
+def morris_design(r, levels=4, seed=0):
+    rng = np.random.default_rng(seed)
+    k = len(FACTORS)
+    delta = levels / (2 * (levels - 1))
+    trajectories = []
+    for _ in range(r):
+        point = rng.integers(0, levels // 2, k) / (levels - 1)          # Low enough that every factor can move up by delta
+        trajectory = [point.copy()]
+        for i in rng.permutation(k):
+            point[i] += delta
+            trajectory.append(point.copy())
+        trajectories.append(trajectory)
+    return np.concatenate(trajectories)
+
+# Mean, mean absolute and standard deviation of the elementary effects from the outputs of a Morris design
+def morris_indices(points, y):
+    k = len(FACTORS)
+    steps = np.diff(points.reshape(-1, k + 1, k), axis=1)
+    changes = np.diff(y.reshape(-1, k + 1, y.shape[1]), axis=1)
+    factor = steps.argmax(axis=2)                                       # The factor moved in every step
+    effects = changes / steps.max(axis=2)[..., None]
+    rows = []
+    for j, name in enumerate(OUTPUTS):
+        for i, factor_name in enumerate(FACTORS):
+            ee = effects[..., j][factor == i]
+            rows.append({"Output": name, "Factor": factor_name, "mu": ee.mean(), "mu_star": np.abs(ee).mean(), "sigma": ee.std(ddof=1) if len(ee) > 1 else np.nan})
+    return pd.DataFrame(rows)
+
+# Runs a full study, samples is the base sample size n (Sobol, n * (k + 2) points) or the number of trajectories r (Morris)
+def sensitivity(method="sobol", samples=32, seeds=(1,), years=30, workers=None, cache_dir="sensitivity_cache", design_seed=0):
+    if method == "sobol":
+        points = saltelli_design(samples, design_seed)
+        return sobol_indices(run_design(points, seeds, years, workers, cache_dir), samples)
+    if method == "morris":
+        points = morris_design(samples, seed=design_seed)
+        return morris_indices(points, run_design(points, seeds, years, workers, cache_dir))
+    raise ValueError(f"Unknown method {method!r}, use 'sobol' or 'morris'.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Global sensitivity analysis of the Florence model constants.")
+    parser.add_argument("--method", choices=["sobol", "morris"], default="sobol")
+    parser.add_argument("--samples", type=int, default=32, help="base sample size (sobol) or trajectories (morris)")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[1], help="replicate seeds, outputs are averaged over them")
+    parser.add_argument("--years", type=int, default=30)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--design-seed", type=int, default=0, help="seed of the sample design")
+    parser.add_argument("--cache", default="sensitivity_cache", help="directory with cached evaluations")
+    parser.add_argument("--out", default="sensitivity.csv")
+    args = parser.parse_args()
+
+    indices = sensitivity(args.method, args.samples, args.seeds, args.years, args.workers, args.cache, args.design_seed)
+    indices.to_csv(args.out, index=False)
+    print(indices.pivot(index="Factor", columns="Output", values="ST" if args.method == "sobol" else "mu_star")[OUTPUTS])
@@ -0,0 +1,500 @@
+# Sharded execution for agent-based Renaissance Florence simulation.
+# Runs one large simulation across worker processes. The household columns live in shared memory and
+# every worker owns a contiguous range of rows, in which it computes taxable income, draws deaths and births,
+# trades and recalculates wealth. At each year boundary the workers only exchange the trades and inheritances
+# received from other shards and the global reductions: partial sums, the class membership counts and the
+# instability. Rows are grouped in blocks of BLOCK rows and shard ranges are made of whole blocks. Population
+# draws and partial sums are taken per block, with streams keyed by block, like Florence(..., streams=True) does,
+# so any number of workers gives the same results as the objects and arrays engines for the same seed.
+#
+# Usage: python shards.py --size 1000000 --years 5 --workers 32
+
+import argparse
+import math
+import multiprocessing
+import time
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+from engine import BLOCK, COLUMNS, StreamDraws, block_births, block_deaths, draw_heirs, pick_partners, plan_trades, recalculate, split_births, split_deaths, trading_gains
+from model import HISTORICAL_EVENTS, PREFERENCES, combine_statistics, model_params, statistics_parts
+from streams import RandomStreams
+
+# Shared columns: the household state, whether a row is alive and the households of each class for partner picks
+SHARED_COLUMNS = {**COLUMNS, "alive": bool, "pools": np.int64}
+
+# Household columns in shared memory blocks, created by the coordinator and attached by name in the workers
+class SharedColumns:
+
+    def __init__(self, capacity, names=None):
+        self.capacity = capacity
+        self.blocks = {}
+        for name, dtype in SHARED_COLUMNS.items():
+            if names is None:
+                block = shared_memory.SharedMemory(create=True, size=max(capacity * np.dtype(dtype).itemsize, 1))
+            else:
+                block = shared_memory.SharedMemory(name=names[name])
+            self.blocks[name] = block
+            setattr(self, name, np.ndarray(capacity, dtype=dtype, buffer=block.buf))
+        if names is None:
+            for name in SHARED_COLUMNS:
+                getattr(self, name)[:] = 0
+
+    def names(self):
+        return {name: block.name for name, block in self.blocks.items()}
+
+    # The arrays have to be released before the blocks can be closed
+    def close(self):
+        for name in SHARED_COLUMNS:
+            setattr(self, name, None)
+        for block in self.blocks.values():
+            block.close()
+
+    def unlink(self):
+        for block in self.blocks.values():
+            block.unlink()
+
+
+# The households of one worker, a contiguous range of rows of the shared columns
+class Shard:
+
+    def __init__(self, names, capacity, seed, params):
+        self.columns = SharedColumns(capacity, names)
+        self.streams = RandomStreams(seed)
+        self.params = params
+        self.class_thresholds = np.array(params["class_thresholds"])
+        self.trades_low, self.trades_high = np.array(params["trades_per_strategy"]).T
+        self.start = 0
+        self.stop = 0
+        self.children = None            # Households split off this year, placed once their rows are known
+
+    # Attaches to new blocks after the coordinator grew the columns
+    def attach(self, names, capacity):
+        self.columns.close()
+        self.columns = SharedColumns(capacity, names)
+
+    def assign(self, start, stop):
+        self.start = start
+        self.stop = stop
+
+    # Living households of the shard, in order of unique_id
+    def rows(self):
+        return self.start + np.flatnonzero(self.columns.alive[self.start:self.stop])
+
+    # Blocks of the shard as (block, first row, end row), the shard starts at a block boundary
+    def blocks(self):
+        if self.stop <= self.start:
+            return []
+        return [(block, block * BLOCK, min((block + 1) * BLOCK, self.stop)) for block in range(self.start // BLOCK, -(-self.stop // BLOCK))]
+
+    # Living households of one block
+    def block_rows(self, start, stop):
+        return start + np.flatnonzero(self.columns.alive[start:stop])
+
+    # Same as HouseholdArrays.calculate_taxable, returns the number of households with taxable income and the taxable total per block
+    def calculate_taxable(self):
+        c = self.columns
+        rows = slice(self.start, self.stop)
+        c.taxable[rows] = np.maximum(c.wealth[rows] - c.bocche[rows] * 200, 0)
+        totals = [math.fsum(c.taxable[self.block_rows(start, stop)]) for _, start, stop in self.blocks()]
+        return np.count_nonzero(c.taxable[self.rows()] > 0), totals
+
+    # Household members per block
+    def block_bocche(self):
+        return [int(self.columns.bocche[self.block_rows(start, stop)].sum()) for _, start, stop in self.blocks()]
+
+    # Deaths in every block, counts gives the number per block, drawn with engine.block_deaths
+    # Returns the estates of the households that died out as (rows, investments, deductions, wealth) and the members left per block.
+    def deaths(self, year, counts):
+        c = self.columns
+        died_out = []
+        bocche = []
+        for (block, start, stop), count in zip(self.blocks(), counts):
+            rows = self.block_rows(start, stop)
+            if count > 0:
+                died = block_deaths(self.streams.generator(year, "deaths", block + 1), c.bocche[rows], count)
+                c.bocche[rows] -= died.astype(c.bocche.dtype)
+                died_out.append(rows[(died > 0) & (c.bocche[rows] <= 0)])
+                c.alive[died_out[-1]] = False
+            bocche.append(int(c.bocche[rows].sum()))
+        rows = np.concatenate(died_out + [np.empty(0, dtype=np.int64)])
+        return (rows, c.investments[rows], c.deductions[rows], c.wealth[rows]), bocche
+
+    # Heirs take their shares of the estates, then the births of every block, counts gives the number per block
+    def births(self, year, heirs, investments, deductions, counts):
+        c = self.columns
+        np.add.at(c.investments, heirs, investments)
+        np.add.at(c.deductions, heirs, deductions)
+        for (block, start, stop), count in zip(self.blocks(), counts):
+            rows = self.block_rows(start, stop)
+            rows = rows[c.bocche[rows] > 0]
+            if count > 0:
+                c.bocche[rows] += block_births(self.streams.generator(year, "births", block + 1), c.bocche[rows], count).astype(c.bocche.dtype)
+
+    # Statistics parts of every block, combined by the coordinator
+    def statistics_parts(self):
+        names = ("wealth", "investments", "deductions", "bocche", "wealth_class")
+        parts = []
+        for _, start, stop in self.blocks():
+            rows = self.block_rows(start, stop)
+            parts.append(statistics_parts({name: getattr(self.columns, name)[rows] for name in names}))
+        return parts
+
+    def class_counts(self):
+        return np.bincount(self.columns.wealth_class[self.rows()], minlength=6)
+
+    # Writes the shard's households of every class to its place in the shared pools
+    def write_pools(self, offsets):
+        rows = self.rows()
+        wealth_class = self.columns.wealth_class[rows]
+        rows = rows[np.argsort(wealth_class, kind="stable")]
+        counts = np.bincount(wealth_class, minlength=6)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        for c in range(6):
+            self.columns.pools[offsets[c]:offsets[c] + counts[c]] = rows[starts[c]:starts[c] + counts[c]]
+
+    # Same as HouseholdArrays.trading_phase_streams for the shard's traders, partners are picked from the global pools
+    # Returns the trades received by partners as (rows, amounts), to be passed on to the shards owning them
+    def trading_phase(self, year, instability, pool_sizes):
+        c = self.columns
+        rows = self.rows()
+        draws = StreamDraws(self.streams, self.streams.keys(year, "trading", c.unique_id[rows]))
+        production, trade_size, trader, trade, partner_class = plan_trades(
+            c.bocche[rows], c.investments[rows], c.trade_strategy[rows], instability, self.params["labor_productivity"], self.params["capital_return_rate"],
+            self.trades_low, self.trades_high, self.class_thresholds, draws)
+        traded, partner = pick_partners(c.pools, pool_sizes, partner_class, trader, trade, draws)
+        trader = trader[traded]
+        c.investments[rows] += trading_gains(production, trade_size, trader)
+        partners, inverse = np.unique(partner, return_inverse=True)
+        return partners, np.bincount(inverse, weights=trade_size[trader], minlength=len(partners))
+
+    # Adds the received trades and runs household.recalculation_phase with the household's recalculation stream
+    # Returns the number of households that split off, they are placed by place_children
+    def recalculation_phase(self, received_rows, received_amounts, year, tax_percentage):
+        c = self.columns
+        rows = self.rows()
+        received = np.bincount(received_rows - self.start, weights=received_amounts, minlength=self.stop - self.start)
+        c.deductions[rows] += received[rows - self.start]     # Summed first, like the single process settlement
+
+        draws = StreamDraws(self.streams, self.streams.keys(year, "recalculation", c.unique_id[rows]))
+        investments, deductions, bocche, (parents, new_bocche, new_investments, new_deductions) = recalculate(
+            c.investments[rows], c.deductions[rows], c.wealth_class[rows], c.bocche[rows], c.taxable[rows], tax_percentage, self.params["split_coefficient"], draws)
+        c.investments[rows] = investments
+        c.deductions[rows] = deductions
+        c.bocche[rows] = bocche
+        self.children = (new_investments, new_deductions, new_bocche, c.guild[rows[parents]], c.location[rows[parents]])
+
+        # Same as HouseholdArrays.update_wealth
+        rows = slice(self.start, self.stop)
+        c.wealth[rows] = c.investments[rows] - c.deductions[rows]
+        c.wealth_class[rows] = np.searchsorted(self.class_thresholds, c.investments[rows], side="right")
+        return len(parents)
+
+    # Writes this year's split households to their rows, unique_ids follow the order of their parents
+    def place_children(self, first_row, first_id, year):
+        c = self.columns
+        investments, deductions, bocche, guild, location = self.children
+        rows = first_row + np.arange(len(bocche))
+        unique_id = first_id + np.arange(len(bocche))
+        c.unique_id[rows] = unique_id
+        c.investments[rows] = investments
+        c.deductions[rows] = deductions
+        c.wealth[rows] = investments - deductions
+        c.taxable[rows] = 0
+        c.bocche[rows] = bocche
+        c.wealth_class[rows] = np.searchsorted(self.class_thresholds, investments, side="right")
+        c.trade_strategy[rows] = self.streams.integers(self.streams.keys(year, "strategy", unique_id), 1, 0, 4)
+        c.guild[rows] = guild
+        c.location[rows] = location
+        c.alive[rows] = True
+        self.children = None
+
+    def close(self):
+        self.columns.close()
+
+
+# Worker process loop, runs the coordinator's calls on its shard until it is closed
+def serve(connection, names, capacity, seed, params):
+    shard = Shard(names, capacity, seed, params)
+    while True:
+        method, args = connection.recv()
+        try:
+            result = getattr(shard, method)(*args)
+        except Exception as error:          # Raised again in the coordinator
+            result = error
+        connection.send(result)
+        if method == "close":
+            break
+
+# A shard in its own process
+class Worker:
+
+    def __init__(self, context, names, capacity, seed, params):
+        self.connection, remote = context.Pipe()
+        self.process = context.Process(target=serve, args=(remote, names, capacity, seed, params), daemon=True)
+        self.process.start()
+
+    def send(self, method, *args):
+        self.connection.send((method, args))
+
+    def receive(self):
+        result = self.connection.recv()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def join(self):
+        self.process.join()
+
+# A shard in the coordinating process, for a single worker
+class InlineWorker:
+
+    def __init__(self, names, capacity, seed, params):
+        self.shard = Shard(names, capacity, seed, params)
+
+    def send(self, method, *args):
+        self.result = getattr(self.shard, method)(*args)
+
+    def receive(self):
+        return self.result
+
+    def join(self):
+        pass
+
+
+# Florence model run across worker processes, e.g.
+#   with ShardedFlorence(1, df_1427, forced_loans_dict, mortality_dict, seed=1, workers=32) as model:
+#       for _ in range(30):
+#           model.step()
+#   data = model.get_model_vars_dataframe()
+class ShardedFlorence:
+
+    def __init__(self, n, df_1427, forced_loans_dict, mortality_dict, seed, workers=2, params=None, sink=None, quiet=False):
+        self.params = model_params(params)
+        if any(self.params[name] for name in PREFERENCES.values()):
+            raise ValueError("Partner preferences are not supported in sharded runs.")
+        self.streams = RandomStreams(seed)
+        self.forced_loans_dict = forced_loans_dict
+        self.mortality_dict = mortality_dict
+        self.sink = sink
+        self.quiet = quiet
+        self.steps = 0
+        self.year = 1427
+        self.war = True
+        self.Cosimo = False
+        self.instability = 0
+        self.instability_input = 0
+        self.tax_total = 0
+        self.taxable_total = 0
+        self.tax_eligible_households = 0
+        self.tax_percentage = 0.1525
+        self.plague = False
+        self.population_1427 = self.params["population_1427"]
+        self.population = self.population_1427
+        self.population_new = 0
+        self.deaths = 0
+        self.births = 0
+        self.records = []
+
+        # Households as created by Florence, n for every row of the Catasto with unique_ids from 1
+        size = len(df_1427) * n
+        self.columns = SharedColumns(max(2 * size, 1))
+        c = self.columns
+        c.unique_id[:size] = np.arange(1, size + 1)
+        c.investments[:size] = np.repeat(df_1427["total"].to_numpy(), n)
+        c.deductions[:size] = np.repeat(df_1427["deductions"].to_numpy(), n)
+        c.wealth[:size] = c.investments[:size] - c.deductions[:size]
+        c.bocche[:size] = np.repeat(df_1427["bocche"].to_numpy(), n)
+        c.wealth_class[:size] = np.searchsorted(self.params["class_thresholds"], c.investments[:size], side="right")
+        c.trade_strategy[:size] = self.streams.integers(self.streams.keys(self.year, "strategy", c.unique_id[:size]), 1, 0, 4)
+        c.guild[:size] = np.repeat(df_1427["trade_last2"].astype(int).to_numpy(), n)
+        c.location[:size] = np.repeat(df_1427["location"].to_numpy(), n)
+        c.alive[:size] = True
+        self.size = size
+        self.next_id = size + 1
+
+        names = self.columns.names()
+        if workers > 1:
+            context = multiprocessing.get_context()
+            self.workers = [Worker(context, names, c.capacity, seed, self.params) for _ in range(workers)]
+        else:
+            self.workers = [InlineWorker(names, c.capacity, seed, self.params)]
+
+        if not self.quiet:
+            print(f"Simulation started.")
+            print(f"There are {str(size)} households across {len(self.workers)} shards.")
+        self.balance()
+        self.collect_data()
+
+    # Sends a call to every worker and waits for all results, args_per_worker gives separate arguments per worker
+    def call(self, method, *args, args_per_worker=None):
+        for i, worker in enumerate(self.workers):
+            worker.send(method, *(args if args_per_worker is None else args_per_worker[i]))
+        return [worker.receive() for worker in self.workers]
+
+    # Living households, in order of unique_id
+    def rows(self):
+        return np.flatnonzero(self.columns.alive[:self.size])
+
+    # Splits the rows in use into ranges of whole blocks with about the same number of living households
+    def balance(self):
+        alive = np.cumsum(self.columns.alive[:self.size])
+        total = alive[-1] if self.size else 0
+        bounds = np.searchsorted(alive, np.linspace(0, total, len(self.workers) + 1)[1:-1], side="left")
+        bounds = np.minimum(np.round(bounds / BLOCK).astype(np.int64) * BLOCK, self.size)
+        self.bounds = np.concatenate(([0], bounds, [self.size]))
+        self.call("assign", args_per_worker=list(zip(self.bounds[:-1], self.bounds[1:])))
+
+    # Moves the columns to larger blocks, the workers attach to them before any rows are written there
+    def grow(self, capacity):
+        grown = SharedColumns(capacity)
+        for name in SHARED_COLUMNS:
+            getattr(grown, name)[:self.size] = getattr(self.columns, name)[:self.size]
+        self.call("attach", grown.names(), capacity)
+        self.columns.close()
+        self.columns.unlink()
+        self.columns = grown
+
+    def step(self):
+        self.year += 1
+        self.steps += 1
+        if not self.quiet:
+            print(f"\nYear {str(self.year)}.")
+            print(f"Population: {str(self.population)}.")
+        for message, attribute, value in HISTORICAL_EVENTS.get(self.year, ()):
+            self.log(message)
+            setattr(self, attribute, value)
+
+        # Taxable income in the shards, the total is an exactly rounded sum of the block totals so it does not depend on the shards
+        self.tax_total = self.forced_loans_dict[self.year]
+        eligible, totals = zip(*self.call("calculate_taxable"))
+        self.tax_eligible_households = sum(eligible)
+        self.taxable_total = math.fsum(total for block_totals in totals for total in block_totals)
+        self.tax_percentage = min(self.tax_total / self.taxable_total, self.params["tax_cap"])
+
+        if self.year in self.mortality_dict and self.mortality_dict[self.year] > self.params["plague_threshold"]:
+            self.plague = True
+            self.log("An epidemic has struck the city.")
+            self.instability_input = (self.tax_total / self.params["instability_tax_unit"] * self.params["plague_multiplier"]) * self.params["instability_weight"]
+        else:
+            self.plague = False
+            self.instability_input = (self.tax_total / self.params["instability_tax_unit"]) * self.params["instability_weight"]
+        self.instability = min((self.instability * self.params["instability_decay_rate"]) + self.instability_input, 1)
+
+        self.population_new = self.population_1427 * np.exp(-0.0058084 * (self.year - 1427))
+        self.births = round(self.population*self.params["birthrate"])
+        self.deaths = round(self.population + self.births - self.population_new)
+        self.population = round(self.population_new)
+        self.population_phase()
+
+        # Pools of every class in unique_id order: each shard writes its households after those of the shards before it
+        self.balance()
+        counts = np.array(self.call("class_counts"))
+        pool_sizes = counts.sum(axis=0)
+        offsets = np.concatenate(([0], np.cumsum(pool_sizes)[:-1])) + np.cumsum(counts, axis=0) - counts
+        self.call("write_pools", args_per_worker=[(offset,) for offset in offsets])
+
+        # Trading, then the trades received from every shard are passed to the shard owning the partner
+        transfers = self.call("trading_phase", self.year, self.instability, pool_sizes)
+        partners = np.concatenate([rows for rows, _ in transfers])
+        amounts = np.concatenate([amounts for _, amounts in transfers])
+        owner = np.searchsorted(self.bounds, partners, side="right") - 1
+        received = [(partners[owner == i], amounts[owner == i], self.year, self.tax_percentage) for i in range(len(self.workers))]
+        splits = np.array(self.call("recalculation_phase", args_per_worker=received))
+
+        # New households from splits get rows and unique_ids in the order of their parents
+        total = int(splits.sum())
+        if self.size + total > self.columns.capacity:
+            self.grow(2 * (self.size + total))
+        first = np.cumsum(splits) - splits
+        self.call("place_children", args_per_worker=[(self.size + f, self.next_id + f, self.year) for f in first])
+        self.size += total
+        self.next_id += total
+        self.balance()                  # The new households join the shards, also for the start of next year
+
+        self.log(f"This year {str(self.deaths)} people have died. There are now {str(np.count_nonzero(self.columns.alive[:self.size]))} households.")
+        self.collect_data()
+
+    # Deaths, inheritance and births, drawn in the shards
+    # The year's deaths and births are split over the blocks with the city's streams and drawn within the blocks with
+    # the blocks' streams, see engine.split_deaths. Heirs are picked among all households alive after the deaths and
+    # take their shares of an estate in the shard that owns them.
+    def population_phase(self):
+        random = self.streams.generator(self.year, "deaths")
+        bocche = self.call("block_bocche")
+        deaths = split_deaths(random, np.concatenate([np.array(b, dtype=np.int64) for b in bocche]), self.deaths)
+        results = self.call("deaths", args_per_worker=[(self.year, counts) for counts in self.split(deaths, bocche)])
+
+        rows, investments, deductions, wealth = (np.concatenate(columns) for columns in zip(*(estates for estates, _ in results)))
+        living = self.rows()
+        heirs, shares, debts = draw_heirs(random, investments, deductions, wealth, len(living))
+        heirs = living[heirs]
+        owner = np.searchsorted(self.bounds, heirs, side="right") - 1
+
+        bocche = [b for _, b in results]
+        births = split_births(self.streams.generator(self.year, "births"), np.concatenate([np.array(b, dtype=np.int64) for b in bocche]), self.births)
+        births = self.split(births, bocche)
+        self.call("births", args_per_worker=[(self.year, heirs[owner == i], shares[owner == i], debts[owner == i], births[i]) for i in range(len(self.workers))])
+
+    # Splits values per block into one array per shard, per_shard has a list with the blocks of every shard
+    def split(self, values, per_shard):
+        return np.split(values, np.cumsum([len(blocks) for blocks in per_shard])[:-1])
+
+    def log(self, message):
+        if self.sink is not None:
+            self.sink.event(self.year, message)
+        if not self.quiet:
+            print(message)
+
+    # Statistics from the parts of every block, summed in block order so they do not depend on the shards
+    def collect_data(self):
+        self.statistics = combine_statistics([part for parts in self.call("statistics_parts") for part in parts], self.instability)
+        self.records.append(self.statistics)
+        if self.sink is not None:
+            self.sink.metrics(self.steps, self.year, {**self.statistics, "Deaths": self.deaths, "Births": self.births, "Tax_Percentage": self.tax_percentage})
+
+    # Model level statistics per step, like Florence.datacollector.get_model_vars_dataframe()
+    def get_model_vars_dataframe(self):
+        return pd.DataFrame(self.records)
+
+    # Stops the workers and frees the shared memory
+    def close(self):
+        if self.columns is None:
+            return
+        self.call("close")
+        for worker in self.workers:
+            worker.join()
+        self.columns.close()
+        self.columns.unlink()
+        self.columns = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    from benchmark import scaled_inputs
+    from data import load_inputs
+
+    parser = argparse.ArgumentParser(description="Run one simulation across worker processes.")
+    parser.add_argument("--size", type=int, default=0, help="Synthetic households, 0 for the 1427 Catasto")
+    parser.add_argument("--years", type=int, default=30)
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", default=None, help="CSV file for the model level statistics")
+    args = parser.parse_args()
+
+    if args.size:
+        df, forced_loans, mortality, params = scaled_inputs(args.size, args.seed)
+    else:
+        (df, forced_loans, mortality), params = load_inputs(), None
+    start = time.perf_counter()
+    with ShardedFlorence(1, df, forced_loans, mortality, seed=args.seed, workers=args.workers, params=params, quiet=True) as model:
+        for _ in range(args.years):
+            model.step()
+    print(f"{len(df)} households, {args.years} years on {args.workers} workers in {time.perf_counter() - start:.1f} s.")
+    if args.out:
+        model.get_model_vars_dataframe().to_csv(args.out, index=False)
@@ -0,0 +1,78 @@
+# Streaming output for agent-based Renaissance Florence simulation.
+# Appends the model level statistics and the yearly events (wars, epidemics, deaths, households)
+# to a JSON lines file as every step finishes. Records are buffered and written in whole lines,
+# so the file of a run that was killed can still be read up to its last flush.
+
+import json
+import time
+import numpy as np
+import pandas as pd
+
+# Converts NumPy scalars to plain Python values for JSON
+def plain(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+class MetricsSink:
+
+    # flush_every:   write the buffered records after this many steps
+    # flush_seconds: or once this much time has passed since the last write
+    def __init__(self, path, flush_every=10, flush_seconds=30):
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self.buffer = []
+        self.steps = 0
+        self.last_flush = time.monotonic()
+        open(self.path, "w").close()            # Start with an empty file
+
+    # Statistics of one step, e.g. model.statistics, with the year and population changes
+    def metrics(self, step, year, values):
+        self.buffer.append({"type": "metrics", "step": step, "year": year, **{name: plain(value) for name, value in values.items()}})
+        self.steps += 1
+        if self.steps % self.flush_every == 0 or time.monotonic() - self.last_flush > self.flush_seconds:
+            self.flush()
+
+    def event(self, year, message):
+        self.buffer.append({"type": "event", "year": year, "event": message})
+
+    def flush(self):
+        if self.buffer:
+            with open(self.path, "a") as f:
+                f.write("".join(json.dumps(record) + "\n" for record in self.buffer))
+            self.buffer = []
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# All complete records of a sink file, a line cut off by a killed run is skipped
+def read_records(path):
+    records = []
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+    return records
+
+# Model level statistics, one row per step like model.datacollector.get_model_vars_dataframe()
+# The Year, Deaths, Births and Tax_Percentage columns are only kept with extra=True.
+def read_metrics(path, extra=False):
+    rows = [record for record in read_records(path) if record["type"] == "metrics"]
+    df = pd.DataFrame(rows).drop(columns=["type", "step"], errors="ignore")
+    df = df.rename(columns={"year": "Year"})
+    if not extra:
+        df = df.drop(columns=["Year", "Deaths", "Births", "Tax_Percentage"], errors="ignore")
+    return df.reset_index(drop=True)
+
+# Events per year, e.g. wars and epidemics
+def read_events(path):
+    rows = [(record["year"], record["event"]) for record in read_records(path) if record["type"] == "event"]
+    return pd.DataFrame(rows, columns=["Year", "Event"])
@@ -0,0 +1,89 @@
+# Counter-based random streams for agent-based Renaissance Florence simulation.
+# Every random number is a hash of (seed, year, phase, household, counter), so draws do not depend on
+# the order in which households are processed. With Florence(..., streams=True) the objects engine,
+# the arrays engine and ShardedFlorence give bit-identical results for the same seed.
+# The hash is the splitmix64 finalizer, computed on Python integers or on NumPy uint64 arrays.
+
+import numpy as np
+
+MASK = (1 << 64) - 1
+GOLDEN = 0x9E3779B97F4A7C15
+MULTIPLIER_1 = 0xBF58476D1CE4E5B9
+MULTIPLIER_2 = 0x94D049BB133111EB
+
+# Phases with their own streams, the population draws of the whole city use household 0 and those of block b use b + 1
+PHASES = {"strategy": 1, "deaths": 2, "births": 3, "trading": 4, "recalculation": 5, "partners": 6}
+
+def mix(z):
+    z = ((z ^ (z >> 30)) * MULTIPLIER_1) & MASK
+    z = ((z ^ (z >> 27)) * MULTIPLIER_2) & MASK
+    return z ^ (z >> 31)
+
+# The same hash on uint64 arrays, which wrap around on overflow like the masked Python version
+def mix_array(z):
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(MULTIPLIER_1)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(MULTIPLIER_2)
+    return z ^ (z >> np.uint64(31))
+
+# Adds one value to a hash chain
+def chain(h, value):
+    return mix(((h ^ (value & MASK)) + GOLDEN) & MASK)
+
+def chain_array(h, values):
+    return mix_array((h ^ np.asarray(values).astype(np.int64).astype(np.uint64)) + np.uint64(GOLDEN))
+
+class RandomStreams:
+
+    def __init__(self, seed):
+        self.seed = seed
+        self.root = chain(0, seed)
+
+    # Key of the stream of one household in one phase of a year
+    def key(self, year, phase, unique_id=0):
+        return chain(chain(chain(self.root, year), PHASES[phase]), unique_id)
+
+    # Keys for many households at once
+    def keys(self, year, phase, unique_ids):
+        return chain_array(np.uint64(chain(chain(self.root, year), PHASES[phase])), unique_ids)
+
+    # The counter-th number in [0, 1) of a stream
+    def uniform(self, key, counter):
+        return (chain(key, counter) >> 11) * 2.0 ** -53
+
+    def uniforms(self, keys, counters):
+        return (chain_array(keys, counters) >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+
+    # Sequential draws from the stream of one household in one phase, a drop-in for random.Random
+    def draws(self, year, phase, unique_id=0):
+        return StreamCounter(self, self.key(year, phase, unique_id))
+
+    # NumPy generator seeded with the key of a stream, for vectorized draws of a whole part of the population
+    def generator(self, year, phase, unique_id=0):
+        return np.random.Generator(np.random.PCG64(self.key(year, phase, unique_id)))
+
+    # Integer in [low, high], both inclusive
+    def integer(self, key, counter, low, high):
+        return low + int(self.uniform(key, counter) * (high - low + 1))
+
+    def integers(self, keys, counters, low, high):
+        return low + (self.uniforms(keys, counters) * (high - low + 1)).astype(np.int64)
+
+
+# Sequential draws from one stream, e.g. for household.recalculation_phase
+class StreamCounter:
+
+    def __init__(self, streams, key):
+        self.streams = streams
+        self.key = key
+        self.counter = 0
+
+    def random(self):
+        self.counter += 1
+        return self.streams.uniform(self.key, self.counter)
+
+    # Integer in [low, high], both inclusive, like random.randint
+    def randint(self, low, high):
+        return low + int(self.random() * (high - low + 1))
+
+    def randrange(self, n):
+        return int(self.random() * n)
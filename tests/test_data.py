@@ -0,0 +1,88 @@
+# Tests of the data cache of agent-based Renaissance Florence simulation.
+# The cache must follow the source file: rebuilt when its size or contents change, reused when it was
+# only touched, and a truncated cache file is treated as missing.
+#
+# Usage: python -m pytest -q tests
+
+import json
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import data
+
+CSV = "bocche,total,trade,location\n3,120.5,2107,S. Spirito\n1,0.0,2201,\n5,4000.0,2301,S. Croce\n"
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "catasto.csv"
+    path.write_text(CSV)
+    return str(path)
+
+# Counts the CSV parses, a load from the cache parses nothing
+@pytest.fixture
+def parses(monkeypatch):
+    calls = []
+    read_csv = pd.read_csv
+    def counting_read_csv(*args, **kwargs):
+        calls.append(args[0])
+        return read_csv(*args, **kwargs)
+    monkeypatch.setattr(data.pd, "read_csv", counting_read_csv)
+    return calls
+
+def cached_mtime(path):
+    with np.load(data.cache_path(path)) as cache:
+        return json.loads(str(cache["header"]))["mtime_ns"]
+
+def set_mtime(path, seconds):
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + seconds * 10 ** 9))
+
+def test_second_load_reads_the_cache(source, parses):
+    first = data.load_csv(source, data.prepare_1427)
+    second = data.load_csv(source, data.prepare_1427)
+    assert len(parses) == 1
+    pd.testing.assert_frame_equal(second, first)
+    assert second["trade_last2"].tolist() == ["07", "01", "01"]
+    assert second["location"].isna().tolist() == [False, True, False]     # Missing text is kept missing
+
+def test_changed_size_rebuilds(source, parses):
+    data.load_csv(source)
+    with open(source, "a") as f:
+        f.write("2,10.0,2401,S. Croce\n")
+    df = data.load_csv(source)
+    assert len(parses) == 2
+    assert df["bocche"].tolist() == [3, 1, 5, 2]
+
+def test_changed_contents_with_same_size_rebuild(source, parses):
+    data.load_csv(source)
+    with open(source, "w") as f:
+        f.write(CSV.replace("120.5", "999.5"))
+    set_mtime(source, 5)
+    df = data.load_csv(source)
+    assert len(parses) == 2
+    assert df["total"].tolist() == [999.5, 0.0, 4000.0]
+
+def test_touched_file_keeps_the_cache(source, parses):
+    data.load_csv(source)
+    set_mtime(source, 5)
+    df = data.load_csv(source)
+    assert len(parses) == 1                             # Same hash, so the CSV is not parsed again
+    assert cached_mtime(source) == os.stat(source).st_mtime_ns
+    assert df["total"].tolist() == [120.5, 0.0, 4000.0]
+
+def test_truncated_cache_is_a_miss(source, parses):
+    data.load_csv(source)
+    cache = data.cache_path(source)
+    with open(cache, "r+b") as f:
+        f.truncate(os.path.getsize(cache) // 2)
+    df = data.load_csv(source)
+    assert len(parses) == 2
+    assert df["bocche"].tolist() == [3, 1, 5]
+    data.load_csv(source)                               # The rebuilt cache is complete again
+    assert len(parses) == 2
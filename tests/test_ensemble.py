@@ -0,0 +1,24 @@
+# Tests of the ensemble runner of agent-based Renaissance Florence simulation.
+# Every run only depends on its seed, so the summary and the runs are the same whatever the number of workers.
+#
+# Usage: python -m pytest -q tests
+
+import os
+import sys
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ensemble import run_ensemble
+
+@pytest.mark.parametrize("engine", ["objects", "arrays"])
+def test_same_results_for_any_number_of_workers(engine):
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(ROOT)           # Data paths are relative to the repository, also in the worker processes
+        serial = run_ensemble(3, years=3, workers=1, engine=engine)
+        parallel = run_ensemble(3, years=3, workers=2, engine=engine)
+    for expected, result in zip(serial, parallel):
+        pd.testing.assert_frame_equal(result, expected)
+    assert serial[1].index.get_level_values("Seed").unique().tolist() == [1, 2, 3]
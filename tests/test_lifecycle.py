@@ -0,0 +1,61 @@
+# Tests of the household lifecycle of agent-based Renaissance Florence simulation.
+# Households that split off are queued during the recalculation phase and created together by Florence.create_splits,
+# households that died out are removed together after the deaths. The tests check the model is consistent after every step.
+#
+# Usage: python -m pytest -q tests
+
+import os
+import sys
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from data import load_inputs
+from model import Florence
+
+@pytest.fixture(scope="module")
+def inputs():
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(ROOT)           # Data paths are relative to the repository
+        return load_inputs()
+
+def florence(inputs, **kwargs):
+    df_1427, forced_loans_dict, mortality_dict = inputs
+    return Florence(1, df_1427, forced_loans_dict, mortality_dict, seed=1, agent_history=False, quiet=True, **kwargs)
+
+# No household is created during the phase, the queued splits join in the order of their parents
+@pytest.mark.parametrize("streams", [False, True])
+def test_splits_are_queued(inputs, streams):
+    model = florence(inputs, streams=streams)
+    model.step()
+    for agent in model.agents:
+        agent.calculate_taxable()
+    n = len(model.agents)
+    model.agents.do("recalculation_phase")
+    parents = list(model.splits)
+    assert parents and len(model.agents) == n
+    model.create_splits()
+    children = sorted(model.agents, key=lambda agent: agent.unique_id)[n:]
+    assert model.splits == {} and len(children) == len(parents)
+    assert [child.trade for child in children] == [parent.trade for parent in parents]
+    assert [child.location for child in children] == [parent.location for parent in parents]
+
+@pytest.mark.parametrize("engine", ["objects", "arrays"])
+def test_households_after_step(inputs, engine):
+    model = florence(inputs, engine=engine)
+    for _ in range(3):
+        ids = {agent.unique_id for agent in model.agents}
+        with_members = {agent.unique_id for agent in model.agents if agent.bocche > 0}       # Some 1427 households have none
+        model.step()
+        after = {agent.unique_id: agent for agent in model.agents}
+        new = sorted(set(after) - ids)
+        assert model.splits == {}
+        assert new and new == list(range(max(ids) + 1, max(ids) + 1 + len(new)))         # Split households in the order of their parents
+        assert all(agent.bocche > 0 for unique_id, agent in after.items() if unique_id in with_members)      # Households that died out are gone
+        indexed = [agent.unique_id for members in model.classified_agents.members for agent in members]
+        assert sorted(indexed) == sorted(after)
+        assert all(agent.wealth_class == wealth_class for wealth_class, members in enumerate(model.classified_agents.members) for agent in members)
+        if model.engine is not None:
+            assert np.array_equal(model.engine.unique_id[model.engine.rows()], np.array(sorted(after)))
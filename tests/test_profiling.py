@@ -0,0 +1,40 @@
+# Tests of the phase profiler of agent-based Renaissance Florence simulation.
+# The detailed mode traces memory with tracemalloc, the profiler stops tracing when it is closed
+# but only if it was the one that started it.
+#
+# Usage: python -m pytest -q tests
+
+import os
+import sys
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from profiling import PhaseProfiler
+
+def test_detailed_stops_its_own_tracing():
+    assert not tracemalloc.is_tracing()
+    with PhaseProfiler("detailed") as profiler:
+        with profiler.phase("trading", 1427):
+            values = [float(i) for i in range(1000)]
+        assert tracemalloc.is_tracing()
+    assert not tracemalloc.is_tracing()
+    assert profiler.to_dataframe()["Allocated_Bytes"].iloc[0] > 0
+    assert len(values) == 1000
+
+def test_detailed_keeps_outside_tracing():
+    tracemalloc.start()
+    try:
+        profiler = PhaseProfiler("detailed")
+        profiler.close()
+        del profiler
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+
+def test_deleted_profiler_stops_tracing():
+    profiler = PhaseProfiler("detailed")
+    assert tracemalloc.is_tracing()
+    del profiler
+    assert not tracemalloc.is_tracing()
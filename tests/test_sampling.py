@@ -0,0 +1,65 @@
+# Tests of the sampling structures of agent-based Renaissance Florence simulation.
+# The deaths and births of Florence draw with FenwickTree instead of random.choices and random.choice,
+# which keeps seeded runs identical only if the tree consumes the generator exactly like them.
+#
+# Usage: python -m pytest -q tests
+
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from sampling import FenwickTree, ClassIndex
+
+WEIGHTS = [3, 0, 1, 7, 0, 0, 2, 12, 1, 0, 5]      # Zero weights are never drawn by either
+
+# Draws with the tree and with random.choices from two generators with the same seed, updating the weights after every draw
+def test_sample_matches_choices():
+    weights = list(WEIGHTS)
+    tree = FenwickTree(weights)
+    tree_random, list_random = random.Random(7), random.Random(7)
+    population = range(len(weights))
+    for step in range(2000):
+        i = tree.sample(tree_random)
+        assert i == list_random.choices(population, weights)[0]
+        assert weights[i] > 0
+        delta = 1 if step % 3 else -1                       # Grow and shrink the drawn weight, as births and deaths do
+        if weights[i] + delta >= 0:
+            weights[i] += delta
+            tree.add(i, delta)
+        if step % 50 == 0:                                  # Revive an index that was empty
+            j = weights.index(0) if 0 in weights else 0
+            weights[j] += 2
+            tree.add(j, 2)
+        assert tree.total == sum(weights)
+    assert tree_random.random() == list_random.random()     # Same number of draws consumed
+
+# Picks among the entries of weight 1 with find(randrange(total)) and with random.choice on the list of those entries
+def test_find_randrange_matches_choice():
+    alive = [1, 1, 0, 1, 0, 1, 1, 1, 0, 0, 1, 1, 1]
+    tree = FenwickTree(alive)
+    tree_random, list_random = random.Random(11), random.Random(11)
+    for step in range(500):
+        i = tree.find(tree_random.randrange(tree.total))
+        assert i == list_random.choice([j for j, a in enumerate(alive) if a])
+        if step % 7 == 0 and tree.total > 1:               # A household dies
+            alive[i] = 0
+            tree.add(i, -1)
+        elif step % 11 == 0:                                # A dead household comes back, e.g. a reused index
+            j = alive.index(0) if 0 in alive else 0
+            alive[j] = 1
+            tree.add(j, 1)
+    assert tree_random.random() == list_random.random()
+
+def test_class_index_remove_and_move():
+    index = ClassIndex()
+    for agent in range(10):
+        index.add(agent, agent % 3)
+    index.remove(3)
+    index.move(4, 5)
+    assert sorted(index[0]) == [0, 6, 9]
+    assert sorted(index[1]) == [1, 7]
+    assert index[5] == [4]
+    assert len(index) == 9
@@ -0,0 +1,47 @@
+# Tests of sharded execution of agent-based Renaissance Florence simulation.
+# With counter-based streams a sharded run draws its population, trades and splits per block of households
+# like Florence(..., streams=True), so for the same seed it must give the same statistics as the objects and
+# arrays engines, whatever the number of workers.
+#
+# Usage: python -m pytest -q tests
+
+import os
+import sys
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from data import load_inputs
+from model import Florence
+from shards import ShardedFlorence
+
+YEARS = 4
+
+@pytest.fixture(scope="module")
+def inputs():
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(ROOT)           # Data paths are relative to the repository
+        return load_inputs()
+
+def florence(inputs, engine, seed):
+    model = Florence(1, *inputs, seed=seed, engine=engine, streams=True, agent_history=False, quiet=True)
+    for _ in range(YEARS):
+        model.step()
+    return model.datacollector.get_model_vars_dataframe()
+
+def sharded(inputs, workers, seed):
+    with ShardedFlorence(1, *inputs, seed=seed, workers=workers, quiet=True) as model:
+        for _ in range(YEARS):
+            model.step()
+    return model.get_model_vars_dataframe()
+
+@pytest.mark.parametrize("seed", [1, 2])
+def test_sharded_run_matches_streams_engines(inputs, seed):
+    arrays = florence(inputs, "arrays", seed)
+    pd.testing.assert_frame_equal(florence(inputs, "objects", seed), arrays)
+    pd.testing.assert_frame_equal(sharded(inputs, 1, seed), arrays.reset_index(drop=True))
+
+def test_same_results_for_any_number_of_workers(inputs):
+    pd.testing.assert_frame_equal(sharded(inputs, 2, 1), sharded(inputs, 1, 1))
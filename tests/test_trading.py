@@ -0,0 +1,74 @@
+# Tests of the trading phase of agent-based Renaissance Florence simulation.
+# Runs household.trading_phase (objects engine) and HouseholdArrays.trading_phase (arrays engine) once from
+# the same initial state and compares the investment gains, the deductions taken on and the wealth classes
+# of the trading partners. The engines draw differently, so the distributions are compared with a tolerance.
+#
+# Usage: python -m pytest -q tests
+
+import os
+import sys
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from data import load_inputs
+from model import Florence
+
+COLUMNS = ("unique_id", "investments", "deductions", "wealth_class", "bocche", "trade_strategy")
+INSTABILITY = 0.1
+
+@pytest.fixture(scope="module")
+def inputs():
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(ROOT)           # Data paths are relative to the repository
+        return load_inputs()
+
+# Household columns sorted by unique_id
+def state(model):
+    if model.engine is not None:
+        rows = model.engine.rows()
+        return {name: getattr(model.engine, name)[rows].astype(float) for name in COLUMNS}
+    agents = sorted(model.agents, key=lambda agent: agent.unique_id)
+    return {name: np.array([getattr(agent, name) for agent in agents], dtype=float) for name in COLUMNS}
+
+# Initial state, gains and deductions of one trading phase per household, and the share of the traded florins per partner class
+def trade_once(inputs, engine, seed):
+    df_1427, forced_loans_dict, mortality_dict = inputs
+    model = Florence(1, df_1427, forced_loans_dict, mortality_dict, seed=seed, engine=engine, agent_history=False, quiet=True)
+    model.instability = INSTABILITY
+    before = state(model)
+    if model.engine is not None:
+        model.engine.trading_phase(model.rng, model.instability, model.labor_productivity, model.capital_return_rate)
+    else:
+        model.agents.shuffle_do("trading_phase")
+    after = state(model)
+    gains = after["investments"] - before["investments"]
+    deductions = after["deductions"] - before["deductions"]
+    partner_classes = np.bincount(before["wealth_class"].astype(int), weights=deductions, minlength=6) / deductions.sum()
+    return before, gains, deductions, partner_classes
+
+# Both engines traded once from the same seed
+@pytest.fixture(scope="module", params=[1, 2])
+def trades(request, inputs):
+    return {engine: trade_once(inputs, engine, request.param) for engine in ("objects", "arrays")}
+
+def test_same_initial_state(trades):
+    for name in COLUMNS:
+        np.testing.assert_array_equal(trades["arrays"][0][name], trades["objects"][0][name])
+
+def test_investment_gains(trades):
+    gains, vectorized = trades["objects"][1], trades["arrays"][1]
+    assert vectorized.mean() == pytest.approx(gains.mean(), rel=0.002)
+    np.testing.assert_allclose(np.quantile(vectorized, [0.1, 0.5, 0.9, 0.99]), np.quantile(gains, [0.1, 0.5, 0.9, 0.99]), rtol=0.02)
+
+def test_deductions(trades):
+    deductions, vectorized = trades["objects"][2], trades["arrays"][2]
+    assert vectorized.mean() == pytest.approx(deductions.mean(), rel=0.005)
+    np.testing.assert_allclose(np.quantile(vectorized, [0.25, 0.5, 0.75, 0.9]), np.quantile(deductions, [0.25, 0.5, 0.75, 0.9]), rtol=0.05)
+    assert (vectorized > 0).mean() == pytest.approx((deductions > 0).mean(), abs=0.01)
+
+def test_partner_classes(trades):
+    partner_classes, vectorized = trades["objects"][3], trades["arrays"][3]
+    np.testing.assert_allclose(vectorized, partner_classes, atol=0.02)